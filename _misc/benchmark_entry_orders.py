@@ -0,0 +1,100 @@
+# Measure manage_packages.update_entry_orders on a synthetic MDB.
+# The previous implementation (list.index per record) is included for comparison and both results are checked to match.
+# Usage: python _misc/benchmark_entry_orders.py [--records 5000] [--runs 5]
+
+import argparse
+import copy
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_PATH)
+
+import manage_packages
+
+
+def update_entry_orders_list_index(mdb):
+    title_ascii_list = [""] + sorted([x for x in set([mdb['records'][k]['title_ascii']['value'] for k in mdb['records'] if 'title_ascii' in mdb['records'][k]]) if x])
+    artist_title_ascii_list = [""] + sorted([x for x in set([mdb['records'][k]['artist_title_ascii']['value'] for k in mdb['records'] if 'artist_title_ascii' in mdb['records'][k]]) if x])
+
+    for k in mdb['records']:
+        order_ascii = title_ascii_list.index(mdb['records'][k]['title_ascii']['value']) + 1 if 'title_ascii' in mdb['records'][k] else 1
+        mdb['records'][k]['order_ascii'] = {
+            'type': "u16",
+            'value': order_ascii
+        }
+
+        artist_order_ascii = artist_title_ascii_list.index(mdb['records'][k]['artist_title_ascii']['value']) + 1 if 'artist_title_ascii' in mdb['records'][k] else 1
+        mdb['records'][k]['artist_order_ascii'] = {
+            'type': "u16",
+            'value': artist_order_ascii
+        }
+
+    return mdb
+
+
+def generate_mdb(record_count):
+    random.seed(0)
+
+    def random_ascii():
+        # Some titles and artists are empty or shared between songs like in the real MDB
+        if random.random() < 0.05:
+            return ""
+
+        return "".join(random.choice(string.ascii_uppercase + " ") for _ in range(random.randint(1, 15)))
+
+    artists = [random_ascii() for _ in range(record_count // 4)]
+
+    mdb = {
+        'records': {},
+        'courses': {},
+    }
+
+    for music_id in range(record_count):
+        mdb['records'][music_id] = {
+            'music_id': {'type': "s32", 'value': music_id},
+            'title_ascii': {'type': "str", 'value': random_ascii()},
+            'artist_title_ascii': {'type': "str", 'value': random.choice(artists)},
+        }
+
+    return mdb
+
+
+def measure(func, mdb, runs):
+    timings = []
+
+    for _ in range(runs):
+        data = copy.deepcopy(mdb)
+
+        start = time.perf_counter()
+        func(data)
+        timings.append(time.perf_counter() - start)
+
+    return timings, data
+
+
+def print_result(name, timings):
+    print("%-30s median %.3fs  min %.3fs  max %.3fs" % (name, statistics.median(timings), min(timings), max(timings)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', help='Number of records in the synthetic MDB', default=5000, type=int)
+    parser.add_argument('--runs', help='Number of runs per measurement', default=5, type=int)
+    args = parser.parse_args()
+
+    mdb = generate_mdb(args.records)
+
+    list_index_timings, list_index_result = measure(update_entry_orders_list_index, mdb, args.runs)
+    rank_map_timings, rank_map_result = measure(manage_packages.update_entry_orders, mdb, args.runs)
+
+    if list_index_result != rank_map_result:
+        print("Results don't match!")
+        exit(1)
+
+    print_result("list.index (previous)", list_index_timings)
+    print_result("update_entry_orders", rank_map_timings)
@@ -0,0 +1,57 @@
+# Measure startup time of the tools and the import time of their modules.
+# Each measurement runs in a fresh interpreter so nothing is cached between runs.
+# Usage: python _misc/benchmark_startup.py [--runs 10] [--path other_checkout]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "helper",
+    "audio",
+    "wavbintool",
+    "vas3tool",
+    "plugins.json",
+    "plugins.dtx",
+    "plugins.sq3",
+    "plugins.wav",
+]
+
+COMMANDS = [
+    ["seqtool.py", "--help"],
+]
+
+
+def measure(cmd, runs, path):
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def print_result(name, timings):
+    print("%-30s median %.3fs  min %.3fs  max %.3fs" % (name, statistics.median(timings), min(timings), max(timings)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', help='Number of runs per measurement', default=10, type=int)
+    parser.add_argument('--path', help='Folder containing the tools', default=BASE_PATH)
+    args = parser.parse_args()
+
+    print_result("python (baseline)", measure([sys.executable, "-c", "pass"], args.runs, args.path))
+
+    for module in MODULES:
+        print_result("import %s" % module, measure([sys.executable, "-c", "import %s" % module], args.runs, args.path))
+
+    for command in COMMANDS:
+        print_result(" ".join(command), measure([sys.executable] + command, args.runs, args.path))
@@ -7,8 +7,6 @@ import tmpfile
 
 import helper
 
-helper.check_ffmpeg()
-
 
 def get_audio_file(filename):
     filename = helper.getCaseInsensitivePath(filename)
@@ -35,10 +33,17 @@ def get_duration(filename):
     return len(sound_file) / 1000
 
 def clip_audio(input_filename, output_filename, duration):
+    clip_audio_multiple(input_filename, [(output_filename, duration)])
+
+def clip_audio_multiple(input_filename, clips):
+    # Decode the input once and write every requested (output_filename, duration) clip from it
     filename = helper.getCaseInsensitivePath(input_filename)
-    sound_file = get_audio_file(filename)[:duration * 1000]
-    sound_file.export(output_filename, format="wav")
-    print("Generated", output_filename, len(sound_file) / 1000, duration)
+    sound_file = get_audio_file(filename)
+
+    for output_filename, duration in clips:
+        clipped_file = sound_file[:duration * 1000]
+        clipped_file.export(output_filename, format="wav")
+        print("Generated", output_filename, len(clipped_file) / 1000, duration)
 
 def merge_bgm(bgm_info, input_foldername, output_filename=None):
     longest_duration = bgm_info['end']
@@ -48,6 +53,10 @@ def merge_bgm(bgm_info, input_foldername, output_filename=None):
     for bgm in bgm_info['data']:
         filename = helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm['filename']))
         print(filename)
+
+        if not filename.lower().endswith(".wav"):
+            helper.get_ffmpeg_path()
+
         bgm['file'] = pydub.AudioSegment.from_file(filename)
         duration = bgm['timestamp'] + len(bgm['file']) / 1000
 
@@ -33,6 +33,8 @@ copy /Y eamxml.py %release%\work
 copy /Y event.py %release%\work
 copy /Y helper.py %release%\work
 copy /Y ifs.py %release%\work
+copy /Y intermediate.py %release%\work
+copy /Y jobs.py %release%\work
 copy /Y manage_packages.py %release%\work
 copy /Y mdb.py %release%\work
 copy /Y seqtool.py %release%\work
@@ -3,6 +3,7 @@ import glob
 import os
 import pydub
 
+import helper
 import ifs
 import mdb
 import tmpfile
@@ -26,8 +27,16 @@ parser.add_argument('--mix-phase', help='Mix using inverted phase BGM', default=
 parser.add_argument('--mix-base-volume', help='Reduce volume of base audio')
 parser.add_argument('--mix-guitar-volume', help='Reduce volume of guitar audio')
 parser.add_argument('--mix-drum-volume', help='Reduce volume of drum audio')
+parser.add_argument('--ffmpeg-path', help='Path to ffmpeg executable')
+parser.add_argument('--ifs-cache', help='Keep files extracted from IFS archives in a cache of up to SIZE megabytes between runs', metavar='SIZE', default=None, type=int)
 args = parser.parse_args()
 
+if args.ffmpeg_path:
+    helper.set_ffmpeg_path(args.ffmpeg_path)
+
+if args.ifs_cache:
+    ifs.enable_cache(args.ifs_cache * 1024 * 1024)
+
 if args.mix_phase:
     if not args.mix_base_volume:
         args.mix_base_volume = -2
@@ -43,19 +52,18 @@ else:
     if not args.mix_drum_volume:
         args.mix_drum_volume = -3.5
 
+# Only the BGM files that are used are extracted from IFS files
 if os.path.isfile(args.input):
-    filenames_bgm, ifs_path = ifs.extract(args.input)
+    bgm_archive = ifs.IfsReader(args.input)
+    filenames_bgm = bgm_archive.list()
 else:
+    bgm_archive = None
     filenames_bgm = glob.glob(args.input + "/bgm*.bin")
-    ifs_path = args.input
-
-tmpfile.add_temp_folder(ifs_path)
 
 if args.mix_phase:
     # Get guitar+bass BGM
     bgms = [x for x in filenames_bgm if x.endswith("___k.bin")]
     base_bgm = bgms[0] if len(bgms) > 0 else None
-    base_bgm_out = base_bgm.replace(".bin", ".wav") if len(bgms) > 0 else None
 
 # Get drum BGM
 bgms = [x for x in filenames_bgm if x.endswith("d__k.bin")]
@@ -64,12 +72,10 @@ if len(bgms) == 0:
     bgms = [x for x in filenames_bgm if x.endswith("d_bk.bin")]
 
 drum_bgm = bgms[0] if len(bgms) > 0 else None
-drum_bgm_out = drum_bgm.replace(".bin", ".wav") if len(bgms) > 0 else None
 
 # Get guitar+bass BGM
 bgms = [x for x in filenames_bgm if x.endswith("_gbk.bin")]
 guitar_bgm = bgms[0] if len(bgms) > 0 else None
-guitar_bgm_out = guitar_bgm.replace(".bin", ".wav") if len(bgms) > 0 else None
 
 if args.mix_phase and not base_bgm:
     print("Couldn't find base BGM")
@@ -86,8 +92,19 @@ if not guitar_bgm:
     tmpfile.tmpcleanup()
     exit(1)
 
-tmpfile.add_temp_file(drum_bgm_out)
-tmpfile.add_temp_file(guitar_bgm_out)
+if bgm_archive:
+    drum_bgm = bgm_archive.extract(drum_bgm)
+    guitar_bgm = bgm_archive.extract(guitar_bgm)
+
+    if args.mix_phase:
+        base_bgm = bgm_archive.extract(base_bgm)
+
+# Extracted BGMs can be in the IFS cache, so the WAVs are written to temp files instead of next to them
+if args.mix_phase:
+    base_bgm_out = tmpfile.mkstemp(suffix=".wav")
+
+drum_bgm_out = tmpfile.mkstemp(suffix=".wav")
+guitar_bgm_out = tmpfile.mkstemp(suffix=".wav")
 
 music_id = int(os.path.basename(drum_bgm)[3:7])
 
@@ -151,6 +168,10 @@ if not output_filename:
         output_filename = "%04d.%s" % (music_id, format)
 
 output_filename = get_sanitized_filename(output_filename)
+
+if format.lower() != "wav":
+    helper.get_ffmpeg_path()
+
 mixed_audio.export(output_filename, format=format, bitrate=args.quality, tags=tags)
 
 print("Saved to", output_filename)
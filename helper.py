@@ -1,7 +1,6 @@
-import pykakasi
-import imageio
 import os
 import shutil
+import threading
 
 
 def getCaseInsensitivePath(path):
@@ -55,6 +54,8 @@ def romanize(text):
     if all(ord(c) < 128 for c in text):
         return text
 
+    import pykakasi
+
     kakasi = pykakasi.kakasi()
     kakasi.setMode("H","a")
     kakasi.setMode("K","a")
@@ -66,22 +67,71 @@ def romanize(text):
 
 
 
-def check_ffmpeg():
-    try:
-        if not os.path.exists("ffmpeg.exe"):
-            exe_path = imageio.plugins.ffmpeg.get_exe()
-            ext = os.path.splitext(exe_path)[-1]
-            filename = "ffmpeg" + ext
+# ffmpeg is only needed to decode/encode compressed audio (mp3, ogg, etc).
+# WAV files are handled by pydub directly, so the lookup is deferred until
+# something actually needs ffmpeg and the result is cached.
+ffmpeg_path = None
+ffmpeg_resolved = False
+ffmpeg_lock = threading.Lock()
+
+
+def set_ffmpeg_path(path):
+    global ffmpeg_path, ffmpeg_resolved
+
+    with ffmpeg_lock:
+        ffmpeg_path = path
+        ffmpeg_resolved = False
 
-            shutil.copy(exe_path, filename)
 
+def find_ffmpeg():
+    if ffmpeg_path:
+        return ffmpeg_path
+
+    if os.environ.get("FFMPEG_PATH"):
+        return os.environ["FFMPEG_PATH"]
+
+    for filename in ["ffmpeg.exe", "ffmpeg"]:
+        if os.path.isfile(filename):
+            return os.path.abspath(filename)
+
+    path = shutil.which("ffmpeg")
+    if path:
+        return path
+
+    # Last resort: use the binary provided by imageio, downloading it if required
+    try:
+        import imageio
+        return imageio.plugins.ffmpeg.get_exe()
     except:
+        pass
+
+    try:
+        import imageio
         imageio.plugins.ffmpeg.download(directory=".")
 
         for platform in imageio.plugins.ffmpeg.FNAME_PER_PLATFORM:
-            filename = imageio.plugins.ffmpeg.FNAME_PER_PLATFORM[platform]
-            path = os.path.join("ffmpeg", filename)
-            ext = os.path.splitext(filename)[-1]
+            path = os.path.join("ffmpeg", imageio.plugins.ffmpeg.FNAME_PER_PLATFORM[platform])
 
             if os.path.exists(path):
-                shutil.copy(path, "ffmpeg" + ext)
+                return os.path.abspath(path)
+    except:
+        pass
+
+    return None
+
+
+def get_ffmpeg_path():
+    global ffmpeg_path, ffmpeg_resolved
+
+    with ffmpeg_lock:
+        if not ffmpeg_resolved:
+            ffmpeg_path = find_ffmpeg()
+            ffmpeg_resolved = True
+
+            if ffmpeg_path:
+                import pydub
+                pydub.AudioSegment.converter = ffmpeg_path
+            else:
+                print("Couldn't find ffmpeg, compressed audio files can't be used")
+
+        return ffmpeg_path
@@ -1,7 +1,11 @@
 import glob
+import hashlib
 import io
 import os
+import shutil
 import sys
+import tempfile
+import threading
 
 # Cheap hack to make the release for manage_packages.py cleaner
 try:
@@ -11,12 +15,181 @@ except:
 
 from ifstools.ifs import IFS
 
+
+class IfsCache:
+    # Extracted IFS members kept between runs in the cache folder.
+    # Entries are keyed by the IFS file's path, mtime and size so a changed archive is never served old files.
+    # Once the cache grows over max_size bytes, the entries that were used least recently are removed.
+    # Cached files can be removed by other processes at any time, so they are always copied or read
+    # instead of being handed out to callers.
+
+    def __init__(self, max_size):
+        self.path = tmpfile.get_cache_dir("ifs")
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entry_sizes = None
+
+    def get_entry_path(self, filename):
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        key = "%s|%d|%d" % (filename, stat.st_mtime_ns, stat.st_size)
+
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def touch(self, entry_path):
+        # The entry folder's mtime is used to find the least recently used entries
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+    def get_size(self, foldername):
+        size = 0
+
+        for root, _, filenames in os.walk(foldername):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    pass
+
+        return size
+
+    def add_entry_size(self, entry_path, size):
+        # The cache is only scanned once, after that the sizes are updated as files are added
+        with self.lock:
+            if self.entry_sizes is None:
+                self.entry_sizes = {}
+
+                for entry in os.scandir(self.path):
+                    if entry.is_dir():
+                        self.entry_sizes[entry.path] = self.get_size(entry.path)
+
+            self.entry_sizes[entry_path] = self.entry_sizes.get(entry_path, 0) + size
+
+    def read_member(self, filename, member):
+        # Returns None if the member isn't cached
+        entry_path = self.get_entry_path(filename)
+
+        try:
+            with open(os.path.join(entry_path, member), "rb") as f:
+                data = f.read()
+
+        except OSError:
+            return None
+
+        self.touch(entry_path)
+
+        return data
+
+    def add_member(self, filename, member, data):
+        entry_path = self.get_entry_path(filename)
+        member_path = os.path.join(entry_path, member)
+        os.makedirs(os.path.dirname(member_path), exist_ok=True)
+
+        try:
+            old_size = os.path.getsize(member_path)
+        except OSError:
+            old_size = 0
+
+        # Other processes may be reading the same member, so replace it in one step
+        fid, temp_filename = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fid, "wb") as f:
+            f.write(data)
+
+        os.replace(temp_filename, member_path)
+
+        self.touch(entry_path)
+        self.add_entry_size(entry_path, len(data) - old_size)
+        self.trim(entry_path)
+
+    def copy_folder(self, filename, path):
+        # Copies every member of the IFS to path, returns False if the IFS isn't fully cached (see add_folder)
+        entry_path = self.get_entry_path(filename)
+
+        if not os.path.isdir(entry_path) or not os.path.exists(entry_path + ".complete"):
+            return False
+
+        self.touch(entry_path)
+
+        try:
+            shutil.copytree(entry_path, path, dirs_exist_ok=True)
+
+        except (OSError, shutil.Error):
+            # Removed by another process while copying
+            return False
+
+        return True
+
+    def add_folder(self, filename, foldername):
+        entry_path = self.get_entry_path(filename)
+        old_size = self.get_size(entry_path)
+
+        shutil.copytree(foldername, entry_path, dirs_exist_ok=True)
+        open(entry_path + ".complete", "w").close()
+
+        self.touch(entry_path)
+        self.add_entry_size(entry_path, self.get_size(entry_path) - old_size)
+        self.trim(entry_path)
+
+    def trim(self, keep_path=None):
+        with self.lock:
+            total_size = sum(self.entry_sizes.values())
+
+            if total_size <= self.max_size:
+                return
+
+            entries = []
+            for entry_path in list(self.entry_sizes.keys()):
+                try:
+                    entries.append((os.stat(entry_path).st_mtime, entry_path))
+
+                except OSError:
+                    # Removed by another process
+                    total_size -= self.entry_sizes.pop(entry_path)
+
+            for _, entry_path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+
+                # Don't remove the entry that was just used, even if it's bigger than the cache
+                if entry_path == keep_path:
+                    continue
+
+                shutil.rmtree(entry_path, ignore_errors=True)
+
+                if os.path.exists(entry_path + ".complete"):
+                    os.remove(entry_path + ".complete")
+
+                total_size -= self.entry_sizes.pop(entry_path)
+
+
+# Set by enable_cache, extraction isn't cached by default
+cache = None
+
+
+def enable_cache(max_size):
+    # max_size is in bytes, 0 or None disables the cache.
+    # Batch workers call this for every song, so the same cache (and its size index) is kept if nothing changed.
+    global cache
+
+    if not max_size:
+        cache = None
+    elif cache is None or cache.max_size != max_size or cache.path != tmpfile.get_cache_dir("ifs"):
+        cache = IfsCache(max_size)
+
+
 def extract(filename, path=None, progress=False):
     if not path:
         path = tmpfile.mkdtemp(prefix="ifs")
 
-    ifs = IFS(filename)
-    ifs.extract(progress=progress, path=path)
+    # Copy the files so the caller can modify them without touching the cache
+    if not cache or not cache.copy_folder(filename, path):
+        ifs = IFS(filename)
+        ifs.extract(progress=progress, path=path)
+
+        if cache:
+            cache.add_folder(filename, path)
 
     # Get file list
     return glob.glob(os.path.join(path, "*")), path
@@ -26,3 +199,125 @@ def create(foldername, output_filename, progress=False):
     ifs.repack(progress=progress, path=output_filename, use_cache=True)
 
     return output_filename
+
+
+class IfsReader:
+    # Reads members of an IFS without extracting the whole archive.
+    # Members are decompressed in memory when read, and only written to disk when extract is called.
+    # If the cache is enabled, members are read from and saved to the cache instead.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.ifs = IFS(filename)
+        self.members = {f.full_path.replace("\\", "/"): f for f in self.ifs.tree.all_files}
+        self.path = None
+        self.lock = threading.Lock()
+
+    def list(self):
+        return sorted(self.members.keys())
+
+    def load(self, member):
+        # Reads can come from multiple threads but the IFS file handle is shared
+        with self.lock:
+            return self.members[member].load()
+
+    def read(self, member):
+        if cache is None:
+            return self.load(member)
+
+        data = cache.read_member(self.filename, member)
+
+        if data is not None:
+            return data
+
+        data = self.load(member)
+        cache.add_member(self.filename, member, data)
+
+        return data
+
+    def open(self, member):
+        return io.BytesIO(self.read(member))
+
+    def extract(self, member, path=None):
+        # Writes a single member to disk and returns its filename.
+        # Without a path, members are written to a temp folder shared by the reader.
+        if not path:
+            if self.path is None:
+                self.path = tmpfile.mkdtemp(prefix="ifs")
+
+            path = self.path
+
+        output_filename = os.path.join(path, member)
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+
+        with open(output_filename, "wb") as f:
+            f.write(self.read(member))
+
+        return output_filename
+
+    def close(self):
+        if hasattr(self.ifs, 'close'):
+            self.ifs.close()
+
+
+def get_folder_hashes(foldername):
+    hashes = {}
+
+    for root, _, filenames in os.walk(foldername):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+
+            with open(path, "rb") as f:
+                hashes[os.path.relpath(path, foldername)] = hashlib.sha1(f.read()).hexdigest()
+
+    return hashes
+
+
+class IfsSession:
+    # Extract-modify-repack cycle for an IFS archive.
+    # The archive is only extracted once something asks for its folder, and only repacked
+    # on close if a member was actually added, removed or changed.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = None
+        self.original_hashes = {}
+
+    def get_path(self):
+        if self.path is None:
+            if os.path.exists(self.filename):
+                _, self.path = extract(self.filename)
+            else:
+                self.path = tmpfile.mkdtemp(prefix="ifs")
+
+            self.original_hashes = get_folder_hashes(self.path)
+
+        return self.path
+
+    def get_member_path(self, member):
+        return os.path.join(self.get_path(), member)
+
+    def get_modified_members(self):
+        if self.path is None:
+            return []
+
+        hashes = get_folder_hashes(self.path)
+        members = set(hashes.keys()) | set(self.original_hashes.keys())
+
+        return sorted([x for x in members if hashes.get(x) != self.original_hashes.get(x)])
+
+    def close(self):
+        # Returns True if the archive was repacked
+        modified_members = self.get_modified_members()
+
+        if not modified_members:
+            return False
+
+        create(self.path, self.filename)
+        self.original_hashes = get_folder_hashes(self.path)
+
+        # The folder matches the new archive, so the next extract can be skipped
+        if cache:
+            cache.add_folder(self.filename, self.path)
+
+        return True
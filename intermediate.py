@@ -0,0 +1,51 @@
+import json
+
+# The intermediate chart data is passed between plugins as plain Python objects.
+# normalize() produces the same structure a json.dumps(sort_keys=True) + json.loads
+# round trip would (string keys in the same order, lists instead of tuples, nothing
+# shared between charts) without paying for the text encoding in between.
+
+def normalize_key(key):
+    if isinstance(key, str):
+        return key
+
+    elif key is True:
+        return "true"
+
+    elif key is False:
+        return "false"
+
+    elif key is None:
+        return "null"
+
+    elif isinstance(key, int):
+        return int.__repr__(key)
+
+    elif isinstance(key, float):
+        return json.dumps(key)
+
+    raise TypeError("Invalid intermediate key: %s" % repr(key))
+
+
+def normalize(data):
+    if isinstance(data, dict):
+        return {normalize_key(k): normalize(v) for k, v in sorted(data.items())}
+
+    elif isinstance(data, (list, tuple)):
+        return [normalize(v) for v in data]
+
+    return data
+
+
+def to_json(data, sort_keys=True):
+    if data is None:
+        return None
+
+    return json.dumps(data, indent=4, sort_keys=sort_keys)
+
+
+def from_json(data):
+    if not data:
+        return None
+
+    return json.loads(data)
@@ -0,0 +1,195 @@
+# Central job scheduler used by seqtool and the plugins.
+# CPU heavy work (audio encoding, BGM renders, etc) goes to a process pool so it isn't
+# serialized by the GIL, and everything else (file copies, orchestration) goes to a
+# thread pool. Jobs can depend on other jobs and failures are collected so the caller
+# can report them and exit with an error.
+
+import concurrent.futures
+import os
+import threading
+import traceback
+
+import helper
+import tmpfile
+
+
+def init_worker(ffmpeg_path):
+    if ffmpeg_path:
+        helper.set_ffmpeg_path(ffmpeg_path)
+
+
+def run_process_job(func, args):
+    # Workers may be forked from the main process, so only clean up
+    # temp files created by this job
+    temp_state = tmpfile.get_temp_state()
+
+    try:
+        return func(*args)
+
+    finally:
+        tmpfile.tmpcleanup(temp_state)
+
+
+class JobRunner:
+    def __init__(self, jobs=None, inline=False):
+        self.jobs = jobs if jobs else (os.cpu_count() or 1)
+        self.inline = inline
+
+        self.process_pool = None
+        self.io_pool = None
+
+        self.lock = threading.Lock()
+        self.futures = []
+        self.failures = []
+
+    def get_process_pool(self):
+        with self.lock:
+            if self.process_pool is None:
+                self.process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs,
+                                                                           initializer=init_worker,
+                                                                           initargs=(helper.ffmpeg_path,))
+
+            return self.process_pool
+
+    def get_io_pool(self):
+        with self.lock:
+            if self.io_pool is None:
+                self.io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+
+            return self.io_pool
+
+    def add_failure(self, name, exception, tb=None):
+        if tb is None:
+            tb = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+
+        print("Job %s failed:" % name)
+        print(tb)
+
+        with self.lock:
+            self.failures.append((name, exception))
+
+    def start(self, name, func, args, io, output):
+        if output.set_running_or_notify_cancel() is False:
+            return
+
+        if io:
+            future = self.get_io_pool().submit(func, *args)
+        else:
+            future = self.get_process_pool().submit(run_process_job, func, args)
+
+        def finished(future):
+            exception = future.exception()
+
+            if exception is not None:
+                self.add_failure(name, exception)
+                output.set_exception(exception)
+            else:
+                output.set_result(future.result())
+
+        future.add_done_callback(finished)
+
+    def submit(self, func, *args, depends=None, io=False, name=None):
+        # Returns a future that finishes once the job has run.
+        # Jobs listed in depends must succeed before this job is started.
+        name = name if name else func.__name__
+        depends = [x for x in depends if x is not None] if depends else []
+
+        output = concurrent.futures.Future()
+
+        with self.lock:
+            self.futures.append(output)
+
+        if self.inline:
+            output.set_running_or_notify_cancel()
+
+            if any([x.exception() is not None for x in depends]):
+                output.set_exception(Exception("Dependency of %s failed" % name))
+                return output
+
+            try:
+                output.set_result(func(*args))
+
+            except (Exception, SystemExit) as e:
+                self.add_failure(name, e)
+                output.set_exception(e)
+
+            return output
+
+        pending = [len(depends)]
+        pending_lock = threading.Lock()
+
+        def dependency_finished(future):
+            with pending_lock:
+                pending[0] -= 1
+                is_ready = pending[0] == 0
+
+            if not is_ready:
+                return
+
+            if any([x.exception() is not None for x in depends]):
+                output.set_running_or_notify_cancel()
+                output.set_exception(Exception("Dependency of %s failed" % name))
+                return
+
+            try:
+                self.start(name, func, args, io, output)
+
+            except Exception as e:
+                self.add_failure(name, e)
+                output.set_exception(e)
+
+        if len(depends) == 0:
+            self.start(name, func, args, io, output)
+        else:
+            for future in depends:
+                future.add_done_callback(dependency_finished)
+
+        return output
+
+    def wait(self):
+        # Jobs can submit more jobs while running, so keep waiting until nothing new shows up
+        while True:
+            with self.lock:
+                futures = self.futures[:]
+
+            concurrent.futures.wait(futures)
+
+            with self.lock:
+                if len(self.futures) == len(futures):
+                    self.futures = []
+                    failures = self.failures
+                    self.failures = []
+                    return failures
+
+    def shutdown(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+        if self.io_pool is not None:
+            self.io_pool.shutdown()
+
+
+runner = None
+runner_lock = threading.Lock()
+
+
+def init_runner(jobs=None, inline=False):
+    global runner
+
+    with runner_lock:
+        if runner is not None:
+            runner.shutdown()
+
+        runner = JobRunner(jobs, inline)
+
+        return runner
+
+
+def get_runner():
+    global runner
+
+    with runner_lock:
+        if runner is None:
+            runner = JobRunner()
+
+        return runner
@@ -1,18 +1,21 @@
 import argparse
+import concurrent.futures
 import multiprocessing
 import glob
+import hashlib
 import json
 import os
 import shutil
 import string
 import subprocess
 import struct
+import tempfile
+import threading
 import uuid
 import pkgutil
 
 from PIL import Image
 
-from lxml import objectify
 from lxml import etree
 from lxml.builder import E
 
@@ -56,6 +59,43 @@ def backup_file(filename, backup_path="backups"):
     shutil.copy(filename, backup_full_path)
 
 
+def iterparse_elements(filename, paths):
+    # Yields the elements found at any of the given paths (relative to the root, ex. "scene_data/scene_m_data")
+    # one at a time while the file is being parsed.
+    # Elements are freed after they've been read so memory use stays flat regardless of the file's size.
+    paths = set([tuple(path.split('/')) for path in paths])
+    tags = set([path[-1] for path in paths])
+
+    for _, elem in etree.iterparse(filename, events=("end",), tag=tags, remove_blank_text=True, remove_comments=True, remove_pis=True):
+        path = [elem.tag]
+
+        parent = elem.getparent()
+        while parent is not None and parent.getparent() is not None:
+            path.insert(0, parent.tag)
+            parent = parent.getparent()
+
+        if tuple(path) not in paths:
+            continue
+
+        yield elem
+
+        elem.clear(keep_tail=True)
+
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def get_child_elements(elem):
+    # Maps the tag of each child to the first child element with that tag
+    children = {}
+
+    for child in elem:
+        if child.tag not in children:
+            children[child.tag] = child
+
+    return children
+
+
 def read_mdb(filename):
     mdb = {
         'records': {},
@@ -65,43 +105,44 @@ def read_mdb(filename):
     if not os.path.exists(filename):
         return mdb
 
-    mdb_xml = objectify.fromstring(open(filename, "rb").read())
+    for record in iterparse_elements(filename, ["mdb_data", "mdb_course"]):
+        record_data = {}
 
-    def read_entries(input, output):
-        for record in input:
-            if hasattr(record, 'course_id'):
-                music_id = int(record.course_id.text)
-            else:
-                music_id = int(record.music_id.text)
+        for field in record:
+            k = field.tag
 
-            record_data = {}
-            for k in record.__dict__.keys():
-                record_data[k] = {}
-                record_data[k]['type'] = getattr(record, k).get('__type')
+            # Only the first field with a given name is used
+            if k in record_data:
+                continue
 
-                if k == "b_eemall":
-                    record_data[k]['value'] = 0
-                elif getattr(record, k).text:
-                    record_data[k]['value'] = getattr(record, k).text
-                else:
-                    record_data[k]['value'] = ""
+            record_data[k] = {}
+            record_data[k]['type'] = field.get('__type')
 
-                if getattr(record, k).get('__count'):
-                    expected_count = int(getattr(record, k).get('__count'))
-                    record_data[k]['value'] = record_data[k]['value'].split(' ')
+            if k == "b_eemall":
+                record_data[k]['value'] = 0
+            elif field.text:
+                record_data[k]['value'] = field.text
+            else:
+                record_data[k]['value'] = ""
 
-                    if len(record_data[k]['value']) != expected_count:
-                        print(record_data[k])
-                        print("Unexpected count in entry: {} items found, expected {}".format(len(record_data[k]['value']), expected_count))
-                        exit(1)
+            if field.get('__count'):
+                expected_count = int(field.get('__count'))
+                record_data[k]['value'] = record_data[k]['value'].split(' ')
 
-            output[music_id] = record_data
+                if len(record_data[k]['value']) != expected_count:
+                    print(record_data[k])
+                    print("Unexpected count in entry: {} items found, expected {}".format(len(record_data[k]['value']), expected_count))
+                    exit(1)
 
-    if hasattr(mdb_xml, 'mdb_data'):
-        read_entries(mdb_xml.mdb_data, mdb['records'])
+        if 'course_id' in record_data:
+            music_id = int(record_data['course_id']['value'])
+        else:
+            music_id = int(record_data['music_id']['value'])
 
-    if hasattr(mdb_xml, 'mdb_course'):
-        read_entries(mdb_xml.mdb_course, mdb['courses'])
+        if record.tag == "mdb_course":
+            mdb['courses'][music_id] = record_data
+        else:
+            mdb['records'][music_id] = record_data
 
     return mdb
 
@@ -303,10 +344,14 @@ def add_song_to_mdb(mdb, package, fresh=False, unsafe=False):
     # Check existing records for same hash
     # If same hash exists, delete old record and reuse the song id
     dupes = []
+    old_music_id = None
     for k in mdb['records']:
         if '__hash' in mdb['records'][k] and (fresh or mdb['records'][k]['__hash']['value'] == new_record['__hash']['value']):
             dupes.append(k)
 
+            if mdb['records'][k]['__hash']['value'] == new_record['__hash']['value']:
+                old_music_id = k
+
     for k in dupes:
         print("Removing old object")
         del mdb['records'][k]
@@ -314,7 +359,13 @@ def add_song_to_mdb(mdb, package, fresh=False, unsafe=False):
     music_id = package.get('music_id', None)
 
     if not music_id or not unsafe:
-        music_id = get_next_id(mdb)
+        if old_music_id is not None:
+            music_id = old_music_id
+        elif package.get('__installed_music_id') is not None and package['__installed_music_id'] not in mdb['records']:
+            # Keep the ID from the last install so the package's files can be reused
+            music_id = package['__installed_music_id']
+        else:
+            music_id = get_next_id(mdb)
 
     package['music_id'] = music_id
 
@@ -328,18 +379,24 @@ def add_song_to_mdb(mdb, package, fresh=False, unsafe=False):
     return mdb, dupes
 
 
+def get_entry_order(mdb, key):
+    # Maps each value of the field to its position in sorted order, starting from 1 for an empty value
+    values = [""] + sorted([x for x in set([mdb['records'][k][key]['value'] for k in mdb['records'] if key in mdb['records'][k]]) if x])
+    return {x: idx + 1 for idx, x in enumerate(values)}
+
+
 def update_entry_orders(mdb):
-    title_ascii_list = [""] + sorted([x for x in set([mdb['records'][k]['title_ascii']['value'] for k in mdb['records'] if 'title_ascii' in mdb['records'][k]]) if x])
-    artist_title_ascii_list = [""] + sorted([x for x in set([mdb['records'][k]['artist_title_ascii']['value'] for k in mdb['records'] if 'artist_title_ascii' in mdb['records'][k]]) if x])
+    title_ascii_order = get_entry_order(mdb, 'title_ascii')
+    artist_title_ascii_order = get_entry_order(mdb, 'artist_title_ascii')
 
     for k in mdb['records']:
-        order_ascii = title_ascii_list.index(mdb['records'][k]['title_ascii']['value']) + 1 if 'title_ascii' in mdb['records'][k] else 1
+        order_ascii = title_ascii_order[mdb['records'][k]['title_ascii']['value']] if 'title_ascii' in mdb['records'][k] else 1
         mdb['records'][k]['order_ascii'] = {
             'type': "u16",
             'value': order_ascii
         }
 
-        artist_order_ascii = artist_title_ascii_list.index(mdb['records'][k]['artist_title_ascii']['value']) + 1 if 'artist_title_ascii' in mdb['records'][k] else 1
+        artist_order_ascii = artist_title_ascii_order[mdb['records'][k]['artist_title_ascii']['value']] if 'artist_title_ascii' in mdb['records'][k] else 1
         mdb['records'][k]['artist_order_ascii'] = {
             'type': "u16",
             'value': artist_order_ascii
@@ -427,46 +484,188 @@ def get_package_info(packages_directory="packages"):
     return packages
 
 
-def prepare_graphics_for_package(package):
-    # Automatically generate all images possible that weren't provided by the user
+def get_file_hash(filename):
+    if not os.path.exists(filename):
+        return None
+
+    file_hash = hashlib.sha1()
+
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(0x100000), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def get_package_hash(package):
+    # Hash of the package info and the contents of every file it references
+    package_hash = hashlib.sha1()
+
+    package_info = {k: package[k] for k in package if not k.startswith("__")}
+    package_hash.update(json.dumps(package_info, sort_keys=True).encode('utf-8'))
+
+    def add_files(entry):
+        if isinstance(entry, dict):
+            for k in sorted(entry.keys()):
+                add_files(entry[k])
+
+        elif isinstance(entry, str):
+            file_hash = get_file_hash(os.path.join(package['__directory'], entry))
+            package_hash.update((entry + (file_hash or "")).encode('utf-8'))
+
+    add_files(package.get('files', {}))
+    add_files(package.get('graphics', {}))
+
+    return package_hash.hexdigest()
+
+
+MANIFEST_VERSION = 1
+
+
+def read_manifest(filename):
+    # The manifest keeps track of what has been installed already so only new or
+    # modified packages have to be installed again.
+    #   packages: unique_id -> music_id, hash of the package's inputs and hashes of the files generated for it
+    #   files: hash of every shared game file (MDBs, texbins, jacket IFS, etc) after it was last written
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'packages': {},
+        'files': {},
+    }
+
+    if os.path.exists(filename):
+        data = json.load(open(filename, "r", encoding="utf-8"))
+
+        if data.get('version') == MANIFEST_VERSION:
+            manifest = data
+
+    return manifest
+
+
+def save_manifest(filename, manifest):
+    json.dump(manifest, open(filename, "w", encoding="utf-8"), indent=4)
+
+
+def is_package_installed(manifest, package):
+    if package['unique_id'] not in manifest['packages']:
+        return False
+
+    installed = manifest['packages'][package['unique_id']]
+
+    if installed['hash'] != package['__hash']:
+        return False
+
+    for filename in installed['outputs']:
+        if get_file_hash(filename) != installed['outputs'][filename]:
+            return False
+
+    return True
+
+
+def is_file_modified(manifest, filename):
+    # True if the file was changed by something else since it was last written (a game update, etc)
+    return manifest['files'].get(filename) != get_file_hash(filename)
+
+
+def update_manifest_file(manifest, filename):
+    manifest['files'][filename] = get_file_hash(filename)
+
+
+def get_text_images(title, artist):
+    # Returns the folder with the images made by gitadora-textgen for the title and artist.
+    # The images are cached so gitadora-textgen only has to run once for each song.
+    cache_folder = os.path.join(tmpfile.get_cache_dir("textgen"), hashlib.sha1((title + "\0" + artist).encode('utf-8')).hexdigest())
+
+    def has_text_images(foldername):
+        return all([os.path.exists(os.path.join(foldername, x)) for x in ["artist.png", "title.png", "title_small.png"]])
+
+    if has_text_images(cache_folder):
+        return cache_folder
+
     output_directory = tmpfile.mkdtemp("textgen")
 
     # TODO: mono for Linux?
-    subprocess.call("\"{}\" solid \"{}\" \"{}\" \"{}\"".format(resource_path(os.path.join("tools", "gitadora-textgen.exe")), package['title'], package['artist'], output_directory), shell=True)
+    subprocess.call("\"{}\" solid \"{}\" \"{}\" \"{}\"".format(resource_path(os.path.join("tools", "gitadora-textgen.exe")), title, artist, output_directory), shell=True)
 
-    def copy_file(entry_name, filename):
-        if 'graphics' not in package:
-            package['graphics'] = {}
+    # The worker's temp folders are removed once it finishes, so the images are always moved into the cache.
+    # They're copied inside of the cache first so other workers never see a half written folder.
+    temp_folder = tempfile.mkdtemp(prefix="textgen", dir=os.path.dirname(cache_folder))
+    shutil.copytree(output_directory, temp_folder, dirs_exist_ok=True)
 
-        if entry_name in package['graphics'] and os.path.exists(os.path.join(package['__directory'], package['graphics'][entry_name])):
-            return
+    if not has_text_images(temp_folder):
+        # Don't reuse failures, gitadora-textgen runs again next time
+        print("Couldn't make every text image for %s - %s" % (artist, title))
+        return temp_folder
 
-        temp_filename = os.path.join(output_directory, filename)
+    try:
+        if os.path.exists(cache_folder) and not has_text_images(cache_folder):
+            # Left over from an install where gitadora-textgen didn't make every image
+            shutil.rmtree(cache_folder, ignore_errors=True)
 
-        if os.path.exists(temp_filename):
-            shutil.copy(temp_filename, os.path.join(package['__directory'], filename))
-            package['graphics'][entry_name] = filename
+        os.replace(temp_folder, cache_folder)
 
-            tmpfile.add_temp_file(os.path.join(package['__directory'], filename))
+    except OSError:
+        # Another worker made the same images at the same time
+        if not has_text_images(cache_folder):
+            return temp_folder
 
-    copy_file("artist", "artist.png")
-    copy_file("title", "title.png")
-    copy_file("title_small", "title_small.png")
+        shutil.rmtree(temp_folder, ignore_errors=True)
 
-    if 'graphics' in package and 'jacket' in package['graphics'] and package['graphics']['jacket']:
-        jacket_img = Image.open(os.path.join(package['__directory'], package['graphics']['jacket'])).convert("RGB")
+    return cache_folder
 
-        jacket_384 = jacket_img.resize((384, 384))
-        jacket_384_filename = os.path.join(package['__directory'], "jacket_384.png")
-        jacket_384.save(jacket_384_filename)
-        package['graphics']['jacket'] = "jacket_384.png"
-        tmpfile.add_temp_file(jacket_384_filename)
 
-        jacket_64 = jacket_img.resize((64, 64))
-        jacket_64_filename = os.path.join(package['__directory'], "jacket_64.png")
-        jacket_64.save(jacket_64_filename)
-        package['graphics']['jacket_small'] = "jacket_64.png"
-        tmpfile.add_temp_file(jacket_64_filename)
+def get_resized_images(input_filename, sizes):
+    # Returns the filenames of the image resized to each of the given sizes.
+    # Resized images are cached by the hash of the input image, and any that are missing are made from a single decode.
+    cache_folder = tmpfile.get_cache_dir("images")
+    image_hash = get_file_hash(input_filename)
+
+    output_filenames = [os.path.join(cache_folder, "%s_%dx%d.png" % (image_hash, size[0], size[1])) for size in sizes]
+
+    if all([os.path.exists(x) for x in output_filenames]):
+        return output_filenames
+
+    image = Image.open(input_filename).convert("RGB")
+
+    for size, output_filename in zip(sizes, output_filenames):
+        if os.path.exists(output_filename):
+            continue
+
+        # Workers may be resizing the same image, so replace the cached image in one step
+        temp_filename = "%s.%d.tmp" % (output_filename, os.getpid())
+        image.resize(size).save(temp_filename, format="PNG")
+        os.replace(temp_filename, output_filename)
+
+    return output_filenames
+
+
+def prepare_graphics_for_package(package):
+    # Automatically generate all images possible that weren't provided by the user.
+    # Generated images are kept in the cache folder, so the graphics are set to their absolute paths.
+    if 'graphics' not in package:
+        package['graphics'] = {}
+
+    text_images = {
+        "artist": "artist.png",
+        "title": "title.png",
+        "title_small": "title_small.png",
+    }
+
+    missing_text_images = [x for x in text_images if x not in package['graphics'] or not os.path.exists(os.path.join(package['__directory'], package['graphics'][x]))]
+
+    if missing_text_images:
+        text_images_folder = get_text_images(package['title'], package['artist'])
+
+        for entry_name in missing_text_images:
+            filename = os.path.join(text_images_folder, text_images[entry_name])
+
+            if os.path.exists(filename):
+                package['graphics'][entry_name] = os.path.abspath(filename)
+
+    if 'jacket' in package['graphics'] and package['graphics']['jacket']:
+        jacket_384_filename, jacket_64_filename = get_resized_images(os.path.join(package['__directory'], package['graphics']['jacket']), [(384, 384), (64, 64)])
+        package['graphics']['jacket'] = os.path.abspath(jacket_384_filename)
+        package['graphics']['jacket_small'] = os.path.abspath(jacket_64_filename)
 
 
 def patch_sq3(filename, music_id):
@@ -528,6 +727,8 @@ def create_song_data_ifs_for_package(package, ifs_data_folder="data\\ifs_pack"):
             shutil.copy(os.path.join(package['__directory'], package['files']['drum']['preview']), os.path.join(bgm_folder, "i%04dgf.bin" % package['music_id']))
     ifs.create(bgm_folder, bgm_ifs_outputfile)
 
+    return [seq_ifs_outputfile, bgm_ifs_outputfile]
+
 
 def create_graphic_ifs_for_packages(packages, key, base_filename, output_filename):
     output_directory = os.path.dirname(output_filename)
@@ -538,13 +739,16 @@ def create_graphic_ifs_for_packages(packages, key, base_filename, output_filenam
         # Folder already exists
         pass
 
-    _, ifs_path = ifs.extract(output_filename)
+    archive = ifs.IfsSession(output_filename)
 
+    conversions = []
     for package in packages:
         if 'graphics' in package and key in package['graphics'] and package['graphics'][key]:
-            convert_image_to_tex(os.path.join(package['__directory'], package['graphics'][key]), os.path.join(ifs_path, "%s%04d%s" % (base_filename, package['music_id'], os.path.splitext(package['graphics'][key])[1])))
+            conversions.append((os.path.join(package['__directory'], package['graphics'][key]), archive.get_member_path("%s%04d%s" % (base_filename, package['music_id'], os.path.splitext(package['graphics'][key])[1]))))
+
+    convert_images_to_tex(conversions)
 
-    ifs.create(ifs_path, output_filename)
+    archive.close()
 
 
 def read_notes_info(filename):
@@ -553,13 +757,9 @@ def read_notes_info(filename):
     if not os.path.exists(filename):
         return seq_infos
 
-    seq_xml = objectify.fromstring(open(filename, "rb").read())
-
-    if not hasattr(seq_xml, 'seq_info'):
-        return seq_infos
-
-    for info in seq_xml.seq_info:
-        music_id = int(info.music_id.text)
+    for info in iterparse_elements(filename, ["seq_info"]):
+        fields = get_child_elements(info)
+        music_id = int(fields['music_id'].text)
         note_data = {
             'music_id': music_id,
             'data': {}
@@ -568,14 +768,16 @@ def read_notes_info(filename):
         def read_data(data, part):
             output = {}
 
+            levels = get_child_elements(data)
+
             for diff in range(0, 5):
-                if hasattr(data, 'diff_level%d' % diff):
-                    attr = getattr(data, 'diff_level%d' % diff)
-                    notes = int(attr.notes_nr.text)
+                if 'diff_level%d' % diff in levels:
+                    attr = get_child_elements(levels['diff_level%d' % diff])
+                    notes = int(attr['notes_nr'].text)
 
-                    if hasattr(attr, 'fret'):
+                    if 'fret' in attr:
                         # Drum
-                        note_data = [int(x) for x in attr.fret.text.split(' ')]
+                        note_data = [int(x) for x in attr['fret'].text.split(' ')]
                         note_data = {
                             "r": note_data[0],
                             "g": note_data[1],
@@ -584,9 +786,9 @@ def read_notes_info(filename):
                             "p": note_data[4],
                             "open": note_data[5],
                         }
-                    elif hasattr(attr, 'pad'):
+                    elif 'pad' in attr:
                         # Drum
-                        note_data = [int(x) for x in attr.pad.text.split(' ')]
+                        note_data = [int(x) for x in attr['pad'].text.split(' ')]
                         note_data = {
                             "leftcymbal": note_data[0],
                             "hihat": note_data[1],
@@ -634,18 +836,20 @@ def read_notes_info(filename):
 
             return output
 
-        if hasattr(info, 'gf'):
-            if hasattr(info.gf, 'seq_type0'):
+        if 'gf' in fields:
+            gf = get_child_elements(fields['gf'])
+
+            if 'seq_type0' in gf:
                 # Guitar
-                note_data['data']['guitar'] = read_data(info.gf.seq_type0, 'guitar')
+                note_data['data']['guitar'] = read_data(gf['seq_type0'], 'guitar')
 
-            if hasattr(info.gf, 'seq_type1'):
+            if 'seq_type1' in gf:
                 # Bass
-                note_data['data']['bass'] = read_data(info.gf.seq_type1, 'bass')
+                note_data['data']['bass'] = read_data(gf['seq_type1'], 'bass')
 
-        if hasattr(info, 'dm'):
+        if 'dm' in fields:
             # Drum
-            note_data['data']['drum'] = read_data(info.dm, 'drum')
+            note_data['data']['drum'] = read_data(fields['dm'], 'drum')
 
         seq_infos[music_id] = note_data
 
@@ -862,20 +1066,16 @@ def read_phrase_address_list(filename):
     if not os.path.exists(filename):
         return pal
 
-    pal_xml = objectify.fromstring(open(filename, "rb").read())
-
-    if not hasattr(pal_xml, 'scene_data') or not hasattr(pal_xml.scene_data, 'scene_m_data'):
-        return pal
-
-    for scene_data in pal_xml.scene_data.scene_m_data:
-        music_id = int(scene_data.music_id.text)
-        version = int(scene_data.version.text)
+    for scene_data in iterparse_elements(filename, ["scene_data/scene_m_data"]):
+        fields = get_child_elements(scene_data)
+        music_id = int(fields['music_id'].text)
+        version = int(fields['version'].text)
         data = []
 
-        num = int(scene_data.num.text)
+        num = int(fields['num'].text)
         for i in range(1, num + 1):
-            address = int(getattr(scene_data, 'address%d' % i).text)
-            address_type = int(getattr(scene_data, 'type%d' % i).text)
+            address = int(fields['address%d' % i].text)
+            address_type = int(fields['type%d' % i].text)
 
             data.append({
                 'address': address,
@@ -938,30 +1138,101 @@ def add_packages_to_phrase_address_list(filename, packages, dupes):
     save_phrase_address_list(filename, pal)
 
 
-def install_packages(game_directory="", packages_directory="packages", game_data_folder="data", fresh=False, unsafe=False):
+def install_package_files(package):
+    # Generates everything that only belongs to a single package.
+    # This runs in a worker process, so the updated graphics info is returned instead of being set on the package.
+    temp_state = tmpfile.get_temp_state()
+
+    try:
+        prepare_graphics_for_package(package)
+
+        outputs = []
+        if package['__changed']:
+            outputs += create_song_data_ifs_for_package(package)
+
+            # Copy movie file
+            if 'files' in package and 'movie' in package['files']:
+                movie_filename = os.path.join("data", "product", "movie", "music", "mv%04d.wmv" % package['music_id'])
+                shutil.copy(os.path.join(package['__directory'], package['files']['movie']), movie_filename)
+                outputs.append(movie_filename)
+
+        return package.get('graphics', None), outputs
+
+    finally:
+        tmpfile.tmpcleanup(temp_state)
+
+
+def install_packages(game_directory="", packages_directory="packages", game_data_folder="data", fresh=False, unsafe=False, force=False, jobs=None):
+    set_textool_jobs(jobs)
+
     packages = get_package_info(packages_directory)
 
     game_data_folder = os.path.join(game_directory, game_data_folder)
 
+    manifest_filename = os.path.join(game_data_folder, "customs_manifest.json")
+    manifest = read_manifest(manifest_filename)
+
+    if fresh or force:
+        manifest['packages'] = {}
+
+    if fresh:
+        manifest['files'] = {}
+
+    # With force the file hashes are kept: every package is installed again anyway, and the archives
+    # patched by patch_game_for_customs in the same run don't have to be rebuilt on the next run
+
+    # Only packages that are new or were modified since the last install have to be installed again
+    changed_packages = []
+    for package in packages:
+        package['__hash'] = get_package_hash(package)
+        package['__changed'] = not is_package_installed(manifest, package)
+
+        if package['__changed']:
+            changed_packages.append(package)
+        else:
+            package['music_id'] = manifest['packages'][package['unique_id']]['music_id']
+            package['__installed_music_id'] = package['music_id']
+
+    print("Installing %d new or modified package(s), %d package(s) are already installed" % (len(changed_packages), len(packages) - len(changed_packages)))
+
+    def get_packages_for_file(filename):
+        # Every package has to be added again if the file was replaced since the last install
+        return packages if is_file_modified(manifest, filename) else changed_packages
+
     dupes = []
-    dupes += add_packages_to_mdb(os.path.join(game_data_folder, "product", "xml", "mdb_xg.xml"), packages, fresh, unsafe)
-    dupes += add_packages_to_mdb(os.path.join(game_data_folder, "product", "xml", "mdb_mt.xml"), packages, fresh, unsafe)
+    for mdb_filename in ["mdb_xg.xml", "mdb_mt.xml"]:
+        mdb_filename = os.path.join(game_data_folder, "product", "xml", mdb_filename)
+        mdb_packages = get_packages_for_file(mdb_filename)
 
-    add_packages_to_notes_info(os.path.join(game_data_folder, "product", "xml", "notes_info.xml"), packages, dupes)
-    add_packages_to_phrase_address_list(os.path.join(game_data_folder, "product", "xml", "phrase_address_list.xml"), packages, dupes)
+        if mdb_packages:
+            dupes += add_packages_to_mdb(mdb_filename, mdb_packages, fresh, unsafe)
+            update_manifest_file(manifest, mdb_filename)
+
+    # If the MDB was replaced, an installed package can only keep its old music ID if no other song took it.
+    # Otherwise its files have to be created again for the new ID.
+    for package in packages:
+        if not package['__changed'] and package['music_id'] != package['__installed_music_id']:
+            print("Music ID of %s changed from %d to %d" % (package['unique_id'], package['__installed_music_id'], package['music_id']))
+            package['__changed'] = True
+            changed_packages.append(package)
+
+    notes_info_filename = os.path.join(game_data_folder, "product", "xml", "notes_info.xml")
+    notes_info_packages = get_packages_for_file(notes_info_filename)
+    if notes_info_packages:
+        add_packages_to_notes_info(notes_info_filename, notes_info_packages, dupes)
+        update_manifest_file(manifest, notes_info_filename)
+
+    pal_filename = os.path.join(game_data_folder, "product", "xml", "phrase_address_list.xml")
+    pal_packages = get_packages_for_file(pal_filename)
+    if pal_packages:
+        add_packages_to_phrase_address_list(pal_filename, pal_packages, dupes)
+        update_manifest_file(manifest, pal_filename)
 
     real_last_id = get_last_archive_id(os.path.join(game_directory, "libshare-pj.dll"))
 
+    # Split packages by music id so it's possible to insert images into the proper archives later
     packages_split = {}
     for package in packages:
-        prepare_graphics_for_package(package)
-        create_song_data_ifs_for_package(package)
-
-        # Copy movie file
-        if 'files' in package and 'movie' in package['files']:
-            shutil.copy(os.path.join(package['__directory'], package['files']['movie']), os.path.join("data", "product", "movie", "music", "mv%04d.wmv" % package['music_id']))
-
-        # Split packages by music id so it's possible to insert images into the proper archives later
         package_key = int(("%04d" % package['music_id'])[:2])
 
         if package_key > real_last_id:
@@ -972,12 +1243,56 @@ def install_packages(game_directory="", packages_directory="packages", game_data
 
         packages_split[package_key].append(package)
 
+    archives = []
     for last_id in packages_split:
-        create_graphic_texbin_for_packages(packages_split[last_id], "jacket_small", "img_jkb", os.path.join(game_data_folder, "product", "d3", "model", "tex_img_jkb%02d.bin" % last_id))
-        create_graphic_texbin_for_packages(packages_split[last_id], "title_small", "img_idb", os.path.join(game_data_folder, "product", "d3", "model", "tex_img_idb%02d.bin" % last_id))
-        create_graphic_ifs_for_packages(packages_split[last_id], "jacket", "img_jk", os.path.join(game_data_folder, "product", "jacket", "img_jk%02d.ifs" % last_id))
-        create_graphic_ifs_for_packages(packages_split[last_id], "title", "img_id", os.path.join(game_data_folder, "product", "jacket", "img_idw%02d.ifs" % last_id))
-        create_graphic_ifs_for_packages(packages_split[last_id], "artist", "img_at", os.path.join(game_data_folder, "product", "jacket", "img_atw%02d.ifs" % last_id))
+        for create_archive, key, base_filename, output_filename in [
+            (create_graphic_texbin_for_packages, "jacket_small", "img_jkb", os.path.join(game_data_folder, "product", "d3", "model", "tex_img_jkb%02d.bin" % last_id)),
+            (create_graphic_texbin_for_packages, "title_small", "img_idb", os.path.join(game_data_folder, "product", "d3", "model", "tex_img_idb%02d.bin" % last_id)),
+            (create_graphic_ifs_for_packages, "jacket", "img_jk", os.path.join(game_data_folder, "product", "jacket", "img_jk%02d.ifs" % last_id)),
+            (create_graphic_ifs_for_packages, "title", "img_id", os.path.join(game_data_folder, "product", "jacket", "img_idw%02d.ifs" % last_id)),
+            (create_graphic_ifs_for_packages, "artist", "img_at", os.path.join(game_data_folder, "product", "jacket", "img_atw%02d.ifs" % last_id)),
+        ]:
+            # Archives only need to be rebuilt if they contain a package that changed
+            if is_file_modified(manifest, output_filename):
+                archive_packages = packages_split[last_id]
+            else:
+                archive_packages = [x for x in packages_split[last_id] if x['__changed']]
+
+            if not archive_packages:
+                continue
+
+            for package in archive_packages:
+                package['__needs_graphics'] = True
+
+            archives.append((create_archive, key, base_filename, output_filename, archive_packages))
+
+    # The files for each package don't depend on any other package so they can all be generated at the same time
+    install_queue = [x for x in packages if x['__changed'] or x.get('__needs_graphics')]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(install_package_files, install_queue))
+
+    for package, (graphics, outputs) in zip(install_queue, results):
+        if graphics is not None:
+            package['graphics'] = graphics
+
+        if package['__changed']:
+            manifest['packages'][package['unique_id']] = {
+                'music_id': package['music_id'],
+                'hash': package['__hash'],
+                'outputs': {filename: get_file_hash(filename) for filename in outputs},
+            }
+
+    # Archives are shared between packages so they're only updated once all of the packages are ready.
+    # Every archive is a separate file so they can all be updated at the same time.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        archive_jobs = [pool.submit(create_archive, archive_packages, key, base_filename, output_filename) for create_archive, key, base_filename, output_filename, archive_packages in archives]
+
+    for archive_job, archive in zip(archive_jobs, archives):
+        archive_job.result()
+        update_manifest_file(manifest, archive[3])
+
+    save_manifest(manifest_filename, manifest)
 
     tmpfile.tmpcleanup()
 
@@ -1007,6 +1322,7 @@ def patch_dll_for_customs(dll_filename="libshare-pj.dll"):
         return
 
     dll_data = bytearray(open(dll_filename, "rb").read())
+    original_dll_data = bytes(dll_data)
 
     # Patch the max song ID for the last archive
     patch_pattern = bytearray([0x80, 0x01, 0x00, 0x00, 0x00]) + struct.pack("<I", last_id * 100)
@@ -1016,19 +1332,83 @@ def patch_dll_for_customs(dll_filename="libshare-pj.dll"):
         dll_data[idx+len(patch_pattern):idx+len(patch_pattern)+4] = struct.pack("<I", 0xfff)
         idx = dll_data.find(patch_pattern, idx + 1)
 
+    if dll_data == original_dll_data:
+        # Already patched
+        return
+
     backup_file(dll_filename)
     open(dll_filename, "wb").write(dll_data)
 
 
 def convert_image_to_tex(input_filename, output_filename):
-    # Copy file to folder
-    image_filename = shutil.copy(input_filename, output_filename)
+    convert_images_to_tex([(input_filename, output_filename)])
+
+
+# Every archive that's being built at the same time runs gitadora-textool, so they share these slots
+# to keep the number of processes within the job count (see set_textool_jobs)
+textool_jobs = os.cpu_count() or 1
+textool_slots = threading.BoundedSemaphore(textool_jobs)
+
+
+def set_textool_jobs(jobs=None):
+    global textool_jobs, textool_slots
+    textool_jobs = jobs if jobs else (os.cpu_count() or 1)
+    textool_slots = threading.BoundedSemaphore(textool_jobs)
+
+
+def convert_images_to_tex(conversions):
+    # Converts (input_filename, output_filename) pairs to textures, saved as output_filename with a .tex extension.
+    # gitadora-textool only takes a single image per run, so converted textures are cached by the hash of the
+    # image to avoid running it again for the same image, and the images that aren't cached are converted at the same time.
+    cache_folder = tmpfile.get_cache_dir("tex")
+
+    images = {}
+    for input_filename, output_filename in conversions:
+        image_hash = get_file_hash(input_filename)
+
+        if image_hash not in images:
+            images[image_hash] = (input_filename, [])
+
+        images[image_hash][1].append(os.path.splitext(output_filename)[0] + ".tex")
+
+    def convert(image_hash, input_filename):
+        cached_filename = os.path.join(cache_folder, "%s.tex" % image_hash)
+
+        if os.path.exists(cached_filename):
+            return cached_filename
+
+        # Copy file to folder
+        staging_folder = tmpfile.mkdtemp("tex")
+        image_filename = shutil.copy(input_filename, os.path.join(staging_folder, image_hash + os.path.splitext(input_filename)[1]))
+
+        # Call gitadora-textool
+        with textool_slots:
+            subprocess.call("\"{}\" \"{}\"".format(resource_path(os.path.join("tools", "gitadora-textool.exe")), image_filename), shell=True)
 
-    # Call gitadora-textool
-    subprocess.call("\"{}\" \"{}\"".format(resource_path(os.path.join("tools", "gitadora-textool.exe")), image_filename), shell=True)
+        tex_filename = os.path.join(staging_folder, "%s.tex" % image_hash)
+        if not os.path.exists(tex_filename):
+            print("Couldn't convert %s to a texture" % input_filename)
+            return None
 
-    # Delete file from tolder
-    os.unlink(image_filename)
+        # The cache can be on another drive and other threads may be copying the same texture,
+        # so copy it inside of the cache folder first and then replace it in one step
+        temp_filename = "%s.%d.%d.tmp" % (cached_filename, os.getpid(), threading.get_ident())
+        shutil.copy(tex_filename, temp_filename)
+        os.replace(temp_filename, cached_filename)
+
+        return cached_filename
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=textool_jobs) as pool:
+        cached_filenames = {image_hash: pool.submit(convert, image_hash, images[image_hash][0]) for image_hash in images}
+
+    for image_hash in images:
+        cached_filename = cached_filenames[image_hash].result()
+
+        if cached_filename is None:
+            continue
+
+        for tex_filename in images[image_hash][1]:
+            shutil.copy(cached_filename, tex_filename)
 
 
 def create_graphic_texbin_for_packages(packages, key, base_filename, output_filename):
@@ -1044,6 +1424,7 @@ def create_graphic_texbin_for_packages(packages, key, base_filename, output_file
     tmpfile.add_temp_folder(texbin_directory)
 
     subprocess.call("\"{}\" \"{}\"".format(resource_path(os.path.join("tools", "gitadora-texbintool.exe")), output_filename), shell=True)
+    original_hashes = ifs.get_folder_hashes(texbin_directory)
 
     # Copy all images to texbin folder with appropriate filenames
     for package in packages:
@@ -1053,38 +1434,65 @@ def create_graphic_texbin_for_packages(packages, key, base_filename, output_file
             output_image_filename = os.path.join(texbin_directory, "%s%04d%s" % (base_filename, package['music_id'], ext))
             shutil.copy(image_filename, output_image_filename)
 
+    if ifs.get_folder_hashes(texbin_directory) == original_hashes:
+        # Nothing changed, no need to create it again
+        return
+
     # Create texbin
     subprocess.call("\"{}\" \"{}\"".format(resource_path(os.path.join("tools", "gitadora-texbintool.exe")), texbin_directory), shell=True)
 
 
-def patch_graphics_for_customs(game_directory="", jacket_folder="data\\product\\jacket\\", customs_banner_image="customs_banner.png", customs_jacket_image="customs_jacket.png"):
+def patch_graphics_for_customs(game_directory="", jacket_folder="data\\product\\jacket\\", customs_banner_image="customs_banner.png", customs_jacket_image="customs_jacket.png", manifest=None):
+    # Archives that haven't changed since they were last patched (according to the manifest) are skipped
     jacket_folder = os.path.join(game_directory, jacket_folder)
     ifs_input_path = os.path.join(jacket_folder, "img_id90.ifs")
-    if os.path.exists(ifs_input_path):
-        backup_file(ifs_input_path)
-        _, ifs_path = ifs.extract(ifs_input_path)
-        convert_image_to_tex(customs_banner_image, os.path.join(ifs_path, "img_id9112.png"))
-        convert_image_to_tex(customs_banner_image, os.path.join(ifs_path, "img_id9162.png"))
-        ifs.create(ifs_path, ifs_input_path)
-    else:
+    if not os.path.exists(ifs_input_path):
         print("Couldn't find img_id90.ifs, can't patch customs banner image")
+    elif manifest is None or is_file_modified(manifest, ifs_input_path):
+        backup_file(ifs_input_path)
+        archive = ifs.IfsSession(ifs_input_path)
+        convert_images_to_tex([
+            (customs_banner_image, archive.get_member_path("img_id9112.png")),
+            (customs_banner_image, archive.get_member_path("img_id9162.png")),
+        ])
+        archive.close()
+
+        if manifest is not None:
+            update_manifest_file(manifest, ifs_input_path)
 
     ifs_input_path = os.path.join(jacket_folder, "img_jk90.ifs")
-    if os.path.exists(ifs_input_path):
-        backup_file(ifs_input_path)
-        _, ifs_path = ifs.extract(ifs_input_path)
-        convert_image_to_tex(customs_jacket_image, os.path.join(ifs_path, "img_jk9112.png"))
-        convert_image_to_tex(customs_jacket_image, os.path.join(ifs_path, "img_jk9162.png"))
-        ifs.create(ifs_path, ifs_input_path)
-    else:
+    if not os.path.exists(ifs_input_path):
         print("Couldn't find img_jk90.ifs, can't patch customs jacket image")
+    elif manifest is None or is_file_modified(manifest, ifs_input_path):
+        backup_file(ifs_input_path)
+        archive = ifs.IfsSession(ifs_input_path)
+        convert_images_to_tex([
+            (customs_jacket_image, archive.get_member_path("img_jk9112.png")),
+            (customs_jacket_image, archive.get_member_path("img_jk9162.png")),
+        ])
+        archive.close()
+
+        if manifest is not None:
+            update_manifest_file(manifest, ifs_input_path)
 
 
-def patch_game_for_customs(game_directory="", dll_filename="libshare-pj.dll", customs_banner_image="customs_banner.png", customs_jacket_image="customs_jacket.png"):
+def patch_game_for_customs(game_directory="", dll_filename="libshare-pj.dll", customs_banner_image="customs_banner.png", customs_jacket_image="customs_jacket.png", game_data_folder="data", force=False, jobs=None):
+    set_textool_jobs(jobs)
+
     dll_filename = os.path.join(game_directory, dll_filename)
 
     patch_dll_for_customs(dll_filename)
-    patch_graphics_for_customs(game_directory, customs_banner_image=resource_path(os.path.join("tools", "customs_banner.png")), customs_jacket_image=resource_path(os.path.join("tools", "customs_jacket.png")))
+
+    manifest_filename = os.path.join(game_directory, game_data_folder, "customs_manifest.json")
+    manifest = read_manifest(manifest_filename)
+
+    if force:
+        manifest['files'] = {}
+
+    patch_graphics_for_customs(game_directory, customs_banner_image=resource_path(os.path.join("tools", "customs_banner.png")), customs_jacket_image=resource_path(os.path.join("tools", "customs_jacket.png")), manifest=manifest)
+
+    if os.path.exists(os.path.dirname(manifest_filename)):
+        save_manifest(manifest_filename, manifest)
 
 
 if __name__ == "__main__":
@@ -1094,7 +1502,13 @@ if __name__ == "__main__":
     parser.add_argument('-g', '--game-dir', help='Input game directory', default="")
     parser.add_argument('-p', '--packages-dir', help='Input packages directory', default="packages")
     parser.add_argument('-u', '--unsafe', help='Enable unsafe mode', default=False, action='store_true')
+    parser.add_argument('-f', '--force', help='Reinstall all packages, even ones that haven\'t changed since the last install', default=False, action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of packages to prepare at the same time (default: number of CPUs)', default=None, type=int)
+    parser.add_argument('--ifs-cache', help='Keep extracted IFS archives in a cache of up to SIZE megabytes between runs', metavar='SIZE', default=None, type=int)
     args = parser.parse_args()
 
-    patch_game_for_customs(args.game_dir)
-    install_packages(args.game_dir, args.packages_dir, unsafe=args.unsafe)
+    if args.ifs_cache:
+        ifs.enable_cache(args.ifs_cache * 1024 * 1024)
+
+    patch_game_for_customs(args.game_dir, force=args.force, jobs=args.jobs)
+    install_packages(args.game_dir, args.packages_dir, unsafe=args.unsafe, force=args.force, jobs=args.jobs)
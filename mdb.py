@@ -1,11 +1,52 @@
+import copy
 import csv
+import hashlib
+import json
 import os
+import threading
 from lxml import objectify
 
-def get_song_info_from_mdb(input_filename, music_id):
-    if not os.path.exists(input_filename):
-        return None
+import tmpfile
+
+# Bump this when the format of the cached index changes
+CACHE_VERSION = 2
+
+
+def get_song_info_from_mdb_data(data, music_id):
+    song_info = {
+        'music_id': music_id
+    }
+
+    if hasattr(data, 'title_name'):
+        song_info['title'] = data.title_name.text or ""
+
+    if hasattr(data, 'artist_title'):
+        song_info['artist'] = data.artist_title.text or ""
+    elif hasattr(data, 'artist_title_ascii'):
+        song_info['artist'] = data.artist_title_ascii.text or ""
+
+    if hasattr(data, 'xg_diff_list'):
+        # The original ordering is guitar, drum, bass, but I want them to be in drum, guitar, bass order
+        difficulties = data.xg_diff_list.text.split(' ')
+        difficulties = difficulties[5:10] + difficulties[0:5] + difficulties[10:]
+        song_info['difficulty'] = [int(x) for x in difficulties]
+
+    if hasattr(data, 'classics_diff_list'):
+        # The original ordering is guitar, bass, open, drum but I want them to be in drum, guitar, bass, open order
+        difficulties = data.classics_diff_list.text.split(' ')
+        difficulties = difficulties[-4:] + difficulties[:-4]
+        song_info['classics_difficulty'] = [int(x) for x in difficulties]
+
+    if hasattr(data, 'bpm'):
+        song_info['bpm'] = int(data.bpm.text)
+
+    if hasattr(data, 'bpm2'):
+        song_info['bpm2'] = int(data.bpm2.text)
+
+    return song_info
 
+
+def read_mdb_songs(input_filename):
     try:
         with open(input_filename, "r", encoding="utf-8") as f:
             root = objectify.fromstring(f.read())
@@ -13,63 +54,159 @@ def get_song_info_from_mdb(input_filename, music_id):
         with open(input_filename, "rb") as f:
             root = objectify.fromstring(f.read())
     except:
-        return None
+        return {}
 
+    songs = {}
     for data in root.mdb_data:
-        if int(data.music_id) == music_id:
-            song_info = {
-                'music_id': music_id
-            }
+        music_id = int(data.music_id)
 
-            if hasattr(data, 'title_name'):
-                song_info['title'] = data.title_name.text or ""
+        # Only the first entry for a music ID is used
+        if music_id not in songs:
+            songs[music_id] = get_song_info_from_mdb_data(data, music_id)
 
-            if hasattr(data, 'artist_title'):
-                song_info['artist'] = data.artist_title.text or ""
-            elif hasattr(data, 'artist_title_ascii'):
-                song_info['artist'] = data.artist_title_ascii.text or ""
+    return songs
 
-            if hasattr(data, 'xg_diff_list'):
-                # The original ordering is guitar, drum, bass, but I want them to be in drum, guitar, bass order
-                difficulties = data.xg_diff_list.text.split(' ')
-                difficulties = difficulties[5:10] + difficulties[0:5] + difficulties[10:]
-                song_info['difficulty'] = [int(x) for x in difficulties]
 
-            if hasattr(data, 'classics_diff_list'):
-                # The original ordering is guitar, bass, open, drum but I want them to be in drum, guitar, bass, open order
-                difficulties = data.classics_diff_list.text.split(' ')
-                difficulties = difficulties[-4:] + difficulties[:-4]
-                song_info['classics_difficulty'] = [int(x) for x in difficulties]
+def read_csv_songs(input_filename):
+    songs = {}
+    song_versions = {}
 
-            if hasattr(data, 'bpm'):
-                song_info['bpm'] = int(data.bpm.text)
+    with open(input_filename, 'r', encoding="utf-8") as f:
+        for data in csv.DictReader(f):
+            music_id = int(data['music_id'])
+            game_version = int(data['game_version'])
 
-            if hasattr(data, 'bpm2'):
-                song_info['bpm2'] = int(data.bpm2.text)
+            # Use the newest entry for a music ID, ignoring versions >= 1000
+            if game_version > song_versions.get(music_id, 0) and game_version < 1000:
+                song_versions[music_id] = game_version
 
-            return song_info
+                songs[music_id] = {
+                    'music_id': music_id
+                }
 
-    return None
+                songs[music_id]['title'] = data['title_name']
+                songs[music_id]['artist'] = data['artist_title']
+                songs[music_id]['difficulty'] = [data[k] for k in ["diff_dm_easy","diff_dm_bsc","diff_dm_adv","diff_dm_ext","diff_dm_mst","diff_gf_easy","diff_gf_bsc","diff_gf_adv","diff_gf_ext","diff_gf_mst","diff_gf_b_easy","diff_gf_b_bsc","diff_gf_b_adv","diff_gf_b_ext","diff_gf_b_mst"]]
 
-def get_song_info_from_csv(input_filename, music_id):
+    return songs
+
+
+class MusicDb:
+    # Index of music ID -> song info for a mdb_xg.xml or gitadora_music.csv file.
+    # The file is only parsed once, and the index is also saved to the cache folder
+    # so later runs can skip parsing as long as the file's mtime and size haven't changed.
+
+    def __init__(self, filename, file_format=None, use_cache=True):
+        self.filename = os.path.abspath(filename)
+        self.file_format = file_format if file_format else ("csv" if filename.lower().endswith(".csv") else "xml")
+        self.use_cache = use_cache
+        self.stat = self.get_stat()
+        self.songs = self.load()
+
+    def get_stat(self):
+        stat = os.stat(self.filename)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def is_stale(self):
+        return not os.path.exists(self.filename) or self.get_stat() != self.stat
+
+    def get_cache_filename(self):
+        key = hashlib.sha1(self.filename.encode('utf-8')).hexdigest()
+        return os.path.join(tmpfile.get_cache_dir("mdb"), "%s_%s.json" % (key, self.file_format))
+
+    def read_cache(self):
+        try:
+            with open(self.get_cache_filename(), "r", encoding="utf-8") as f:
+                cache = json.load(f)
+
+            if cache['version'] == CACHE_VERSION and cache['filename'] == self.filename and tuple(cache['stat']) == self.stat:
+                # JSON only has string keys
+                return {int(k): v for k, v in cache['songs'].items()}
+
+        except:
+            pass
+
+        return None
+
+    def write_cache(self, songs):
+        cache = {
+            'version': CACHE_VERSION,
+            'filename': self.filename,
+            'stat': self.stat,
+            'songs': songs,
+        }
+
+        try:
+            cache_filename = self.get_cache_filename()
+            temp_filename = "%s.%d.tmp" % (cache_filename, os.getpid())
+
+            with open(temp_filename, "w", encoding="utf-8") as f:
+                json.dump(cache, f, ensure_ascii=False)
+
+            # Other processes may be reading the same cache, so replace it in one step
+            os.replace(temp_filename, cache_filename)
+
+        except OSError as e:
+            print("Couldn't write music database cache:", e)
+
+    def load(self):
+        songs = self.read_cache() if self.use_cache else None
+
+        if songs is None:
+            if self.file_format == "csv":
+                songs = read_csv_songs(self.filename)
+            else:
+                songs = read_mdb_songs(self.filename)
+
+            if self.use_cache:
+                self.write_cache(songs)
+
+        return songs
+
+    def get_song_info(self, music_id):
+        if music_id not in self.songs:
+            return None
+
+        # Callers are free to modify the returned song info
+        return copy.deepcopy(self.songs[music_id])
+
+
+music_dbs = {}
+music_dbs_lock = threading.Lock()
+
+
+def get_music_db(input_filename, file_format=None):
+    # Returns a shared MusicDb for the file, or None if it doesn't exist.
+    # The file is parsed again if it changed since it was last loaded.
     if not os.path.exists(input_filename):
         return None
 
-    reader = csv.DictReader(open(input_filename, 'r', encoding="utf-8"))
+    key = (os.path.abspath(input_filename), file_format)
+
+    with music_dbs_lock:
+        if key not in music_dbs or music_dbs[key].is_stale():
+            music_dbs[key] = MusicDb(input_filename, file_format)
+
+        return music_dbs[key]
+
+
+def get_song_info_from_mdb(input_filename, music_id):
+    music_db = get_music_db(input_filename, "xml")
+    return music_db.get_song_info(music_id) if music_db else None
+
+
+def get_song_info_from_csv(input_filename, music_id):
+    music_db = get_music_db(input_filename, "csv")
+    return music_db.get_song_info(music_id) if music_db else None
 
-    song_info_ver = 0
+
+def get_song_info(music_id, music_db=None):
     song_info = None
-    for data in reader:
-        if int(data['music_id']) == music_id:
-            if int(data['game_version']) > song_info_ver and int(data['game_version']) < 1000:
-                song_info_ver = int(data['game_version'])
 
-                song_info = {
-                    'music_id': music_id
-                }
+    if music_db and music_db.endswith(".csv") or not music_db:
+        song_info = get_song_info_from_csv(music_db if music_db else "gitadora_music.csv", music_id)
 
-                song_info['title'] = data['title_name']
-                song_info['artist'] = data['artist_title']
-                song_info['difficulty'] = [data[k] for k in ["diff_dm_easy","diff_dm_bsc","diff_dm_adv","diff_dm_ext","diff_dm_mst","diff_gf_easy","diff_gf_bsc","diff_gf_adv","diff_gf_ext","diff_gf_mst","diff_gf_b_easy","diff_gf_b_bsc","diff_gf_b_adv","diff_gf_b_ext","diff_gf_b_mst"]]
+    if song_info is None or music_db and music_db.endswith(".xml") or not music_db:
+        song_info = get_song_info_from_mdb(music_db if music_db else "mdb_xg.xml", music_id)
 
     return song_info
@@ -1,4 +1,80 @@
-from os.path import dirname, basename, isfile
-import glob
-modules = glob.glob(dirname(__file__)+"/*.py")
-__all__ = [ basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
\ No newline at end of file
+import collections
+import importlib
+import os
+
+# Static plugin registry so formats can be detected without importing the plugins
+# (and all of the audio/archive dependencies they pull in).
+# magic is a list of (offset, bytes) checks that must all match the file header.
+# Plugins without any magic are detected using the file extension instead.
+PluginInfo = collections.namedtuple('PluginInfo', ['name', 'module', 'magic', 'extensions'])
+
+PLUGINS = [
+    PluginInfo("SQ3", "sq3", [(0x00, b"SEQP"), (0x30, b"SQ3T"), (0x36, b"\x03")], [".sq3"]),
+    PluginInfo("SQ2", "sq2", [(0x00, b"SEQP"), (0x30, b"SEQT"), (0x36, b"\x02")], [".sq2"]),
+    PluginInfo("Dsq2", "dsq2", [(0x00, b"DSQ1")], []),
+    PluginInfo("Gsq2", "gsq2", [(0x00, b"GSQ1")], []),
+    PluginInfo("Dsq1", "dsq1", [], []),
+    PluginInfo("Gsq1", "gsq1", [], []),
+    PluginInfo("CIF", "cif", [(0x00, b"GCIF")], [".cif"]),
+    PluginInfo("DTX", "dtx", [], [".dtx"]),
+    PluginInfo("JSON", "json", [], [".json"]),
+    PluginInfo("WAV", "wav", [], []),
+]
+
+HEADER_SIZE = max([offset + len(data) for info in PLUGINS for offset, data in info.magic])
+
+__all__ = [info.module for info in PLUGINS]
+
+
+def get_plugin_info(format_name):
+    for info in PLUGINS:
+        if info.name.lower() == format_name.lower():
+            return info
+
+    return None
+
+
+def read_header(filename):
+    if not filename or not os.path.isfile(filename):
+        return None
+
+    with open(filename, "rb") as f:
+        return f.read(HEADER_SIZE)
+
+
+def match_magic(info, header):
+    if not info.magic or header is None:
+        return False
+
+    for offset, data in info.magic:
+        if header[offset:offset + len(data)] != data:
+            return False
+
+    return True
+
+
+def is_format(format_name, filename):
+    info = detect_format(filename)
+    return info is not None and info.name.lower() == format_name.lower()
+
+
+def detect_format(filename):
+    header = read_header(filename)
+
+    if header is None:
+        return None
+
+    for info in PLUGINS:
+        if match_magic(info, header):
+            return info
+
+    ext = os.path.splitext(filename)[1].lower()
+    for info in PLUGINS:
+        if not info.magic and ext in info.extensions:
+            return info
+
+    return None
+
+
+def load_plugin(info):
+    return importlib.import_module('plugins.' + info.module).get_class()
@@ -0,0 +1,464 @@
+# Compact Intermediate Format
+# Binary alternative to the JSON plugin for storing the intermediate chart data.
+#
+# Layout (little endian):
+#   0x00  magic "GCIF"
+#   0x04  u16 version
+#   0x06  u16 reserved
+#   0x08  u32 string table offset, u32 string count
+#   0x10  u32 document offset, u32 document size
+#   0x18  u32 event table directory offset, u32 event table count
+#
+# All strings (keys, note names, filenames, ...) are stored once in the string table
+# and referenced by index. Event lists (chart['timestamp'], chart['beats']) are stored
+# as event tables with one typed array per field instead of one object per event.
+# Everything else is stored in a small tagged document.
+# All arrays are 8 byte aligned so they can be used directly from a memory map.
+
+import mmap
+import os
+import struct
+
+import numpy
+
+import intermediate
+import plugins
+
+CIF_MAGIC = b"GCIF"
+CIF_VERSION = 1
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STRING = 5
+TAG_LIST = 6
+TAG_DICT = 7
+TAG_EVENTS = 8
+TAG_BIGINT = 9
+
+COLUMN_INT = 1
+COLUMN_FLOAT = 2
+COLUMN_STRING = 3
+COLUMN_VALUE = 4
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+def align(data, size=8):
+    if len(data) % size:
+        data += b"\0" * (size - len(data) % size)
+
+
+def is_event_table(value):
+    if not isinstance(value, dict) or len(value) == 0:
+        return False
+
+    for events in value.values():
+        if not isinstance(events, list):
+            return False
+
+        for event in events:
+            if not isinstance(event, dict):
+                return False
+
+            # Only flat events, anything holding lists is better off as a document
+            for _, v in flatten_event(event):
+                if isinstance(v, (list, tuple)):
+                    return False
+
+    return True
+
+
+def flatten_event(event, path=()):
+    for k, v in event.items():
+        if isinstance(v, dict) and len(v) > 0:
+            yield from flatten_event(v, path + (k,))
+        else:
+            yield path + (k,), v
+
+
+class CifWriter:
+    def __init__(self):
+        self.strings = {}
+        self.tables = []
+
+    def intern(self, value):
+        if value not in self.strings:
+            self.strings[value] = len(self.strings)
+
+        return self.strings[value]
+
+    def write_value(self, output, value):
+        if value is None:
+            output += struct.pack("<B", TAG_NONE)
+
+        elif value is True or value is False:
+            output += struct.pack("<B", TAG_TRUE if value else TAG_FALSE)
+
+        elif isinstance(value, int):
+            if INT64_MIN <= value <= INT64_MAX:
+                output += struct.pack("<Bq", TAG_INT, value)
+            else:
+                output += struct.pack("<BI", TAG_BIGINT, self.intern(str(value)))
+
+        elif isinstance(value, float):
+            output += struct.pack("<Bd", TAG_FLOAT, value)
+
+        elif isinstance(value, str):
+            output += struct.pack("<BI", TAG_STRING, self.intern(value))
+
+        elif isinstance(value, (list, tuple)):
+            output += struct.pack("<BI", TAG_LIST, len(value))
+
+            for v in value:
+                self.write_value(output, v)
+
+        elif is_event_table(value):
+            output += struct.pack("<BI", TAG_EVENTS, len(self.tables))
+            self.tables.append(value)
+
+        elif isinstance(value, dict):
+            output += struct.pack("<BI", TAG_DICT, len(value))
+
+            for k, v in value.items():
+                output += struct.pack("<I", self.intern(intermediate.normalize_key(k)))
+                self.write_value(output, v)
+
+        else:
+            raise TypeError("Can't store %s in CIF file" % type(value))
+
+    def write_table(self, output, table):
+        group_keys = []
+        group_sizes = []
+        columns = {}
+
+        event_count = 0
+        for group_key, events in table.items():
+            group_keys.append(self.intern(intermediate.normalize_key(group_key)))
+            group_sizes.append(len(events))
+
+            for event in events:
+                for path, value in flatten_event(event):
+                    if path not in columns:
+                        columns[path] = {}
+
+                    columns[path][event_count] = value
+
+                event_count += 1
+
+        output += struct.pack("<III", len(group_keys), event_count, len(columns))
+        align(output)
+        output += numpy.array(group_keys, dtype="<u4").tobytes()
+        output += numpy.array(group_sizes, dtype="<u4").tobytes()
+        align(output)
+
+        for path in sorted(columns.keys()):
+            values = columns[path]
+
+            present = numpy.zeros(event_count, dtype="<u1")
+            present[list(values.keys())] = 1
+
+            column_type = COLUMN_VALUE
+            if all(type(v) is int and INT64_MIN <= v <= INT64_MAX for v in values.values()):
+                column_type = COLUMN_INT
+            elif all(type(v) is float for v in values.values()):
+                column_type = COLUMN_FLOAT
+            elif all(type(v) is str for v in values.values()):
+                column_type = COLUMN_STRING
+
+            output += struct.pack("<II", column_type, len(path))
+            output += numpy.array([self.intern(k) for k in path], dtype="<u4").tobytes()
+            align(output)
+            output += present.tobytes()
+            align(output)
+
+            if column_type == COLUMN_INT:
+                column = numpy.zeros(event_count, dtype="<i8")
+                column[list(values.keys())] = list(values.values())
+                output += column.tobytes()
+
+            elif column_type == COLUMN_FLOAT:
+                column = numpy.zeros(event_count, dtype="<f8")
+                column[list(values.keys())] = list(values.values())
+                output += column.tobytes()
+
+            elif column_type == COLUMN_STRING:
+                column = numpy.zeros(event_count, dtype="<u4")
+                column[list(values.keys())] = [self.intern(v) for v in values.values()]
+                output += column.tobytes()
+                align(output)
+
+            else:
+                encoded = bytearray()
+                offsets = numpy.zeros(event_count, dtype="<u4")
+                for idx, value in values.items():
+                    offsets[idx] = len(encoded)
+                    self.write_value(encoded, value)
+
+                output += offsets.tobytes()
+                align(output)
+                output += struct.pack("<I", len(encoded))
+                output += encoded
+                align(output)
+
+    def write(self, data):
+        document = bytearray()
+        self.write_value(document, data)
+
+        # Tables can't contain other tables, so every table is known at this point
+        tables = []
+        for table in self.tables:
+            table_data = bytearray()
+            self.write_table(table_data, table)
+            tables.append(table_data)
+
+        strings = [s.encode('utf-8') for s in self.strings.keys()]
+        string_offsets = [0]
+        for s in strings:
+            string_offsets.append(string_offsets[-1] + len(s))
+
+        output = bytearray(0x20)
+
+        string_table_offset = len(output)
+        output += numpy.array(string_offsets, dtype="<u4").tobytes()
+        output += b"".join(strings)
+        align(output)
+
+        document_offset = len(output)
+        output += document
+        align(output)
+
+        table_offsets = []
+        for table_data in tables:
+            table_offsets.append(len(output))
+            output += table_data
+            align(output)
+
+        table_directory_offset = len(output)
+        output += numpy.array(table_offsets, dtype="<u4").tobytes()
+
+        output[0:0x20] = CIF_MAGIC + struct.pack("<HHIIIIII",
+            CIF_VERSION,
+            0,
+            string_table_offset,
+            len(strings),
+            document_offset,
+            len(document),
+            table_directory_offset,
+            len(tables)
+        )
+
+        return bytes(output)
+
+
+class CifReader:
+    def __init__(self, data):
+        self.data = data
+
+        if len(data) < 0x20 or bytes(data[0:4]) != CIF_MAGIC:
+            raise Exception("Not a valid CIF file")
+
+        version, _, string_table_offset, string_count, document_offset, _, table_directory_offset, table_count = \
+            struct.unpack("<HHIIIIII", data[0x04:0x20])
+
+        if version > CIF_VERSION:
+            raise Exception("Unsupported CIF version %d" % version)
+
+        string_offsets = numpy.frombuffer(data, dtype="<u4", count=string_count + 1, offset=string_table_offset).tolist()
+        string_data_offset = string_table_offset + (string_count + 1) * 4
+        self.strings = [
+            bytes(data[string_data_offset + string_offsets[i]:string_data_offset + string_offsets[i + 1]]).decode('utf-8')
+            for i in range(string_count)
+        ]
+
+        self.table_offsets = numpy.frombuffer(data, dtype="<u4", count=table_count, offset=table_directory_offset).tolist()
+        self.document_offset = document_offset
+
+    def read_value(self, offset):
+        tag = self.data[offset]
+        offset += 1
+
+        if tag == TAG_NONE:
+            return None, offset
+
+        elif tag == TAG_FALSE:
+            return False, offset
+
+        elif tag == TAG_TRUE:
+            return True, offset
+
+        elif tag == TAG_INT:
+            return struct.unpack_from("<q", self.data, offset)[0], offset + 8
+
+        elif tag == TAG_FLOAT:
+            return struct.unpack_from("<d", self.data, offset)[0], offset + 8
+
+        elif tag == TAG_STRING:
+            return self.strings[struct.unpack_from("<I", self.data, offset)[0]], offset + 4
+
+        elif tag == TAG_BIGINT:
+            return int(self.strings[struct.unpack_from("<I", self.data, offset)[0]]), offset + 4
+
+        elif tag == TAG_LIST:
+            count = struct.unpack_from("<I", self.data, offset)[0]
+            offset += 4
+
+            output = []
+            for _ in range(count):
+                value, offset = self.read_value(offset)
+                output.append(value)
+
+            return output, offset
+
+        elif tag == TAG_DICT:
+            count = struct.unpack_from("<I", self.data, offset)[0]
+            offset += 4
+
+            output = {}
+            for _ in range(count):
+                key = self.strings[struct.unpack_from("<I", self.data, offset)[0]]
+                output[key], offset = self.read_value(offset + 4)
+
+            return output, offset
+
+        elif tag == TAG_EVENTS:
+            table_idx = struct.unpack_from("<I", self.data, offset)[0]
+            return self.read_table(self.table_offsets[table_idx]), offset + 4
+
+        raise Exception("Unknown CIF value tag %d" % tag)
+
+    def read_array(self, offset, dtype, count):
+        array = numpy.frombuffer(self.data, dtype=dtype, count=count, offset=offset)
+        size = array.nbytes
+        return array, offset + size + (-size % 8)
+
+    def read_table(self, offset):
+        group_count, event_count, column_count = struct.unpack_from("<III", self.data, offset)
+        offset += 12 + (-12 % 8)
+
+        # Group keys and sizes are stored back to back and aligned together
+        group_keys = numpy.frombuffer(self.data, dtype="<u4", count=group_count, offset=offset)
+        group_sizes = numpy.frombuffer(self.data, dtype="<u4", count=group_count, offset=offset + group_count * 4)
+        offset += group_count * 8
+
+        events = [{} for _ in range(event_count)]
+
+        for _ in range(column_count):
+            column_type, path_len = struct.unpack_from("<II", self.data, offset)
+            path, offset = self.read_array(offset + 8, "<u4", path_len)
+            path = [self.strings[k] for k in path.tolist()]
+            present, offset = self.read_array(offset, "<u1", event_count)
+            present = numpy.flatnonzero(present).tolist()
+
+            if column_type == COLUMN_INT:
+                column, offset = self.read_array(offset, "<i8", event_count)
+                column = column.tolist()
+
+            elif column_type == COLUMN_FLOAT:
+                column, offset = self.read_array(offset, "<f8", event_count)
+                column = column.tolist()
+
+            elif column_type == COLUMN_STRING:
+                column, offset = self.read_array(offset, "<u4", event_count)
+                strings = self.strings
+                column = [strings[k] for k in column.tolist()]
+
+            elif column_type == COLUMN_VALUE:
+                value_offsets, offset = self.read_array(offset, "<u4", event_count)
+                value_offsets = value_offsets.tolist()
+                encoded_size = struct.unpack_from("<I", self.data, offset)[0]
+                base = offset + 4
+                offset = base + encoded_size + (-(4 + encoded_size) % 8)
+                column = [None] * event_count
+
+                for idx in present:
+                    column[idx] = self.read_value(base + value_offsets[idx])[0]
+
+            else:
+                raise Exception("Unknown CIF column type %d" % column_type)
+
+            parents, key = path[:-1], path[-1]
+            for idx in present:
+                target = events[idx]
+
+                for parent in parents:
+                    if parent not in target:
+                        target[parent] = {}
+
+                    target = target[parent]
+
+                target[key] = column[idx]
+
+        table = {}
+        event_idx = 0
+        for group_key, group_size in zip(group_keys.tolist(), group_sizes.tolist()):
+            table[self.strings[group_key]] = events[event_idx:event_idx + group_size]
+            event_idx += group_size
+
+        return table
+
+    def read(self):
+        return self.read_value(self.document_offset)[0]
+
+
+def get_cif_filename(path):
+    if path and os.path.isdir(path):
+        return os.path.join(path, "output.cif")
+
+    return path
+
+
+def read_cif_file(filename):
+    # The map is released once the reader and the arrays viewing it are gone
+    with open(filename, "rb") as f:
+        # Empty files can't be mapped, and anything shorter than the header isn't a CIF file anyway
+        if os.fstat(f.fileno()).st_size < 0x20:
+            raise Exception("Not a valid CIF file")
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return CifReader(data).read()
+
+
+def write_cif_file(filename, data):
+    with open(filename, "wb") as f:
+        f.write(CifWriter().write(data))
+
+
+class CifFormat:
+    @staticmethod
+    def get_format_name():
+        return "CIF"
+
+    @staticmethod
+    def to_json(params):
+        return intermediate.to_json(CifFormat.to_intermediate(params))
+
+    @staticmethod
+    def to_intermediate(params):
+        input_filename = get_cif_filename(params.get('input'))
+
+        if not input_filename or not os.path.exists(input_filename):
+            return None
+
+        return read_cif_file(input_filename)
+
+    @staticmethod
+    def to_chart(params):
+        CifFormat.from_intermediate(dict(params, input=intermediate.from_json(params.get('input'))))
+
+    @staticmethod
+    def from_intermediate(params):
+        output_filename = os.path.join(params.get('output', ""), "output.cif")
+        write_cif_file(output_filename, params.get('input'))
+
+    @staticmethod
+    def is_format(filename):
+        return plugins.is_format("CIF", filename)
+
+
+def get_class():
+    return CifFormat
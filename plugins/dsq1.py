@@ -10,6 +10,7 @@ from lxml.builder import E
 import uuid
 
 import helper
+import intermediate
 import mdb
 import eamxml
 import audio
@@ -17,6 +18,7 @@ import vas3tool
 import wavbintool
 import tmpfile
 
+import plugins
 import plugins.wav as wav
 
 USE_THREADS = True
@@ -62,13 +64,7 @@ REVERSE_NOTE_MAPPING = {
 
 
 def add_song_info(charts, music_id, music_db):
-    song_info = None
-
-    if music_db and music_db.endswith(".csv") or not music_db:
-        song_info = mdb.get_song_info_from_csv(music_db if music_db else "gitadora_music.csv", music_id)
-
-    if song_info is None or music_db and music_db.endswith(".xml") or not music_db:
-        song_info = mdb.get_song_info_from_mdb(music_db if music_db else "mdb_xg.xml", music_id)
+    song_info = mdb.get_song_info(music_id, music_db)
 
     for chart_idx in range(len(charts)):
         chart = charts[chart_idx]
@@ -513,7 +509,7 @@ def generate_json_from_dsq1(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Dsq1Format:
@@ -523,15 +519,23 @@ class Dsq1Format:
 
     @staticmethod
     def to_json(params):
-        return generate_json_from_dsq1(params)
+        return intermediate.to_json(generate_json_from_dsq1(params))
+
+    @staticmethod
+    def to_intermediate(params):
+        return intermediate.normalize(generate_json_from_dsq1(params))
 
     @staticmethod
     def to_chart(params):
         super()
 
+    @staticmethod
+    def from_intermediate(params):
+        super()
+
     @staticmethod
     def is_format(filename):
-        return False
+        return plugins.is_format("Dsq1", filename)
 
 
 def get_class():
@@ -42,6 +42,8 @@
 # BLACKCOLORKEY
 
 
+import bisect
+import collections
 import copy
 from fractions import Fraction
 import json
@@ -51,6 +53,9 @@ import os
 import re
 
 import audio
+import intermediate
+import jobs
+import plugins
 
 dtx_bonus_mapping = {
     "leftcymbal": 0x01,
@@ -238,28 +243,23 @@ class Fraction2:
 #   DTX reading code   #
 ########################
 
-def get_value_from_dtx(target_tag, lines, default=None):
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+DTX_COMMAND_REGEX = re.compile(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)")
+DTX_CHANNEL_REGEX = re.compile(r"(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})")
 
-        if not matches:
-            continue
+# The first matching prefix decides the resource type (WAVVOL/WAVPAN must come before WAV)
+DTX_RESOURCE_PREFIXES = ["WAVVOL", "WAVPAN", "WAV", "VOLUME", "PAN", "BPM"]
+DTX_RESOURCE_REGEX = {x: re.compile(x + r"(?P<id>[0-9A-Z]{2})?") for x in DTX_RESOURCE_PREFIXES}
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+# type is one of "header" (#TITLE etc), "resource" (#WAVxx, #BPMxx, etc) or "channel" (#mmmcc)
+DtxCommand = collections.namedtuple('DtxCommand', ['type', 'tag', 'value', 'resource', 'index', 'measure', 'channel'])
 
-        if tag.startswith(target_tag):
-            return value
 
-    return default
-
-
-def get_bpms_from_dtx(lines):
-    bpms = {}
-    base_bpm = 0
+def tokenize_dtx(lines):
+    # Classify every line once so the extractors don't need to parse the lines again
+    commands = []
 
     for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+        matches = DTX_COMMAND_REGEX.match(line)
 
         if not matches:
             continue
@@ -267,239 +267,164 @@ def get_bpms_from_dtx(lines):
         tag = matches.group('tag').upper()
         value = matches.group('value')
 
-        if tag.startswith("BPM"):
-            matches2 = re.match("BPM(?P<id>[0-9A-Z]{2})?", tag)
+        if tag[0].isdigit():
+            matches2 = DTX_CHANNEL_REGEX.match(tag)
 
-            if not matches2:
-                pass
+            if matches2:
+                measure = int(matches2.group('measure'))
+                channel = int(matches2.group('event'), 16)
+                commands.append(DtxCommand("channel", tag, value, None, None, measure, channel))
+                continue
 
-            bpm_id = matches2.group('id')
+        for resource in DTX_RESOURCE_PREFIXES:
+            if tag.startswith(resource):
+                resource_id = DTX_RESOURCE_REGEX[resource].match(tag).group('id')
+                resource_id = int(resource_id, 36) if resource_id else 0
+                commands.append(DtxCommand("resource", tag, value, resource, resource_id, None, None))
+                break
 
-            if bpm_id:
-                bpm_id = int(bpm_id, 36)
-            else:
-                bpm_id = 0
+        else:
+            commands.append(DtxCommand("header", tag, value, None, None, None, None))
 
-            bpms[bpm_id] = float(value)
+    return commands
 
-        elif tag.startswith("BASEBPM"):
-            base_bpm = float(value)
 
-    return bpms, base_bpm
+def get_value_from_dtx(target_tag, commands, default=None):
+    for command in commands:
+        if command.tag.startswith(target_tag):
+            return command.value
 
+    return default
 
-def get_wavs_from_dtx(lines, target_parts, sound_metadata, get_wav_length=True):
-    wav_filenames = {}
-    wav_lengths = {}
 
-    for line in lines:
-        if ';' in line:
-            line = line[:line.index(';')].strip()
+def get_bpms_from_dtx(commands):
+    bpms = {}
+    base_bpm = 0
 
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+    for command in commands:
+        if command.resource == "BPM":
+            bpms[command.index] = float(command.value)
 
-        if not matches:
-            continue
+        elif command.tag.startswith("BASEBPM"):
+            base_bpm = float(command.value)
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+    return bpms, base_bpm
 
-        if tag.startswith("WAV") and not tag.startswith("WAVPAN") and not tag.startswith("WAVVOL"):
-            # Handle WAV tags
-            # This can be exported for use by va3 creator
 
-            matches2 = re.match("WAV(?P<id>[0-9A-Z]{2})?", tag)
+def get_wavs_from_dtx(commands, target_parts, sound_folder, get_wav_length=True):
+    wav_filenames = {}
+    wav_lengths = {}
 
-            if not matches2:
-                pass
+    for command in commands:
+        if command.resource != "WAV":
+            continue
 
-            wav_id = matches2.group('id')
+        # Handle WAV tags
+        # This can be exported for use by va3 creator
+        value = command.value
 
-            if wav_id:
-                wav_id = int(wav_id, 36)
-            else:
-                wav_id = 0
+        if ';' in value:
+            value = value[:value.index(';')].strip()
 
-            wav_filenames[wav_id] = os.sep.join(value.split('\\'))
+        wav_id = command.index
+        wav_filenames[wav_id] = os.sep.join(value.split('\\'))
 
-            if get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts):
-                duration = audio.get_duration(os.path.join(sound_metadata['sound_folder'], value))
-                wav_lengths[wav_id] = int(round(duration * 300))
-            else:
-                wav_lengths[wav_id] = 0
+        if get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts):
+            duration = audio.get_duration(os.path.join(sound_folder, value))
+            wav_lengths[wav_id] = int(round(duration * 300))
+        else:
+            wav_lengths[wav_id] = 0
 
     return wav_filenames, wav_lengths
 
 
-def get_wav_volumes_from_dtx(lines):
+def get_wav_volumes_from_dtx(commands):
     wav_volumes = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag.startswith("VOLUME"):
-            valid_tag = "VOLUME"
-        elif tag.startswith("WAVVOL"):
-            valid_tag = "WAVVOL"
-        else:
-            valid_tag = None
-
-        if valid_tag:
+    for command in commands:
+        if command.resource in ["VOLUME", "WAVVOL"]:
             # Handle VOLUME tags
             # This can be exported for use by va3 creator
-
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
-
-            vol_id = matches2.group('id')
-
-            if vol_id:
-                vol_id = int(vol_id, 36)
-            else:
-                vol_id = 0
-
-            wav_volumes[vol_id] = int(value)
+            wav_volumes[command.index] = int(command.value)
 
     return wav_volumes
 
 
-def get_wav_pans_from_dtx(lines):
+def get_wav_pans_from_dtx(commands):
     wav_pans = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag.startswith("PAN"):
-            valid_tag = "PAN"
-        elif tag.startswith("WAVPAN"):
-            valid_tag = "WAVPAN"
-        else:
-            valid_tag = None
-
-
-        if valid_tag:
+    for command in commands:
+        if command.resource in ["PAN", "WAVPAN"]:
             # Handle PAN tags
             # This can be exported for use by va3 creator
-
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
-
-            pan_id = matches2.group('id')
-
-            if pan_id:
-                pan_id = int(pan_id, 36)
-            else:
-                pan_id = 0
-
-            wav_pans[pan_id] = int(value)
+            wav_pans[command.index] = int(command.value)
 
     return wav_pans
 
 
-def get_bonus_notes_from_dtx(lines, start_offset_padding):
+def get_bonus_notes_from_dtx(commands, start_offset_padding):
     bonus_notes = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
+    for command in commands:
+        if command.type != "channel":
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
+        measure = command.measure + start_offset_padding
+        value = command.value
 
-            if not matches2:
-                pass
+        if command.channel in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
+            data = [value[i:i+2] for i in range(0, len(value), 2)]
+            for i in range(len(data)):
+                if measure not in bonus_notes:
+                    bonus_notes[measure] = {}
 
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
+                if i not in bonus_notes[measure]:
+                    bonus_notes[measure][i] = []
 
-            if event in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
-                data = [value[i:i+2] for i in range(0, len(value), 2)]
-                for i in range(len(data)):
-                    if measure not in bonus_notes:
-                        bonus_notes[measure] = {}
-
-                    if i not in bonus_notes[measure]:
-                        bonus_notes[measure][i] = []
-
-                    bonus_notes[measure][i].append(int(data[i], 36))
+                bonus_notes[measure][i].append(int(data[i], 36))
 
     return bonus_notes
 
 
-def get_measure_lengths_from_dtx(lines, start_offset_padding):
+def get_measure_lengths_from_dtx(commands, start_offset_padding):
     VALID_TIMESIG_DENOMINATORS = [1 << x for x in range(0, 256)]
 
     measure_lengths = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
+    for command in commands:
+        if command.type != "channel" or command.channel != 0x02:
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
-
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event != 0x02:
-                continue
-
-            # Measure length event
-            f1 = Fraction(float(value)).limit_denominator()
-            numerator = f1.numerator
-            denominator = f1.denominator
-
-            # How to code this?
-            if denominator == 1:
-                numerator *= 4
-                denominator = 4
-            elif denominator == 2:
-                numerator *= 2
-                denominator = 4
-
-            f2 = Fraction2(numerator, denominator)
-
-            # Add check for impossible time signatures
-            if denominator not in VALID_TIMESIG_DENOMINATORS:
-                print("ERROR: This is an impossible to represent"
-                      "time signature: {}".format(value))
-                print("This came out to be", f2)
-                print("Valid denominators for the time signature"
-                      "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
-                print("Please try simplifying all measures which"
-                      "use the measure length {}".format(value))
-                exit(1)
+        measure = command.measure + start_offset_padding
+        value = command.value
+
+        # Measure length event
+        f1 = Fraction(float(value)).limit_denominator()
+        numerator = f1.numerator
+        denominator = f1.denominator
+
+        # How to code this?
+        if denominator == 1:
+            numerator *= 4
+            denominator = 4
+        elif denominator == 2:
+            numerator *= 2
+            denominator = 4
+
+        f2 = Fraction2(numerator, denominator)
+
+        # Add check for impossible time signatures
+        if denominator not in VALID_TIMESIG_DENOMINATORS:
+            print("ERROR: This is an impossible to represent"
+                  "time signature: {}".format(value))
+            print("This came out to be", f2)
+            print("Valid denominators for the time signature"
+                  "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
+            print("Please try simplifying all measures which"
+                  "use the measure length {}".format(value))
+            exit(1)
 
-            measure_lengths[measure] = f2
+        measure_lengths[measure] = f2
 
     if 0 not in measure_lengths:
         measure_lengths[0] = Fraction2(4, 4)  # Default to 4/4
@@ -507,62 +432,58 @@ def get_measure_lengths_from_dtx(lines, start_offset_padding):
     return measure_lengths
 
 
-def get_events_by_measure_from_dtx(lines, start_offset_padding):
+def get_events_by_measure_from_dtx(commands, start_offset_padding):
     events_by_measure = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
+    for command in commands:
+        if command.type != "channel" or command.channel == 0x02:
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+        measure = command.measure + start_offset_padding
+        value = command.value
 
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
+        # Handle specific events
+        if measure not in events_by_measure:
+            events_by_measure[measure] = {}
 
-            if not matches2:
-                pass
+        events_by_measure[measure][command.channel] = [value[i:i+2] for i in range(0, len(value), 2)]
 
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event == 0x02:
-                continue
+    return events_by_measure
 
-            # Handle specific events
-            if measure not in events_by_measure:
-                events_by_measure[measure] = {}
 
-            events_by_measure[measure][event] = [value[i:i+2] for i in range(0, len(value), 2)]
+# length is the number of ticks covered by the channel in its measure and
+# chips maps the tick of each non-zero chip to its value
+DtxChannel = collections.namedtuple('DtxChannel', ['length', 'chips'])
 
-    return events_by_measure
 
+def get_sparse_events(events_by_measure, measure_lengths):
+    # Place every chip on the 1920 ticks per whole note grid of its measure.
+    # Only non-zero chips are stored so nothing has to scan the empty slots later.
+    measure_lengths_keys = sorted(measure_lengths.keys())
 
-def pad_events(events_by_measure, measure_lengths):
-    # Pad all measures to appropriate sizes
     for measure in events_by_measure:
-        for event in events_by_measure[measure]:
-            scale = Fraction(4, 4)
+        scale = Fraction(4, 4)
 
-            measure_lengths_keys = sorted(measure_lengths.keys(), key=lambda x: int(x))
-            matched_measures = [x for x in measure_lengths_keys if int(x) <= measure]
+        matched_measures = [x for x in measure_lengths_keys if x <= measure]
+        if len(matched_measures) > 0:
+            scale = measure_lengths[matched_measures[-1]]
 
-            if len(matched_measures) > 0:
-                scale = measure_lengths[matched_measures[-1]]
+        for event in events_by_measure[measure]:
+            data = events_by_measure[measure][event]
 
-            event_count = len(events_by_measure[measure][event])
-            beat_division = (1920 / scale.denominator) * scale.numerator
+            if len(data) == 0:
+                events_by_measure[measure][event] = DtxChannel(0, {})
+                continue
 
-            new_chips = []
-            for i in range(len(events_by_measure[measure][event])):
-                c = events_by_measure[measure][event][i]
+            # Chips can't share a tick even if there are more chips than ticks
+            step = max(1, (1920 * scale.numerator) // (scale.denominator * len(data)))
 
-                new_chips.append(c)
-                new_chips += ['00'] * (int(beat_division / len(events_by_measure[measure][event])) - 1)
+            chips = {}
+            for i in range(len(data)):
+                if data[i] != '00':
+                    chips[i * step] = data[i]
 
-            events_by_measure[measure][event] = new_chips
+            events_by_measure[measure][event] = DtxChannel(step * len(data), chips)
 
     return events_by_measure
 
@@ -572,16 +493,11 @@ def get_bpms_at_measure_beat(events, bpms):
 
     for measure in events:
         if 0x08 in events[measure]:
-            for i in range(len(events[measure][0x08])):
-                if events[measure][0x08][i] != "00":
-                    if measure not in bpms_at_measure_beat:
-                        bpms_at_measure_beat[measure] = {}
-
-                    if i not in bpms_at_measure_beat[measure]:
-                        bpms_at_measure_beat[measure][i] = {}
+            for i, value in events[measure][0x08].chips.items():
+                if measure not in bpms_at_measure_beat:
+                    bpms_at_measure_beat[measure] = {}
 
-                    val = int(events[measure][0x08][i], 36)
-                    bpms_at_measure_beat[measure][i] = bpms[val]
+                bpms_at_measure_beat[measure][i] = bpms[int(value, 36)]
 
     if 0 not in bpms_at_measure_beat:
         bpms_at_measure_beat[0] = {0: bpms[0]}
@@ -595,12 +511,11 @@ def get_guitar_long_notes_at_measure_beat(events):
     for measure in events:
         for long_event in [0x2a, 0x2c]:
             if long_event in events[measure]:
-                for i in range(len(events[measure][long_event])):
-                    if events[measure][long_event][i] != "00":
-                        if measure not in guitar_long_notes_at_measure_beat:
-                            guitar_long_notes_at_measure_beat[measure] = {}
+                for i in events[measure][long_event].chips:
+                    if measure not in guitar_long_notes_at_measure_beat:
+                        guitar_long_notes_at_measure_beat[measure] = {}
 
-                        guitar_long_notes_at_measure_beat[measure][i] = True
+                    guitar_long_notes_at_measure_beat[measure][i] = True
 
     return guitar_long_notes_at_measure_beat
 
@@ -611,12 +526,11 @@ def get_bass_long_notes_at_measure_beat(events):
     for measure in events:
         for long_event in [0x2b, 0x2d]:
             if long_event in events[measure]:
-                for i in range(len(events[measure][long_event])):
-                    if events[measure][long_event][i] != "00":
-                        if measure not in bass_long_notes_at_measure_beat:
-                            bass_long_notes_at_measure_beat[measure] = {}
+                for i in events[measure][long_event].chips:
+                    if measure not in bass_long_notes_at_measure_beat:
+                        bass_long_notes_at_measure_beat[measure] = {}
 
-                        bass_long_notes_at_measure_beat[measure][i] = True
+                    bass_long_notes_at_measure_beat[measure][i] = True
 
     return bass_long_notes_at_measure_beat
 
@@ -627,17 +541,16 @@ def get_notes_by_measure_beat(events):
     for measure in events:
         for event in events[measure]:
             if event in guitar_range or event in bass_range:
-                for i in range(len(events[measure][event])):
-                    if events[measure][event][i] != "00":
-                        if measure not in notes_by_measure_beat:
-                            notes_by_measure_beat[measure] = {}
-
-                        if event in guitar_range:
-                            notes_by_measure_beat[measure][i] = 1
-                        elif event in bass_range:
-                            notes_by_measure_beat[measure][i] = 2
-                        else:
-                            notes_by_measure_beat[measure][i] = 0
+                for i in events[measure][event].chips:
+                    if measure not in notes_by_measure_beat:
+                        notes_by_measure_beat[measure] = {}
+
+                    if event in guitar_range:
+                        notes_by_measure_beat[measure][i] = 1
+                    elif event in bass_range:
+                        notes_by_measure_beat[measure][i] = 2
+                    else:
+                        notes_by_measure_beat[measure][i] = 0
 
     return notes_by_measure_beat
 
@@ -673,7 +586,50 @@ def get_long_note_time_by_measure_beat(events_by_measure, long_notes_at_measure_
     return long_note_time_by_measure_beat
 
 
-def generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_pans, target_id=30, override_target_id=100, is_drums=False):
+class SoundIdAllocator:
+    # Keeps track of the sound IDs used in sound_metadata['data'] so that
+    # registering a sound doesn't need to scan all of the existing entries.
+    # All changes to the data must go through add/remove to keep the index valid.
+
+    def __init__(self, data):
+        self.data = data
+        self.next_free = {}  # Used ID -> ID after the run of used IDs it belongs to
+        self.sound_ids = {}  # (filename, pan) -> sound ID
+
+        for k in data:
+            self.sound_ids.setdefault((data[k]['filename'], data[k]['pan']), k)
+
+    def get_free_id(self, sound_id):
+        # Returns the first unused ID starting at sound_id
+        used = []
+
+        while sound_id in self.data:
+            used.append(sound_id)
+            sound_id = self.next_free.get(sound_id, sound_id + 1)
+
+        for k in used:
+            self.next_free[k] = sound_id
+
+        return sound_id
+
+    def find(self, filename, pan):
+        return self.sound_ids.get((filename, pan), None)
+
+    def add(self, md):
+        self.data[md['sound_id']] = md
+        self.sound_ids.setdefault((md['filename'], md['pan']), md['sound_id'])
+
+    def remove(self, sound_id):
+        md = self.data.pop(sound_id)
+
+        if self.sound_ids.get((md['filename'], md['pan'])) == sound_id:
+            del self.sound_ids[(md['filename'], md['pan'])]
+
+        # Freed IDs can be in the middle of a run so start over
+        self.next_free = {}
+
+
+def generate_sound_metadata_map(sound_metadata, allocator, wav_filenames, wav_volumes, wav_pans, target_id=30, override_target_id=100, is_drums=False):
     sound_metadata_map = {}
 
     for wav_id in wav_filenames:
@@ -683,8 +639,7 @@ def generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_
         if is_drums and filename.startswith("_override_clipped"):
             sound_id = override_target_id
 
-        while sound_id in sound_metadata['data']:
-            sound_id += 1
+        sound_id = allocator.get_free_id(sound_id)
 
         if is_drums and filename.startswith("_override_clipped"):
             override_target_id = sound_id
@@ -709,56 +664,18 @@ def generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_
         if wav_id in wav_pans:
             md['pan'] = int(round(((int(wav_pans[wav_id]) * (128/2)) / 100) + (128/2)))
 
-        map_id = sound_id
-        found_match = False
-        for k in sound_metadata['data']:
-            item = sound_metadata['data'][k]
+        # TODO: Add volume to the key if mixing volume in VA3 file
+        map_id = allocator.find(md['filename'], md['pan'])
 
-            # TODO: Add following to if statement if mixing volume in VA3 file
-            # and item['volume'] == md['volume']:
-            if item['filename'] == md['filename'] and item['pan'] == md['pan']:
-                map_id = item['sound_id']
-                found_match = True
-                break
+        if map_id is None:
+            map_id = sound_id
+            allocator.add(md)
 
         sound_metadata_map[wav_id] = map_id
 
-        if not found_match:
-            sound_metadata['data'][map_id] = md
-
     return sound_metadata_map, sound_metadata
 
 
-bpm_cache = {}
-def find_last_bpm(measure, target_beat, bpms_at_measure_beat):
-    global bpm_cache
-
-    last_bpm = 0
-
-    if measure in bpm_cache and target_beat in bpm_cache[measure]:
-        return bpm_cache[measure][target_beat]
-
-    for pk in sorted(bpms_at_measure_beat.keys()):
-        if pk > measure:
-            break
-
-        if pk not in bpms_at_measure_beat:
-            continue
-
-        for subbeat_k in sorted(bpms_at_measure_beat[pk].keys()):
-            is_start = measure == 0 and target_beat == 0
-            if not is_start and pk == measure and subbeat_k > target_beat:
-                break
-
-            last_bpm = bpms_at_measure_beat[pk][subbeat_k]
-
-    if measure not in bpm_cache:
-        bpm_cache[measure] = {}
-
-    bpm_cache[measure][target_beat] = last_bpm
-
-    return last_bpm
-
 def is_mid_bpm(measure, bpms_at_measure_beat):
     if measure not in bpms_at_measure_beat:
         return False
@@ -773,109 +690,104 @@ def is_mid_bpm(measure, bpms_at_measure_beat):
     return False
 
 
-timestamp_cache = {}
-timestamp_cache2 = {}
-def calculate_current_timestamp(measure, target_beat, measure_lengths, bpms_at_measure_beat):
-    global bpm_cache
-    global timestamp_cache
-    global timestamp_cache2
+def get_ticks_time(ticks, timesig, bpm):
+    one_measure = (1920 / timesig.denominator) * timesig.numerator
+    beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
+    beat_len = (beat_ts * timesig.numerator) / one_measure
 
-    def _calculate_current_timestamp(measure, target_beat, prev, timesig, bpm):
-        cache_key = "%d_%d_%d_%d_%f" % (
-            measure,
-            target_beat,
-            timesig.numerator,
-            timesig.denominator,
-            bpm
-        )
+    return (ticks * beat_len) / 300
 
-        if cache_key in timestamp_cache2:
-            return timestamp_cache2[cache_key]
 
-        one_measure = (1920 / timesig.denominator) * timesig.numerator
-        beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
-        beat_len = (beat_ts * timesig.numerator) / one_measure
+class DtxTimingContext:
+    # Holds all of the timing state for a single DTX file, so files
+    # can be parsed in parallel without sharing any caches.
+    # The tempo map is filled in measure by measure as it's needed:
+    # the start time of each measure and, inside of each measure, the segments
+    # of constant BPM so any tick can be looked up by bisecting the segment ticks.
 
-        timestamp = (((measure * one_measure) + target_beat) * beat_len) / 300
-        timestamp_cache2[cache_key] = timestamp
+    def __init__(self, measure_lengths, bpms_at_measure_beat):
+        self.measure_lengths = measure_lengths
+        self.measure_lengths_keys = sorted(measure_lengths.keys())
+        self.bpms_at_measure_beat = bpms_at_measure_beat
+        self.bpm_measures = sorted(bpms_at_measure_beat.keys())
 
-        return timestamp
+        self.measures = []  # (timesig, beat division, segment ticks, segment bpms, segment times) per measure
+        self.measure_start = [0]  # Time at the start of each measure, in seconds
 
-    if measure in timestamp_cache and target_beat in timestamp_cache[measure]:
-        return timestamp_cache[measure][target_beat]
+    def get_timesig(self, measure):
+        idx = bisect.bisect_right(self.measure_lengths_keys, measure) - 1
 
-    measure_lengths_before_target = {}
-    results = [0]
-    keys = sorted(measure_lengths.keys())
+        if idx < 0:
+            return None
 
-    if len(keys) > 0:
-        measure_lengths_before_target[keys[0]] = 0
+        return self.measure_lengths[self.measure_lengths_keys[idx]]
 
-    for cur_measure in range(measure + 1):
-        current_timesig = find_last_timesig(cur_measure, measure_lengths)
+    def get_measure_tempo(self, measure):
+        while len(self.measures) <= measure:
+            cur_measure = len(self.measures)
 
-        if cur_measure == measure or is_mid_bpm(cur_measure, bpms_at_measure_beat):
-            numerator = current_timesig.numerator
-            denominator = current_timesig.denominator
-            beat_division = int(round((1920 // denominator) * numerator))
+            timesig = self.get_timesig(cur_measure)
+            beat_division = int(round((1920 // timesig.denominator) * timesig.numerator))
 
-            for cur_beat in range(beat_division):
-                if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                    current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
-                else:
-                    current_bpm = bpm_cache[cur_measure][cur_beat]
+            # BPM carried over from the last BPM change before this measure
+            bpm = 0
+            idx = bisect.bisect_left(self.bpm_measures, cur_measure) - 1
+            if idx >= 0:
+                prev_bpms = self.bpms_at_measure_beat[self.bpm_measures[idx]]
+                bpm = prev_bpms[sorted(prev_bpms.keys())[-1]]
 
-                if cur_measure >= measure and cur_beat >= target_beat:
-                    break
+            segment_ticks = [0]
+            segment_bpms = [bpm]
 
-                cache_key = "0_1_%d_%d_%f" % (
-                    current_timesig.numerator,
-                    current_timesig.denominator,
-                    current_bpm
-                )
+            cur_bpms = self.bpms_at_measure_beat.get(cur_measure, {})
+            for subbeat_k in sorted(cur_bpms.keys()):
+                if subbeat_k == segment_ticks[-1]:
+                    segment_bpms[-1] = cur_bpms[subbeat_k]
+                else:
+                    segment_ticks.append(subbeat_k)
+                    segment_bpms.append(cur_bpms[subbeat_k])
 
-                results.append(results[-1] + timestamp_cache2.get(cache_key, _calculate_current_timestamp(0, 1, results[-1], current_timesig, current_bpm)))
-        else:
-            cur_beat = 0
+            if cur_measure == 0 and segment_bpms[0] != segment_bpms[-1]:
+                # The very first tick of the song uses the last BPM of measure 0
+                bpm_at_1 = segment_bpms[bisect.bisect_right(segment_ticks, 1) - 1]
+                rest = [(x, y) for x, y in zip(segment_ticks, segment_bpms) if x > 1]
+                segment_ticks = [0, 1] + [x for x, y in rest]
+                segment_bpms = [segment_bpms[-1], bpm_at_1] + [y for x, y in rest]
 
-            if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
-            else:
-                current_bpm = bpm_cache[cur_measure][cur_beat]
+            segment_times = [0]
+            for i in range(1, len(segment_ticks)):
+                length = get_ticks_time(segment_ticks[i] - segment_ticks[i - 1], timesig, segment_bpms[i - 1])
+                segment_times.append(segment_times[-1] + length)
 
-            cache_key = "1_0_%d_%d_%f" % (
-                current_timesig.numerator,
-                current_timesig.denominator,
-                current_bpm
-            )
+            self.measures.append((timesig, beat_division, segment_ticks, segment_bpms, segment_times))
 
-            if cache_key in timestamp_cache2:
-                results.append(results[-1] + timestamp_cache2[cache_key])
+            if is_mid_bpm(cur_measure, self.bpms_at_measure_beat):
+                duration = get_measure_time(self.measures[cur_measure], beat_division)
             else:
-                results.append(results[-1] + _calculate_current_timestamp(1, 0, results[-1], current_timesig, current_bpm))
+                one_measure = (1920 / timesig.denominator) * timesig.numerator
+                duration = get_ticks_time(one_measure, timesig, segment_bpms[0])
 
-    if measure not in timestamp_cache:
-        timestamp_cache[measure] = {}
+            self.measure_start.append(self.measure_start[-1] + duration)
 
-    result = int(round(results[-1] * 300))
-    timestamp_cache[measure][target_beat] = result
+        return self.measures[measure]
 
-    return result
+    def get_timestamp(self, measure, target_beat):
+        measure_tempo = self.get_measure_tempo(measure)
+        timestamp = self.measure_start[measure] + get_measure_time(measure_tempo, target_beat)
 
+        return int(round(timestamp * 300))
 
-def find_last_timesig(measure, measure_lengths):
-    last_timesig = None
 
-    for pk in sorted(measure_lengths.keys()):
-        if pk > measure:
-            break
+def get_measure_time(measure_tempo, target_beat):
+    timesig, beat_division, segment_ticks, segment_bpms, segment_times = measure_tempo
 
-        if pk not in measure_lengths:
-            continue
+    target_beat = min(target_beat, beat_division)
+    idx = bisect.bisect_right(segment_ticks, target_beat) - 1
 
-        last_timesig = measure_lengths[pk]
+    if target_beat == segment_ticks[idx]:
+        return segment_times[idx]
 
-    return last_timesig
+    return segment_times[idx] + get_ticks_time(target_beat - segment_ticks[idx], timesig, segment_bpms[idx])
 
 
 def calculate_current_beat(measure, target_beat, measure_lengths):
@@ -975,14 +887,14 @@ def get_valid_chart(chart):
     return None
 
 
-def get_chart_datas(chart_data, lines):
-    song_title = get_value_from_dtx("TITLE", lines, default="")
-    artist_name = get_value_from_dtx("ARTIST", lines, default="")
-    drum_difficulty = get_value_from_dtx("DLEVEL", lines, default=0)
-    guitar_difficulty = get_value_from_dtx("GLEVEL", lines, default=0)
-    bass_difficulty = get_value_from_dtx("BLEVEL", lines, default=0)
-    pre_image = get_value_from_dtx("PREIMAGE", lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
+def get_chart_datas(chart_data, commands):
+    song_title = get_value_from_dtx("TITLE", commands, default="")
+    artist_name = get_value_from_dtx("ARTIST", commands, default="")
+    drum_difficulty = get_value_from_dtx("DLEVEL", commands, default=0)
+    guitar_difficulty = get_value_from_dtx("GLEVEL", commands, default=0)
+    bass_difficulty = get_value_from_dtx("BLEVEL", commands, default=0)
+    pre_image = get_value_from_dtx("PREIMAGE", commands)
+    bpms, base_bpm = get_bpms_from_dtx(commands)
     first_bpm = bpms[sorted(bpms.keys(), key=lambda x:int(x))[0]]
 
     drum_chart_data = {
@@ -1069,21 +981,12 @@ def get_chart_datas(chart_data, lines):
 # TODO: Try to refactor this more later
 def parse_dtx_to_intermediate(filename,
                               params,
-                              sound_metadata,
+                              sound_folder,
                               target_parts=['drum', 'guitar', 'bass', 'open']):
-    global timestamp_cache
-    global bpm_cache
-    global timestamp_cache2
-
     start_offset_padding = params.get('dtx_pad_start', 0)
 
-    timestamp_cache = {}
-    bpm_cache = {}
-    timestamp_cache2 = {}
-    bpms_at_measure_beat = {}
-
     if not filename or not os.path.exists(filename):
-        return None, None, None, None, sound_metadata
+        return None, None, None, None, None
 
     try:
         with open(filename, "r", encoding="shift-jis") as f:
@@ -1096,32 +999,31 @@ def parse_dtx_to_intermediate(filename,
             with open(filename, "r", encoding="utf-16") as f:
                 lines = [x.strip() for x in f if x.strip().startswith("#")]
 
+    commands = tokenize_dtx(lines)
+
     # Parse all commands
     bgm_info = []
     default_notes = {}
 
-    preview_filename = get_value_from_dtx("PREVIEW", lines)
-    wav_filenames, wav_lengths = get_wavs_from_dtx(lines, target_parts, sound_metadata, not params.get('no_sounds', False))
-    wav_volumes = get_wav_volumes_from_dtx(lines)
-    wav_pans = get_wav_pans_from_dtx(lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
+    preview_filename = get_value_from_dtx("PREVIEW", commands)
+    wav_filenames, wav_lengths = get_wavs_from_dtx(commands, target_parts, sound_folder, not params.get('no_sounds', False))
+    wav_volumes = get_wav_volumes_from_dtx(commands)
+    wav_pans = get_wav_pans_from_dtx(commands)
+    bpms, base_bpm = get_bpms_from_dtx(commands)
 
-    bonus_notes = get_bonus_notes_from_dtx(lines, start_offset_padding)
-    measure_lengths = get_measure_lengths_from_dtx(lines, start_offset_padding)
-    events_by_measure = get_events_by_measure_from_dtx(lines, start_offset_padding)
+    bonus_notes = get_bonus_notes_from_dtx(commands, start_offset_padding)
+    measure_lengths = get_measure_lengths_from_dtx(commands, start_offset_padding)
+    events_by_measure = get_events_by_measure_from_dtx(commands, start_offset_padding)
 
-    # Build data for sound metadata file
-    # This must be correct to get the right sound id for the note commands
-    # It's not possible to store panning information in the chart data,
-    # but volume data is possible.
-    # As a result, all volume flags will be stored in the chart data
-    # but the panning will be in the sound metadata.
-    sound_metadata_map, sound_metadata = generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_pans, is_drums='drum' in target_parts)
+    # Sound IDs in the parsed chart are the WAV IDs of this file.
+    # They're mapped to the real sound IDs by merge_dtx_sounds so that
+    # multiple files can be parsed at the same time.
     sound_metadata_guitar = []
     sound_metadata_drum = []
 
-    events_by_measure = pad_events(events_by_measure, measure_lengths)
+    events_by_measure = get_sparse_events(events_by_measure, measure_lengths)
     bpms_at_measure_beat = get_bpms_at_measure_beat(events_by_measure, bpms)
+    timing = DtxTimingContext(measure_lengths, bpms_at_measure_beat)
 
     guitar_long_notes_at_measure_beat = get_guitar_long_notes_at_measure_beat(events_by_measure)
     guitar_long_note_time_by_measure_beat = \
@@ -1156,7 +1058,7 @@ def parse_dtx_to_intermediate(filename,
     }
 
     # Add start events
-    timestamp_cur = calculate_current_timestamp(0, 0, measure_lengths, bpms_at_measure_beat)
+    timestamp_cur = timing.get_timestamp(0, 0)
     chart_data['beats'][0] = []
     chart_data['beats'][0].append({
         "name": "startpos",
@@ -1197,7 +1099,7 @@ def parse_dtx_to_intermediate(filename,
     keys = list(events_by_measure.keys()) + list(measure_lengths.keys())
     measure_list = sorted(list(set(keys)), key=lambda x: int(x))
     for measure in range(measure_list[-1] + 1):
-        time_signature = find_last_timesig(measure, measure_lengths)
+        time_signature = timing.get_timesig(measure)
         same_numerator = time_signature.numerator == current_time_signature.numerator
         same_denominator = time_signature.denominator == current_time_signature.denominator
         updated_time_signature = not same_numerator or not same_denominator
@@ -1218,7 +1120,7 @@ def parse_dtx_to_intermediate(filename,
         if global_beat_metadata not in metadata_chart_data['beats']:
             metadata_chart_data['beats'][global_beat_metadata] = []
 
-        timestamp_cur = calculate_current_timestamp(measure, 0, measure_lengths, bpms_at_measure_beat)
+        timestamp_cur = timing.get_timestamp(measure, 0)
         if updated_time_signature:
             metadata_chart_data['beats'][global_beat_metadata].append({
                 "data": {
@@ -1253,7 +1155,7 @@ def parse_dtx_to_intermediate(filename,
 
             metadata_chart_data['beats'][beat].append({
                 "name": "beat",
-                "timestamp": calculate_current_timestamp(measure, cb, measure_lengths, bpms_at_measure_beat),
+                "timestamp": timing.get_timestamp(measure, cb),
             })
 
         global_beat_metadata = int(round(global_beat_metadata))
@@ -1275,17 +1177,9 @@ def parse_dtx_to_intermediate(filename,
 
                 if event == 0x01:
                     # BGM item
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
-                        timestamp = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
+                        timestamp = timing.get_timestamp(measure, i)
 
                         if int(data[i], 36) in wav_filenames:
                             bgm_info.append({
@@ -1295,11 +1189,8 @@ def parse_dtx_to_intermediate(filename,
 
                 elif event == 0x03:
                     # Base BPM addition
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
                         beat = global_beat_metadata + i
 
                         if beat not in metadata_chart_data['beats']:
@@ -1312,12 +1203,7 @@ def parse_dtx_to_intermediate(filename,
                                 "bpm": new_bpm
                             },
                             "name": "bpm",
-                            "timestamp": calculate_current_timestamp(
-                                measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
-                            ),
+                            "timestamp": timing.get_timestamp(measure, i),
                         })
 
                         if beat > last_event[2]:
@@ -1327,11 +1213,8 @@ def parse_dtx_to_intermediate(filename,
 
                 elif event == 0x08:
                     # BPM event
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
                         beat = global_beat_metadata + i
 
                         if beat not in metadata_chart_data['beats']:
@@ -1347,12 +1230,7 @@ def parse_dtx_to_intermediate(filename,
                                     "bpm": base_bpm + bpms[int(data[i], 36)]
                                 },
                                 "name": "bpm",
-                                "timestamp": calculate_current_timestamp(
-                                    measure,
-                                    i % len(data),
-                                    measure_lengths,
-                                    bpms_at_measure_beat
-                                ),
+                                "timestamp": timing.get_timestamp(measure, i),
                             })
 
                             if beat > last_event[2]:
@@ -1362,11 +1240,8 @@ def parse_dtx_to_intermediate(filename,
 
                 elif event == 0xc2:
                     # baron/off
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
                         beat = global_beat_metadata + i
 
                         name = ""
@@ -1386,83 +1261,53 @@ def parse_dtx_to_intermediate(filename,
 
                         metadata_chart_data['beats'][beat].append({
                             "name": name,
-                            "timestamp": calculate_current_timestamp(
-                                measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
-                            ),
+                            "timestamp": timing.get_timestamp(measure, i),
                         })
 
                         if beat > last_event[2]:
                             last_event = (measure, i, beat)
 
                 elif event in default_note_events:
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
-                        sound_id = int(data[i], 36)
-                        mapped_sound_id = sound_metadata_map.get(sound_id, 0)
-                        default_notes[reverse_dtx_mapping[event]] = mapped_sound_id
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
+                        default_notes[reverse_dtx_mapping[event]] = int(data[i], 36)
 
                 elif event in [0x2a, 0x2c]:
                     # Guitar long note
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
                         if measure not in guitar_long_note_info:
                             guitar_long_note_info[measure] = {}
 
-                        guitar_long_note_info[measure][i] = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
+                        guitar_long_note_info[measure][i] = timing.get_timestamp(measure, i)
 
                 elif event in [0x2b, 0x2d]:
                     # Bass long note
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
                         if measure not in bass_long_note_info:
                             bass_long_note_info[measure] = {}
 
-                        bass_long_note_info[measure][i] = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
+                        bass_long_note_info[measure][i] = timing.get_timestamp(measure, i)
 
                 elif event in reverse_dtx_mapping:
-                    data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
-
+                    data = events_by_measure[measure][event].chips
+                    for i in data:
                         beat = global_beat_chart + i
 
                         if beat not in chart_data['beats']:
                             chart_data['beats'][beat] = []
 
                         sound_id = int(data[i], 36)
-                        mapped_sound_id = sound_metadata_map.get(sound_id, 0)
 
                         if event in drum_range:
-                            sound_metadata_drum.append(mapped_sound_id)
+                            sound_metadata_drum.append(sound_id)
 
                             if reverse_dtx_mapping[event] not in default_notes:
-                                default_notes[reverse_dtx_mapping[event]] = mapped_sound_id
+                                default_notes[reverse_dtx_mapping[event]] = sound_id
 
                         elif event in guitar_range or event in bass_range:
-                            sound_metadata_guitar.append(mapped_sound_id)
+                            sound_metadata_guitar.append(sound_id)
 
                         if beat > last_event[2]:
                             last_event = (measure, i, beat)
@@ -1486,7 +1331,8 @@ def parse_dtx_to_intermediate(filename,
                             wail_event = 0xa8
 
                         if wail_event != -1 and wail_event in events_by_measure[measure]:
-                            if len(events_by_measure[measure][wail_event]) == len(events_by_measure[measure][event]) and events_by_measure[measure][wail_event][i] != "00":
+                            wail_data = events_by_measure[measure][wail_event]
+                            if wail_data.length == events_by_measure[measure][event].length and i in wail_data.chips:
                                 wail_flag = 1
 
                         if event in guitar_range and measure in guitar_long_note_time_by_measure_beat and i in guitar_long_note_time_by_measure_beat[measure]:
@@ -1501,7 +1347,7 @@ def parse_dtx_to_intermediate(filename,
                                 "hold_duration": 0,
                                 "note": reverse_dtx_mapping[event],
                                 "note_length": 0,
-                                "sound_id": mapped_sound_id,
+                                "sound_id": sound_id,
                                 "unk": 0,
                                 "volume": 127 if sound_id not in wav_volumes else int(round(127 * (wav_volumes[sound_id] / 100))),
                                 "wail_misc": wail_direction if wail_flag else 0,
@@ -1509,7 +1355,7 @@ def parse_dtx_to_intermediate(filename,
                                 "bonus_note": 1 if measure in bonus_notes and i in bonus_notes[measure] and sound_id in bonus_notes[measure][i] else 0,
                             },
                             "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
+                            "timestamp": timing.get_timestamp(measure, i),
                         })
 
                         if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
@@ -1520,12 +1366,9 @@ def parse_dtx_to_intermediate(filename,
                     if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
                         continue
 
-                    data = events_by_measure[measure][event]
-
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    data = events_by_measure[measure][event].chips
 
+                    for i in data:
                         beat = global_beat_chart + i
 
                         if beat not in chart_data['beats']:
@@ -1541,7 +1384,7 @@ def parse_dtx_to_intermediate(filename,
                                 "hold_duration": 0,
                                 "note": "auto",
                                 "note_length": 0,
-                                "sound_id": 0 if sound_id not in sound_metadata_map else sound_metadata_map[sound_id],
+                                "sound_id": sound_id,
                                 "unk": 0,
                                 "volume": 127 if sound_id not in wav_volumes else int(round(127 * (wav_volumes[sound_id] / 100))),
                                 "wail_direction": 0,
@@ -1549,7 +1392,7 @@ def parse_dtx_to_intermediate(filename,
                                 "guitar_special": 0,
                             },
                             "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
+                            "timestamp": timing.get_timestamp(measure, i),
                         })
 
                         if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
@@ -1574,7 +1417,7 @@ def parse_dtx_to_intermediate(filename,
 
     chart_data['beats'][last_event[2]].append({
         "name": "chipend",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": timing.get_timestamp(last_event[0], last_event[1]),
     })
 
     # Delayed end command
@@ -1592,39 +1435,75 @@ def parse_dtx_to_intermediate(filename,
 
     chart_data['beats'][last_event[2]].append({
         "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": timing.get_timestamp(last_event[0], last_event[1]),
     })
 
     metadata_chart_data['beats'][last_event[2]].append({
         "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": timing.get_timestamp(last_event[0], last_event[1]),
     })
 
     chart_data = generate_timestamp_set(chart_data, last_event)
     metadata_chart_data = generate_timestamp_set(metadata_chart_data, last_event)
 
+    sounds = {
+        'wav_filenames': wav_filenames,
+        'wav_volumes': wav_volumes,
+        'wav_pans': wav_pans,
+        'is_drums': 'drum' in target_parts,
+        'drum': sound_metadata_drum,
+        'guitar': sound_metadata_guitar,
+        'bgm': {
+            'end': timing.get_timestamp(last_event[0], last_event[1]) / 300,
+            'data': bgm_info
+        },
+        'preview': preview_filename,
+        'defaults': default_notes,
+    }
+
+    drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, commands)
+
+    return metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, sounds
+
+
+def merge_dtx_sounds(sound_metadata, allocator, sounds, chart):
+    # Assign the real sound IDs for one parsed file.
+    # This must run in the same order for every conversion to get stable sound IDs.
+
+    # Build data for sound metadata file
+    # This must be correct to get the right sound id for the note commands
+    # It's not possible to store panning information in the chart data,
+    # but volume data is possible.
+    # As a result, all volume flags will be stored in the chart data
+    # but the panning will be in the sound metadata.
+    sound_metadata_map, sound_metadata = generate_sound_metadata_map(sound_metadata, allocator, sounds['wav_filenames'], sounds['wav_volumes'], sounds['wav_pans'], is_drums=sounds['is_drums'])
+
+    if chart:
+        for k in chart['timestamp']:
+            for entry in chart['timestamp'][k]:
+                if entry['name'] == 'note':
+                    entry['data']['sound_id'] = sound_metadata_map.get(entry['data']['sound_id'], 0)
+
     # Remove any BGMs from the sound metadata
-    for bgm in bgm_info:
+    for bgm in sounds['bgm']['data']:
         remove_keys = []
         for k in sound_metadata['data']:
             if sound_metadata['data'][k]['filename'] == bgm['filename']:
                 remove_keys.append(k)
 
         for k in remove_keys:
-            del sound_metadata['data'][k]
+            allocator.remove(k)
+
+    sound_metadata_drum = [sound_metadata_map.get(x, 0) for x in sounds['drum']]
+    sound_metadata_guitar = [sound_metadata_map.get(x, 0) for x in sounds['guitar']]
 
     sound_metadata['drum'] = list(set(sound_metadata['drum'] + sound_metadata_drum))
     sound_metadata['guitar'] = list(set(sound_metadata['guitar'] + sound_metadata_guitar))
-    sound_metadata['bgm'] = {
-        'end': calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat) / 300,
-        'data': bgm_info
-    }
-    sound_metadata['preview'] = preview_filename
-    sound_metadata['defaults'] = default_notes
+    sound_metadata['bgm'] = sounds['bgm']
+    sound_metadata['preview'] = sounds['preview']
+    sound_metadata['defaults'] = {k: sound_metadata_map.get(sounds['defaults'][k], 0) for k in sounds['defaults']}
 
-    drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, lines)
-
-    return metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, sound_metadata
+    return sound_metadata
 
 
 def create_json_from_dtx(params):
@@ -1655,25 +1534,42 @@ def create_json_from_dtx(params):
     master_data = get_data('mst')
 
     sound_metadata = {'sound_folder': params['sound_folder'] if 'sound_folder' in params else "", 'preview': "", 'bgm': {}, 'data': {}, 'guitar': [], 'drum': [], 'defaults': {}}
+    allocator = SoundIdAllocator(sound_metadata['data'])
+
+    # Parse all of the files at the same time.
+    # The sound IDs are assigned afterwards in a fixed order by get_chart_data.
+    runner = jobs.get_runner()
 
-    def get_chart_data(data, sound_metadata, parts):
+    def parse_charts(data, parts):
+        parse_jobs = {}
+
+        for part in ['drum', 'guitar', 'bass']:
+            if part in parts and part in data and data[part]:
+                parse_jobs[part] = runner.submit(parse_dtx_to_intermediate, data[part], params, sound_metadata['sound_folder'], part)
+
+        return parse_jobs
+
+    def get_chart_data(parse_jobs, sound_metadata):
         metadatas = []
+        charts = {}
+
+        for idx, part in enumerate(['drum', 'guitar', 'bass']):
+            charts[part] = None
 
-        chart_drum = None
-        if "drum" in parts and 'drum' in data:
-            metadata1, chart_drum, _, _, sound_metadata = parse_dtx_to_intermediate(data['drum'], params, sound_metadata, "drum")
-            metadatas.append(metadata1)
+            if part not in parse_jobs:
+                continue
+
+            result = parse_jobs[part].result()
+            charts[part] = result[idx + 1]
 
-        chart_guitar = None
-        if "guitar" in parts and 'guitar' in data:
-            metadata2, _, chart_guitar, _, sound_metadata = parse_dtx_to_intermediate(data['guitar'], params, sound_metadata, "guitar")
-            metadatas.append(metadata2)
+            if result[4] is not None:
+                sound_metadata = merge_dtx_sounds(sound_metadata, allocator, result[4], charts[part])
 
-        chart_bass = None
-        if "bass" in parts and 'bass' in data:
-            metadata3, _,  _, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['bass'], params, sound_metadata, "bass")
-            metadatas.append(metadata3)
+            metadatas.append(result[0])
 
+        chart_drum = charts['drum']
+        chart_guitar = charts['guitar']
+        chart_bass = charts['bass']
         chart_open = None
         # if "open" in parts and 'open' in data:
         #     metadata4, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['open'], params, sound_metadata, "open")
@@ -1684,11 +1580,17 @@ def create_json_from_dtx(params):
 
         return metadata, chart_drum, chart_guitar, chart_bass, chart_open, sound_metadata
 
-    novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open, sound_metadata = get_chart_data(novice_data, sound_metadata, params['parts'])
-    basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open, sound_metadata = get_chart_data(basic_data, sound_metadata, params['parts'])
-    adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open, sound_metadata = get_chart_data(adv_data, sound_metadata, params['parts'])
-    ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open, sound_metadata = get_chart_data(ext_data, sound_metadata, params['parts'])
-    master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open, sound_metadata = get_chart_data(master_data, sound_metadata, params['parts'])
+    novice_jobs = parse_charts(novice_data, params['parts'])
+    basic_jobs = parse_charts(basic_data, params['parts'])
+    adv_jobs = parse_charts(adv_data, params['parts'])
+    ext_jobs = parse_charts(ext_data, params['parts'])
+    master_jobs = parse_charts(master_data, params['parts'])
+
+    novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open, sound_metadata = get_chart_data(novice_jobs, sound_metadata)
+    basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open, sound_metadata = get_chart_data(basic_jobs, sound_metadata)
+    adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open, sound_metadata = get_chart_data(adv_jobs, sound_metadata)
+    ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open, sound_metadata = get_chart_data(ext_jobs, sound_metadata)
+    master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open, sound_metadata = get_chart_data(master_jobs, sound_metadata)
 
     # Create sound metadata file
     # Any notes not in the drums or guitar sound metadata fields should be added to both just in case
@@ -1800,13 +1702,21 @@ def create_json_from_dtx(params):
         "preview": sound_metadata['preview'],
     }
 
-    return json.dumps(output_json, indent=4, sort_keys=True)
+    return output_json
 
 
 #########################
 #   DTX creation code   #
 #########################
 
+# Two character IDs used by DTX, values wrap around after ZZ
+DTX_BASE36_IDS = [base_repr(i, 36, padding=2).upper()[-2:] for i in range(36 * 36)]
+
+
+def to_base36(value):
+    return DTX_BASE36_IDS[value % len(DTX_BASE36_IDS)]
+
+
 def combine_charts(metadata, chart):
     chart_combined = copy.deepcopy(chart)
 
@@ -2107,7 +2017,40 @@ def generate_measure_beat_for_chart(chart_data):
     return chart_data
 
 
-def get_clipped_wav(sound_metadata, sound_entry, duration):
+class SoundEntryIndex:
+    # Lookups into sound_metadata['entries'] while generating a DTX chart.
+    # New entries must be added through add to keep the index valid.
+
+    def __init__(self, sound_metadata):
+        self.entries = sound_metadata['entries'] if sound_metadata and 'entries' in sound_metadata else []
+        self.sound_ids = {}  # sound ID -> first entry with that ID
+        self.clipped = {}  # (filename, duration) -> clipped entry
+        self.next_sound_id = 100  # Clipped WAVs get IDs after every existing sound
+
+        for entry in self.entries:
+            self.index_entry(entry)
+
+    def index_entry(self, entry):
+        self.sound_ids.setdefault(entry['sound_id'], entry)
+
+        if entry.get('clipped', False):
+            self.clipped.setdefault((entry['filename'], entry['duration']), entry)
+
+        if entry['sound_id'] >= self.next_sound_id:
+            self.next_sound_id = entry['sound_id'] + 1
+
+    def get(self, sound_id):
+        return self.sound_ids.get(sound_id, None)
+
+    def get_clipped(self, filename, duration):
+        return self.clipped.get((filename, duration), None)
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.index_entry(entry)
+
+
+def get_clipped_wav(sound_metadata, sound_index, sound_entry, duration):
     # Check if a clipped WAV exists of the same length
     # If one exists, return the existing entry
     # Otherwise return a newly created entry
@@ -2115,23 +2058,17 @@ def get_clipped_wav(sound_metadata, sound_entry, duration):
 
     duration = round(duration, 3) # Pydub only can handle 3 decimal places
 
-    for entry in sound_metadata['entries']:
-        if not entry.get('clipped', False):
-            continue
+    entry = sound_index.get_clipped(sound_entry['filename'], duration)
+    if entry:
+        return entry
 
-        if entry['filename'] == sound_entry['filename'] and entry['duration'] == duration:
-            return entry
-
-    next_sound_id = 100
-    for entry in sound_metadata['entries']:
-        if entry['sound_id'] >= next_sound_id:
-            next_sound_id = entry['sound_id'] + 1
+    next_sound_id = sound_index.next_sound_id
 
     clipped_wav_entry = copy.deepcopy(sound_entry)
     clipped_wav_entry['sound_id'] = next_sound_id
     clipped_wav_entry['clipped'] = True
     clipped_wav_entry['duration'] = duration
-    sound_metadata['entries'].append(clipped_wav_entry)
+    sound_index.add(clipped_wav_entry)
 
     if "NoFilename" not in sound_entry['flags']:
         orig_wav_filename = "%s.wav" % (sound_entry['filename'])
@@ -2150,13 +2087,34 @@ def get_clipped_wav(sound_metadata, sound_entry, duration):
     if not os.path.exists(orig_wav_filename):
         return None
 
-    audio.clip_audio(orig_wav_filename, wav_filename, duration)
+    # The WAVs are clipped by create_clipped_wavs after all of the charts are generated
+    if 'clip_requests' not in sound_metadata:
+        sound_metadata['clip_requests'] = {}
+
+    if orig_wav_filename not in sound_metadata['clip_requests']:
+        sound_metadata['clip_requests'][orig_wav_filename] = []
+
+    sound_metadata['clip_requests'][orig_wav_filename].append((wav_filename, duration))
 
     return clipped_wav_entry
 
 
+def create_clipped_wavs(sound_metadata):
+    if not sound_metadata or not sound_metadata.get('clip_requests', None):
+        return
+
+    # Each source WAV is decoded once for all of the clip lengths requested from it
+    runner = jobs.get_runner()
+    clip_jobs = [runner.submit(audio.clip_audio_multiple, k, v) for k, v in sound_metadata['clip_requests'].items()]
+    sound_metadata['clip_requests'] = {}
+
+    for job in clip_jobs:
+        job.result()
+
+
 def generate_dtx_info(chart_data, sound_metadata, game_type):
-    sound_keys = [""]
+    sound_keys = {"": 0}  # sound key -> WAV slot, slot 0 is never used
+    sound_index = SoundEntryIndex(sound_metadata)
 
     sound_files = {}
     volumes = {}
@@ -2184,14 +2142,12 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                     chart_data[measure][beat][idx]['data']['volume'] = 127
 
                 pan = 64  # Center
-                if sound_metadata and 'entries' in sound_metadata:
-                    for sound_entry in sound_metadata['entries']:
-                        if sound_entry['sound_id'] == cd['data']['sound_id']:
-                            if 'volume' in sound_entry:
-                                volume = sound_entry['volume']
-                            if 'pan' in sound_entry:
-                                pan = sound_entry['pan']
-                            break
+                sound_entry = sound_index.get(cd['data']['sound_id'])
+                if sound_entry:
+                    if 'volume' in sound_entry:
+                        volume = sound_entry['volume']
+                    if 'pan' in sound_entry:
+                        pan = sound_entry['pan']
 
                 pan_final = 0
                 if cd['data'].get('pan') != 64:
@@ -2249,56 +2205,46 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0x08] = ['00'] * beat_division
-                    d = dtx_info[measure][0x08]
-                    d[beat] = base_repr(len(bpms), 36, padding=2).upper()[-2:]
+                        dtx_info[measure][0x08] = DtxChannel(beat_division, {})
+                    d = dtx_info[measure][0x08].chips
+                    d[beat] = to_base36(len(bpms))
                     cur_bpm = cd['data']['bpm']
 
-                    dtx_info[measure][0x08] = d
-
                 elif cd['name'] == "barinfo":
-                    if measure in dtx_info and 0x02 not in dtx_info[measure]:
-                        dtx_info[measure][0x02] = {}
-
-                    dtx_info[measure][0x02] = ["{}".format(
+                    # Measure length, written as is
+                    dtx_info[measure][0x02] = "{}".format(
                         cd['time_signature']['numerator'] / cd['time_signature']['denominator']
-                    )]
+                    )
 
                 elif cd['name'] == "baron":
                     if measure in dtx_info and 0xc2 not in dtx_info[measure]:
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0xc2] = ['00'] * beat_division
+                        dtx_info[measure][0xc2] = DtxChannel(beat_division, {})
 
-                    d = dtx_info[measure][0xc2]
-                    d[beat] = base_repr(0x01, 36, padding=2).upper()[-2:]
-
-                    dtx_info[measure][0xc2] = d
+                    d = dtx_info[measure][0xc2].chips
+                    d[beat] = to_base36(0x01)
 
                 elif cd['name'] == "baroff":
                     if measure in dtx_info and 0xc2 not in dtx_info[measure]:
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0xc2] = ['00'] * beat_division
-
-                    d = dtx_info[measure][0xc2]
-                    d[beat] = base_repr(0x02, 36, padding=2).upper()[-2:]
+                        dtx_info[measure][0xc2] = DtxChannel(beat_division, {})
 
-                    dtx_info[measure][0xc2] = d
+                    d = dtx_info[measure][0xc2].chips
+                    d[beat] = to_base36(0x02)
 
                 elif cd['name'] == "endpos":
                     if measure in dtx_info and 0xc2 not in dtx_info[measure]:
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][0xc2] = ['00'] * beat_division
+                        dtx_info[measure][0xc2] = DtxChannel(beat_division, {})
 
-                    d = dtx_info[measure][0xc2]
-                    #d[beat] = base_repr(0x03, 36, padding=2).upper()[-2:]
-
-                    dtx_info[measure][0xc2] = d
+                    d = dtx_info[measure][0xc2].chips
+                    #d[beat] = to_base36(0x03)
 
                 elif cd['name'] in ["_note_start", "_note_release"]:
                     # This is an automatically generated event based on
@@ -2309,22 +2255,16 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][longnote_field] = ['00'] * beat_division
-
-                    d = dtx_info[measure][longnote_field]
-                    d[beat] = base_repr(0x01, 36, padding=2).upper()[-2:]
+                        dtx_info[measure][longnote_field] = DtxChannel(beat_division, {})
 
-                    dtx_info[measure][longnote_field] = d
+                    d = dtx_info[measure][longnote_field].chips
+                    d[beat] = to_base36(0x01)
 
                 elif cd['name'] == "note":
                     if is_mutable_sound and last_sound_was_mutable:
                         # Sound id >= 100
                         # Only one mutable sound can be played at once
-                        sound_entry = None
-                        if sound_metadata and 'entries' in sound_metadata:
-                            for sound_entry in sound_metadata['entries']:
-                                if sound_entry['sound_id'] == last_played_note['data']['data']['sound_id']:
-                                    break
+                        sound_entry = sound_index.get(last_played_note['data']['data']['sound_id'])
 
                         if sound_entry:
                             time_diff = (int(cd['timestamp']) - int(last_played_note['data']['timestamp'])) / 300
@@ -2332,14 +2272,14 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                             if time_diff < sound_entry['duration']:
                                 # Set last_played_note['data']['sound_id'] to new sound id of clipped WAV
                                 # Create list of WAVs to be clipped once parsing is done
-                                clipped_wav_metadata = get_clipped_wav(sound_metadata, sound_entry, time_diff)
+                                clipped_wav_metadata = get_clipped_wav(sound_metadata, sound_index, sound_entry, time_diff)
 
                                 if clipped_wav_metadata:
                                     prev_sound_id = last_played_note['data']['data']['sound_id']
                                     last_played_note['data']['data']['sound_id'] = clipped_wav_metadata['sound_id']
 
                                     mapped_note = dtx_mapping[last_played_note['data']['data']['note']]
-                                    d = dtx_info[last_played_note['measure']][mapped_note]
+                                    d = dtx_info[last_played_note['measure']][mapped_note].chips
 
                                     # TODO: Refactor so this and the next instance of the same code are in their own function
                                     sound_key = "%04d_%03d_%03d" % (
@@ -2355,26 +2295,25 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                                     )
 
                                     if sound_key not in sound_keys:
-                                        sound_keys.append(sound_key)
-                                        sound_id = sound_keys.index(sound_key)
-                                        prev_sound_id = sound_keys.index(prev_sound_key)
+                                        sound_keys[sound_key] = len(sound_keys)
+                                        sound_id = sound_keys[sound_key]
+                                        prev_sound_id = sound_keys[prev_sound_key]
 
                                         sound_files[sound_id] = last_played_note['data']['data']['sound_id']
                                         volumes[sound_id] = volumes[prev_sound_id]
                                         pans[sound_id] = pans[prev_sound_id]
 
-                                    sound_id = sound_keys.index(sound_key)
-                                    d[last_played_note['beat']] = base_repr(sound_id, 36, padding=2).upper()[-2:]
-                                    dtx_info[last_played_note['measure']][mapped_note] = d
+                                    sound_id = sound_keys[sound_key]
+                                    d[last_played_note['beat']] = to_base36(sound_id)
 
                     mapped_note = dtx_mapping[cd['data']['note']]
 
                     # Fix mapped note for autoplay sounds
                     if mapped_note in auto_play_ranges:
                         while measure in dtx_info and mapped_note in dtx_info[measure]:
-                            d = dtx_info[measure][mapped_note]
+                            d = dtx_info[measure][mapped_note].chips
 
-                            if d[beat] != "00" and mapped_note in auto_play_ranges:
+                            if d.get(beat, "00") != "00" and mapped_note in auto_play_ranges:
                                 if auto_play_ranges.index(mapped_note) + 1 >= len(auto_play_ranges):
                                     print("Ran out of auto play spaces")
                                     exit(1)
@@ -2388,9 +2327,9 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                         numerator = cd['time_signature']['numerator']
                         denominator = cd['time_signature']['denominator']
                         beat_division = int((1920 / denominator) * numerator)
-                        dtx_info[measure][mapped_note] = ['00'] * beat_division
+                        dtx_info[measure][mapped_note] = DtxChannel(beat_division, {})
 
-                    d = dtx_info[measure][mapped_note]
+                    d = dtx_info[measure][mapped_note].chips
 
                     if 'auto_volume' in cd['data']:
                         if 'auto_note' not in cd['data'] or cd['data'].get('auto_note') == 1:
@@ -2405,17 +2344,16 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                     )
 
                     if sound_key not in sound_keys:
-                        sound_keys.append(sound_key)
-                        sound_id = sound_keys.index(sound_key)
+                        sound_keys[sound_key] = len(sound_keys)
+                        sound_id = sound_keys[sound_key]
                         sound_files[sound_id] = cd['data']['sound_id']
                         volumes[sound_id] = cd['data']['volume']
                         pans[sound_id] = cd['data']['pan']
 
                     #print(measure, len(d), beat, cd['time_signature'], cur_bpm)
 
-                    sound_id = sound_keys.index(sound_key)
-                    d[beat] = base_repr(sound_id, 36, padding=2).upper()[-2:]
-                    dtx_info[measure][mapped_note] = d
+                    sound_id = sound_keys[sound_key]
+                    d[beat] = to_base36(sound_id)
 
                     # Wail support
                     if 'guitar_special' in cd['data'] and cd['data']['guitar_special'] & 0x01:
@@ -2433,13 +2371,11 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                             denominator = cd['time_signature']['denominator']
                             timesig = numerator / denominator
                             beat_division = int(1920 * timesig)
-                            dtx_info[measure][wail_field] = ['00'] * beat_division
+                            dtx_info[measure][wail_field] = DtxChannel(beat_division, {})
 
-                        wail_d = dtx_info[measure][wail_field]
+                        wail_d = dtx_info[measure][wail_field].chips
                         wail_d[beat] = d[beat]
 
-                        dtx_info[measure][wail_field] = wail_d
-
                     # Bonus note support
                     if cd['data'].get('bonus_note') and cd['data']['note'] in dtx_bonus_mapping:
                         bonus_note_lane = 0x4f
@@ -2449,17 +2385,15 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
                                 numerator = cd['time_signature']['numerator']
                                 denominator = cd['time_signature']['denominator']
                                 beat_division = int((1920 / denominator) * numerator)
-                                dtx_info[measure][bonus_note_lane] = ['00'] * beat_division
+                                dtx_info[measure][bonus_note_lane] = DtxChannel(beat_division, {})
 
-                            bonus_d = dtx_info[measure][bonus_note_lane]
+                            bonus_d = dtx_info[measure][bonus_note_lane].chips
 
-                            if bonus_d[beat] != "00":
+                            if bonus_d.get(beat, "00") != "00":
                                 bonus_note_lane -= 1
                                 continue
 
                             bonus_d[beat] = base_repr(dtx_bonus_mapping[cd['data']['note']], 16, padding=2).upper()[-2:]
-
-                            dtx_info[measure][bonus_note_lane] = bonus_d
                             break
 
                         if bonus_note_lane < 0x4c:
@@ -2534,7 +2468,7 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
 
     # TODO:BPMωꍇBPMxxo͂ȂABPM`bvzuȂ
     for i in range(0, len(bpms)):
-        output.append("#BPM%s %s" % (base_repr(i+1, 36, padding=2).upper()[-2:], bpms[i]))
+        output.append("#BPM%s %s" % (to_base36(i+1), bpms[i]))
 
     for k in sorted(sound_files.keys()):
         wav_filename = "%04x.wav" % sound_files[k]
@@ -2552,7 +2486,7 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
 
                 break
 
-        output.append("#WAV%s %s" % (base_repr(int(k), 36, padding=2).upper()[-2:], wav_filename))
+        output.append("#WAV%s %s" % (to_base36(int(k)), wav_filename))
 
     bgm_filename = "bgm.wav"
     if 'level' in orig_chart_data['header']:
@@ -2579,11 +2513,11 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
     
     # TODO:VOLUMEl0ȂYPANo͂Ȃ
     for k in sorted(volumes.keys()):
-        output.append("#VOLUME%s %d" % (base_repr(int(k), 36, padding=2).upper()[-2:], volumes[k]))
+        output.append("#VOLUME%s %d" % (to_base36(int(k)), volumes[k]))
 
     # TODO:PANl0ȂYPANo͂Ȃ
     for k in sorted(pans.keys()):
-        output.append("#PAN%s %d" % (base_repr(int(k), 36, padding=2).upper()[-2:], pans[k]))
+        output.append("#PAN%s %d" % (to_base36(int(k)), pans[k]))
 
     output.append("") # 2019.8.19 R-DAISUKE s
     
@@ -2593,11 +2527,103 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
 
     output.append("#00001: ZZ")
     output.append("#00054: ZZ")
+
+    # The chip rows are only turned into text while writing the file, see write_dtx_chart
+    return {
+        'header': output,
+        'dtx_info': carry_overflowing_chips(dtx_info),
+    }
+
+
+def get_measure_length(dtx_info, measure, default):
+    # Every row in a measure uses the measure's time signature
+    for key in dtx_info.get(measure, {}):
+        if key != 0x02:
+            return dtx_info[measure][key].length
+
+    if 0x02 in dtx_info.get(measure, {}):
+        return int(1920 * float(dtx_info[measure][0x02]))
+
+    return default
+
+
+def carry_overflowing_chips(dtx_info):
+    # Rounding can place a chip at or past the end of its measure, or before its start,
+    # so move those chips into the measure they actually land in
+    measure = min(dtx_info.keys(), default=0)
+    while measure <= max(dtx_info.keys(), default=0):
+        for key in list(dtx_info.get(measure, {}).keys()):
+            if key == 0x02:
+                continue
+
+            row = dtx_info[measure][key]
+            for beat in sorted([x for x in row.chips if x >= row.length]):
+                next_length = get_measure_length(dtx_info, measure + 1, row.length)
+
+                if measure + 1 not in dtx_info:
+                    dtx_info[measure + 1] = {}
+
+                if key not in dtx_info[measure + 1]:
+                    dtx_info[measure + 1][key] = DtxChannel(next_length, {})
+
+                dtx_info[measure + 1][key].chips.setdefault(beat - row.length, row.chips[beat])
+                del row.chips[beat]
+
+        measure += 1
+
+    for measure in sorted(dtx_info.keys(), reverse=True):
+        if measure - 1 not in dtx_info:
+            continue
+
+        for key in list(dtx_info[measure].keys()):
+            if key == 0x02:
+                continue
+
+            row = dtx_info[measure][key]
+            for beat in sorted([x for x in row.chips if x < 0], reverse=True):
+                prev_length = get_measure_length(dtx_info, measure - 1, row.length)
+
+                if key not in dtx_info[measure - 1]:
+                    dtx_info[measure - 1][key] = DtxChannel(prev_length, {})
+
+                dtx_info[measure - 1][key].chips.setdefault(beat + prev_length, row.chips[beat])
+                del row.chips[beat]
+
+    return dtx_info
+
+
+def get_dtx_row(row):
+    # Use the lowest resolution that can still place every chip on its beat
+    step = row.length
+    for beat in row.chips:
+        if beat < 0 or beat >= row.length:
+            raise Exception("Chip at beat %d is outside of its measure (length %d)" % (beat, row.length))
+
+        step = math.gcd(step, beat)
+
+    if step == 0:
+        return "00"
+
+    data = ['00'] * (row.length // step)
+    for beat in row.chips:
+        data[beat // step] = row.chips[beat]
+
+    return "".join(data)
+
+
+def write_dtx_chart(outfile, chart_data):
+    outfile.write("\n".join(chart_data['header']))
+
+    dtx_info = chart_data['dtx_info']
     for measure in sorted(dtx_info.keys(), key=lambda x: int(x)):
         for key in sorted(dtx_info[measure].keys(), key=lambda x: int(x)):
-            output.append("#%03d%02X: %s" % (measure, key, "".join(dtx_info[measure][key])))
+            if key == 0x02:
+                # Measure length
+                row = dtx_info[measure][key]
+            else:
+                row = get_dtx_row(dtx_info[measure][key])
 
-    return "\n".join(output)
+            outfile.write("\n#%03d%02X: %s" % (measure, key, row))
 
 
 def get_metadata_chart(charts):
@@ -2619,9 +2645,8 @@ def get_charts_data(charts, sound_metadata, params):
 
 
 def create_dtx_from_json(params):
-    dtx_data = params.get('input', None)
+    json_dtx = params.get('input', None)
     sound_folder = params.get('sound_folder', None)
-    json_dtx = json.loads(dtx_data)
 
     output_folder = params.get('output', None)
     if output_folder and not os.path.exists(output_folder):
@@ -2632,6 +2657,7 @@ def create_dtx_from_json(params):
     charts_data = get_charts_data(json_dtx['charts'], sound_metadata, params)
     create_dtx_files(json_dtx, params, charts_data)
     create_set_definition_file(json_dtx, params, charts_data)
+    create_clipped_wavs(sound_metadata)
 
     return None
 
@@ -2662,7 +2688,7 @@ def create_dtx_files(json_dtx, params, charts_data):
             output_filename = os.path.join(output_folder, output_filename)
 
         with open(output_filename, "w", encoding="shift-jis") as f:
-            f.write(x['data'])
+            write_dtx_chart(f, x['data'])
 
 
 def create_set_definition_file(json_dtx, params, charts_data):
@@ -2701,16 +2727,23 @@ class DtxFormat:
 
     @staticmethod
     def to_json(params):
-        return create_json_from_dtx(params)
+        return intermediate.to_json(create_json_from_dtx(params))
+
+    @staticmethod
+    def to_intermediate(params):
+        return intermediate.normalize(create_json_from_dtx(params))
 
     @staticmethod
     def to_chart(params):
+        return create_dtx_from_json(dict(params, input=intermediate.from_json(params.get('input'))))
+
+    @staticmethod
+    def from_intermediate(params):
         return create_dtx_from_json(params)
 
     @staticmethod
     def is_format(filename):
-        # How to determine a DTX?
-        return False
+        return plugins.is_format("DTX", filename)
 
 
 def get_class():
@@ -1,6 +1,9 @@
 import json
 import os
 
+import intermediate
+import plugins
+
 
 class JsonFormat:
     @staticmethod
@@ -9,7 +12,10 @@ class JsonFormat:
 
     @staticmethod
     def to_json(params):
-        input_filename = os.path.join(params.get('input'), "output.json")
+        input_filename = params.get('input')
+
+        if input_filename and os.path.isdir(input_filename):
+            input_filename = os.path.join(input_filename, "output.json")
 
         if not input_filename or not os.path.exists(input_filename):
             return None
@@ -17,6 +23,10 @@ class JsonFormat:
         with open(input_filename, "rb") as f:
             return f.read()
 
+    @staticmethod
+    def to_intermediate(params):
+        return intermediate.from_json(JsonFormat.to_json(params))
+
     @staticmethod
     def to_chart(params):
         output_filename = os.path.join(params.get('output', ""), "output.json")
@@ -24,9 +34,15 @@ class JsonFormat:
         with open(output_filename, "w") as f:
             f.write(params.get('input', ""))
 
+    @staticmethod
+    def from_intermediate(params):
+        # Only serialize to text when JSON is the actual output format.
+        # The intermediate data is already sorted by normalize()
+        JsonFormat.to_chart(dict(params, input=intermediate.to_json(params.get('input'), sort_keys=False)))
+
     @staticmethod
     def is_format(filename):
-        return False
+        return plugins.is_format("JSON", filename)
 
 
 def get_class():
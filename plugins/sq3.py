@@ -3,12 +3,13 @@ import json
 import os
 import shutil
 import struct
-import threading
 from lxml import etree
 from lxml.builder import E
 import uuid
 
 import helper
+import intermediate
+import jobs
 import mdb
 import eamxml
 import audio
@@ -16,9 +17,9 @@ import vas3tool
 import wavbintool
 import tmpfile
 
+import plugins
 import plugins.wav as wav
 
-USE_THREADS = True
 
 EVENT_ID_MAP = {
     0x01: "bpm",
@@ -448,38 +449,40 @@ def get_note_counts_from_json(chart, part):
     return {'total': total_notes, 'notes': note_counts}
 
 
+def render_bgm_file(params_bgm, output_bgm_filename):
+    wav.generate_wav_from_json(params_bgm, generate_output_filename=False)
+    wavbintool.parse_wav(params_bgm['output'], output_bgm_filename)
+
+
+def merge_bgm_file(bgm_info, sound_folder, output_bgm_filename):
+    # Create BGM file render
+    merged_wav_filename = audio.merge_bgm(bgm_info, sound_folder)
+    wavbintool.parse_wav(merged_wav_filename, output_bgm_filename)
+
+
+def copy_missing_bgms(output_bgm_filename, all_bgm_filenames):
+    for alt_bgm_filename in all_bgm_filenames:
+        if not os.path.exists(alt_bgm_filename):
+            shutil.copy(output_bgm_filename, alt_bgm_filename)
+
+
 def create_preview(json_sq3, params, part):
     print("Creating preview file", part)
 
-    running_threads = []
     output_folder = params['output']
 
     filename = os.path.join(output_folder,
                             "i%04d%s.bin" % (json_sq3['musicid'], part))
 
     if not os.path.exists(os.path.join(params['sound_folder'], json_sq3['preview'])):
-        return []
-
-    if USE_THREADS:
-        bgm_thread = threading.Thread(target=wavbintool.parse_wav,
-                                      args=(os.path.join(params['sound_folder'],
-                                            json_sq3['preview']),
-                                            filename))
-        bgm_thread.start()
-        running_threads.append(bgm_thread)
-    else:
-        wavbintool.parse_wav(os.path.join(params['sound_folder'],
-                             json_sq3['preview']),
-                             filename)
+        return None
 
-    return running_threads
+    return jobs.get_runner().submit(wavbintool.parse_wav,
+                                    os.path.join(params['sound_folder'], json_sq3['preview']),
+                                    filename)
 
 
 def create_bgm_render(json_sq3, params, target_parts, output_bgm_filename):
-    def _create_bgm_render(params_bgm, target_parts, output_bgm_filename):
-        wav.generate_wav_from_json(params_bgm, generate_output_filename=False)
-        wavbintool.parse_wav(params_bgm['output'], output_bgm_filename)
-
     print("Creating BGM render", target_parts)
 
     params_bgm = copy.deepcopy(params)
@@ -495,70 +498,30 @@ def create_bgm_render(json_sq3, params, target_parts, output_bgm_filename):
     params_bgm['parts'] = target_parts
     params_bgm['difficulty'] = ['max']
 
-    running_threads = []
-
-    if USE_THREADS:
-        bgm_thread = threading.Thread(target=_create_bgm_render,
-                                      args=(params_bgm,
-                                            target_parts,
-                                            output_bgm_filename))
-        bgm_thread.start()
-        running_threads.append(bgm_thread)
-    else:
-        _create_bgm_render(params_bgm, target_parts, output_bgm_filename)
-
-    return running_threads
+    return jobs.get_runner().submit(render_bgm_file, params_bgm, output_bgm_filename)
 
 
 def create_bgm(json_sq3, params, output_bgm_filename):
-    def _create_bgm(bgm_filename, sound_folder, output_bgm_filename):
-        # Create BGM file render
-        merged_wav_filename = audio.merge_bgm(bgm_filename, sound_folder)
-        wavbintool.parse_wav(merged_wav_filename, output_bgm_filename)
-
     print("Creating BGM file")
 
-    running_threads = []
-
-    if USE_THREADS:
-        bgm_thread = threading.Thread(target=_create_bgm,
-                                      args=(json_sq3['bgm'],
-                                            params['sound_folder'],
-                                            output_bgm_filename))
-        bgm_thread.start()
-        running_threads.append(bgm_thread)
-    else:
-        _create_bgm(json_sq3['bgm'], params['sound_folder'], output_bgm_filename)
-
-    return running_threads
+    return jobs.get_runner().submit(merge_bgm_file, json_sq3['bgm'], params['sound_folder'], output_bgm_filename)
 
 
 def create_va3(json_sq3, params, part):
     print("Creating VA3 archive")
 
-    running_threads = []
-
     if part not in json_sq3['sound_metadata']:
-        return []
+        return None
 
     output_folder = params['output']
 
     va3_filename = "spu%04d%s.va3" % (json_sq3['musicid'], part[0])
     output_filename = os.path.join(output_folder, va3_filename)
 
-    if USE_THREADS:
-        va3_thread = threading.Thread(target=vas3tool.write_vas3,
-                                      args=(params['sound_folder'],
-                                            output_filename,
-                                            json_sq3['sound_metadata'][part]))
-        va3_thread.start()
-        running_threads.append(va3_thread)
-    else:
-        vas3tool.write_vas3(params['sound_folder'],
-                            output_filename,
-                            json_sq3['sound_metadata'][part])
-
-    return running_threads
+    return jobs.get_runner().submit(vas3tool.write_vas3,
+                                    params['sound_folder'],
+                                    output_filename,
+                                    json_sq3['sound_metadata'][part])
 
 
 def create_event_file(json_sq3, params, charts):
@@ -872,7 +835,7 @@ def create_sq3_file(json_sq3, params, target_parts, charts_data):
 
 
 def create_sound_files(json_sq3, params, target_parts):
-    running_threads = []
+    bgm_jobs = []
     output_folder = params['output']
 
     # Make audio files here if sound_metadata exists?
@@ -883,33 +846,28 @@ def create_sound_files(json_sq3, params, target_parts):
 
         # Create sound archives
         output_bgm_filename = os.path.join(output_folder, 'bgm%04d___k.bin' % (json_sq3['musicid']))
-        running_threads += create_bgm(json_sq3, params, output_bgm_filename)
+        bgm_jobs.append(create_bgm(json_sq3, params, output_bgm_filename))
 
         if params.get('generate_bgms', False):
             if 'guitar' in target_parts or 'bass' in target_parts:
-                running_threads += create_bgm_render(json_sq3, params, ['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq3['musicid'])))
-                running_threads += create_bgm_render(json_sq3, params, ['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq3['musicid'])))
+                bgm_jobs.append(create_bgm_render(json_sq3, params, ['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq3['musicid']))))
+                bgm_jobs.append(create_bgm_render(json_sq3, params, ['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq3['musicid']))))
 
             if 'drum' in target_parts:
-                running_threads += create_bgm_render(json_sq3, params, ['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq3['musicid'])))
+                bgm_jobs.append(create_bgm_render(json_sq3, params, ['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq3['musicid']))))
 
-            running_threads += create_bgm_render(json_sq3, params, ['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq3['musicid'])))
+            bgm_jobs.append(create_bgm_render(json_sq3, params, ['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq3['musicid']))))
 
         if 'drum' in target_parts:
-            running_threads += create_va3(json_sq3, params, 'drum')
+            create_va3(json_sq3, params, 'drum')
 
         elif 'guitar' in target_parts or 'bass' in target_parts:
-            running_threads += create_va3(json_sq3, params, 'guitar')
+            create_va3(json_sq3, params, 'guitar')
 
         # Create preview files
         if json_sq3.get('preview', None):
-            running_threads += create_preview(json_sq3, params, 'dm')
-            running_threads += create_preview(json_sq3, params, 'gf')
-
-        if USE_THREADS:
-            # Wait for threads to finish so the BGMs can be copied as required
-            for thread in running_threads:
-                thread.join()
+            create_preview(json_sq3, params, 'dm')
+            create_preview(json_sq3, params, 'gf')
 
         # Create missing BGMs if needed
         all_bgm_filenames = [
@@ -920,20 +878,12 @@ def create_sound_files(json_sq3, params, target_parts):
             os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq3['musicid'])),
         ]
 
-        for alt_bgm_filename in all_bgm_filenames:
-            if os.path.exists(alt_bgm_filename):
-                continue
-
-            if not os.path.exists(alt_bgm_filename):
-                shutil.copy(output_bgm_filename, alt_bgm_filename)
-
-    if USE_THREADS:
-        for thread in running_threads:
-            thread.join()
+        # The BGMs have to exist before they can be copied
+        jobs.get_runner().submit(copy_missing_bgms, output_bgm_filename, all_bgm_filenames, depends=bgm_jobs, io=True)
 
 
 def generate_sq3_file_from_json(params):
-    json_sq3 = json.loads(params['input']) if 'input' in params else None
+    json_sq3 = params['input'] if 'input' in params else None
 
     if not json_sq3:
         print("Couldn't find input data")
@@ -1307,13 +1257,7 @@ def parse_chart_intermediate(chart, events):
 
 
 def add_song_info(charts, music_id, music_db):
-    song_info = None
-
-    if music_db and music_db.endswith(".csv") or not music_db:
-        song_info = mdb.get_song_info_from_csv(music_db if music_db else "gitadora_music.csv", music_id)
-
-    if song_info is None or music_db and music_db.endswith(".xml") or not music_db:
-        song_info = mdb.get_song_info_from_mdb(music_db if music_db else "mdb_xg.xml", music_id)
+    song_info = mdb.get_song_info(music_id, music_db)
 
     for chart_idx in range(len(charts)):
         chart = charts[chart_idx]
@@ -1485,7 +1429,7 @@ def generate_json_from_sq3(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Sq3Format:
@@ -1495,26 +1439,23 @@ class Sq3Format:
 
     @staticmethod
     def to_json(params):
-        return generate_json_from_sq3(params)
+        return intermediate.to_json(generate_json_from_sq3(params))
+
+    @staticmethod
+    def to_intermediate(params):
+        return intermediate.normalize(generate_json_from_sq3(params))
 
     @staticmethod
     def to_chart(params):
+        generate_sq3_file_from_json(dict(params, input=intermediate.from_json(params.get('input'))))
+
+    @staticmethod
+    def from_intermediate(params):
         generate_sq3_file_from_json(params)
 
     @staticmethod
     def is_format(filename):
-        header = open(filename, "rb").read(0x40)
-
-        try:
-            is_seqp = header[0x00:0x04].decode('ascii') == "SEQP"
-            is_sq3t = header[0x30:0x34].decode('ascii') == "SQ3T"
-            is_ver3 = header[0x36] == 0x03
-            if is_seqp and is_ver3 and is_sq3t:
-                return True
-        except:
-            return False
-
-        return False
+        return plugins.is_format("SQ3", filename)
 
 
 def get_class():
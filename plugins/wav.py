@@ -10,9 +10,8 @@ import tmpfile
 import audio
 import wavbintool
 import helper
-
-import imageio
-imageio.plugins.ffmpeg.download()
+import intermediate
+import plugins
 
 
 def percentage_to_db(percentage):
@@ -280,7 +279,7 @@ def get_bgm_filename(json_data, chart_data, input_foldername):
 
 
 def generate_wav_from_json(params, generate_output_filename=True):
-    input_json = params.get('input')
+    json_data = params.get('input')
     input_foldername = params.get('sound_folder')
     output_filename = params.get('output')
 
@@ -293,10 +292,9 @@ def generate_wav_from_json(params, generate_output_filename=True):
 
         params['render_ext'] = ext
 
-    if not input_json:
+    if not json_data:
         raise Exception("Couldn't find input data")
 
-    json_data = json.loads(input_json)
     selected_difficulty = get_selected_difficulty(json_data, params)
 
     if not selected_difficulty:
@@ -365,7 +363,12 @@ def generate_wav_from_json(params, generate_output_filename=True):
     for bgm in bgms:
         output_audio = output_audio.overlay(bgm)
 
-    output_audio.export(params['output'], format=params.get('render_ext', "mp3"), tags={}, bitrate=params.get('render_quality', '320k'))
+    render_ext = params.get('render_ext', "mp3")
+
+    if render_ext.lower() != "wav":
+        helper.get_ffmpeg_path()
+
+    output_audio.export(params['output'], format=render_ext, tags={}, bitrate=params.get('render_quality', '320k'))
 
 class WavFormat:
     @staticmethod
@@ -374,11 +377,15 @@ class WavFormat:
 
     @staticmethod
     def to_chart(params):
+        return generate_wav_from_json(dict(params, input=intermediate.from_json(params.get('input'))))
+
+    @staticmethod
+    def from_intermediate(params):
         return generate_wav_from_json(params)
 
     @staticmethod
     def is_format(filename):
-        return False
+        return plugins.is_format("WAV", filename)
 
 
 def get_class():
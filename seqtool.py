@@ -1,40 +1,37 @@
 # Gitadora Re:evolve SQ3 format
 import argparse
+import concurrent.futures
+import copy
 import glob
-import importlib
 import json
 import os
 import shutil
 import sys
-import threading
+import time
 
+import helper
+import jobs
 import tmpfile
 
-import wavbintool
-import vas3tool
-import ifs
-import eamxml
-import event
-
 import plugins
 
-running_threads = []
-
 def find_handler(input_filename, input_format):
-    formats = [importlib.import_module('plugins.' + name).get_class() for name in plugins.__all__]
+    # Only the plugin that gets picked is imported
+    info = None
 
-    for handler in formats:
-        if input_format is not None and handler.get_format_name().lower() == input_format.lower():
-            return handler
-        elif input_filename is not None and handler.is_format(input_filename):
-            return handler
+    if input_format is not None:
+        info = plugins.get_plugin_info(input_format)
 
-    return None
+    if info is None and input_filename is not None:
+        info = plugins.detect_format(input_filename)
+
+    if info is None:
+        return None
 
+    return plugins.load_plugin(info)
 
-def filter_charts(json_data, params):
-    json_data = json.loads(json_data)
 
+def filter_charts(json_data, params):
     if 'charts' not in json_data:
         return json_data
 
@@ -73,7 +70,7 @@ def filter_charts(json_data, params):
     for chart in filtered_charts:
         json_data['charts'].remove(chart)
 
-    return json.dumps(json_data, indent=4)
+    return json_data
 
 
 def process_file(params):
@@ -100,7 +97,13 @@ def process_file(params):
 
     print("Using {} handler to process this file...".format(input_handler.get_format_name()))
 
-    json_data = input_handler.to_json(params)
+    # Charts are passed to the output handler as objects, text JSON is only
+    # generated when the JSON handler is the output format
+    json_data = input_handler.to_intermediate(params)
+
+    if json_data is None:
+        print("Couldn't read input data")
+        exit(1)
 
     # Filter based on difficulty and parts here
     json_data = filter_charts(json_data, params)
@@ -109,7 +112,17 @@ def process_file(params):
         os.makedirs(params['output'])
 
     params['input'] = json_data
-    output_handler.to_chart(params)
+    output_handler.from_intermediate(params)
+
+
+def read_event_file(filename):
+    if not filename:
+        return {}
+
+    import eamxml
+    import event
+
+    return event.get_bonus_notes_by_timestamp(eamxml.get_raw_xml(open(filename, "rb").read()))
 
 
 def get_sound_metadata(sound_folder):
@@ -125,6 +138,484 @@ def get_sound_metadata(sound_folder):
     return None
 
 
+def convert_ifs(args, runner):
+    # Archive and audio tools are only needed when working with IFS input
+    import wavbintool
+    import vas3tool
+    import ifs
+    import eamxml
+    import event
+
+    if args.ifs_cache:
+        ifs.enable_cache(args.ifs_cache * 1024 * 1024)
+
+    # Only the members that are needed are extracted from IFS files
+    if os.path.isdir(args.input_ifs_seq):
+        seq_archive = None
+        filenames = glob.glob(args.input_ifs_seq + "/*")
+    else:
+        seq_archive = ifs.IfsReader(args.input_ifs_seq)
+        filenames = seq_archive.list()
+
+    def read_seq_file(filename):
+        return seq_archive.read(filename) if seq_archive else open(filename, "rb").read()
+
+    # Try to match charts with sound files, then extract as required
+    guitar = {}
+    drum = {}
+    for filename in filenames:
+        base_filename = os.path.basename(filename)
+
+        target_charts = [".sq3", ".sq2"]
+        target_events = [".ev2", ".evt"]
+        if args.ifs_target:
+            if args.ifs_target.lower() == "sq2":
+                target_charts = [".sq2"]
+                target_events = [".evt", ".ev2"]
+            elif args.ifs_target.lower() == "sq3":
+                target_charts = [".sq3"]
+                target_events = [".ev2", ".evt"]
+            else:
+                raise Exception("Invalid IFS target selected")
+
+        if base_filename[-4:] in target_charts:
+            if base_filename[0] == 'd':
+                drum['seq'] = filename
+            elif base_filename[0] == 'g':
+                guitar['seq'] = filename
+        elif base_filename[-4:] == ".va3" and not args.no_sounds:
+            if base_filename[-5] == 'd':
+                drum['sound'] = filename
+            elif base_filename[-5] == 'g':
+                guitar['sound'] = filename
+        elif base_filename[-4:] in target_events:
+            # Give priority to the events file at the top of the list
+            if base_filename[-4:] != target_events[0] and 'events' in drum:
+                continue
+
+            event_xml = eamxml.get_raw_xml(read_seq_file(filename))
+
+            if len(event_xml) > 0:
+                events = event.get_bonus_notes_by_timestamp(event_xml)
+                drum['events'] = events
+                guitar['events'] = events
+
+    if seq_archive:
+        for file_set in [drum, guitar]:
+            for k in ['seq', 'sound']:
+                if k in file_set:
+                    file_set[k] = seq_archive.extract(file_set[k])
+
+    if args.sound_folder:
+        sound_folder = args.sound_folder
+    elif args.output:
+        sound_folder = args.output
+    else:
+        sound_folder = tmpfile.mkdtemp(prefix="sounds")
+
+    if not os.path.exists(sound_folder) and not args.no_sounds:
+        os.makedirs(sound_folder)
+
+    if args.input_ifs_bgm:
+        if os.path.isdir(args.input_ifs_bgm):
+            bgm_archive = None
+            filenames_bgm = glob.glob(args.input_ifs_bgm + "/*.bin")
+        else:
+            bgm_archive = ifs.IfsReader(args.input_ifs_bgm)
+            filenames_bgm = [x for x in bgm_archive.list() if x.endswith(".bin")]
+
+    if args.input_ifs_bgm and args.copy_raw_files:
+        if not os.path.exists(args.output):
+            os.makedirs(args.output)
+
+        for filename in filenames_bgm:
+            output_filename = os.path.join(args.output, os.path.basename(filename))
+
+            if bgm_archive:
+                bgm_archive.extract(filename, args.output)
+            else:
+                shutil.copy2(filename, output_filename)
+
+    bgm_jobs = []
+    if args.input_ifs_bgm and not args.no_sounds:
+        if bgm_archive:
+            filenames_bgm = [bgm_archive.extract(x) for x in filenames_bgm]
+
+        for filename in filenames_bgm:
+            # Convert to WAV
+            output_filename = filename.replace(".bin", ".wav")
+            output_filename = os.path.join(sound_folder, os.path.basename(filename).replace(".bin", ".wav"))
+
+            print("Converting %s..." % output_filename)
+
+            bgm_jobs.append(runner.submit(wavbintool.parse_bin, filename, output_filename))
+    else:
+        filenames_bgm = None
+
+    def handle_set(file_set):
+        if 'seq' not in file_set or not file_set['seq']:
+            return
+
+        params = {
+            "input": file_set['seq'],
+            "input_format": None,
+            "output": args.output,
+            "output_format": args.output_format,
+            "sound_folder": sound_folder,
+            "sound_metadata": get_sound_metadata(sound_folder),
+            "event_file": file_set['event'] if 'event' in file_set else None,
+            "parts": args.parts,
+            "difficulty": args.difficulty,
+            "merge_guitars": args.merge_guitars,
+            "events": file_set['events'] if 'events' in file_set else {},
+            "musicdb": args.music_db,
+            "musicid": args.music_id,
+            "input_split": {
+                "drum": {
+                    "nov": args.input_drum_nov,
+                    "bsc": args.input_drum_bsc,
+                    "adv": args.input_drum_adv,
+                    "ext": args.input_drum_ext,
+                    "mst": args.input_drum_mst,
+                },
+                "guitar": {
+                    "nov": args.input_guitar_nov,
+                    "bsc": args.input_guitar_bsc,
+                    "adv": args.input_guitar_adv,
+                    "ext": args.input_guitar_ext,
+                    "mst": args.input_guitar_mst,
+                },
+                "bass": {
+                    "nov": args.input_bass_nov,
+                    "bsc": args.input_bass_bsc,
+                    "adv": args.input_bass_adv,
+                    "ext": args.input_bass_ext,
+                    "mst": args.input_bass_mst,
+                },
+                "open": {
+                    "nov": args.input_open_nov,
+                    "bsc": args.input_open_bsc,
+                    "adv": args.input_open_adv,
+                    "ext": args.input_open_ext,
+                    "mst": args.input_open_mst,
+                }
+            },
+            "render_no_bgm": args.render_no_bgm,
+            "render_auto_name": args.render_auto_name,
+            "render_ext": args.render_ext,
+            "render_quality": args.render_quality,
+            "render_volume": args.render_volume,
+            "render_volume_bgm": args.render_volume_bgm,
+            "render_ignore_auto": args.render_ignore_auto,
+            "dtx_pad_start": args.dtx_pad_start,
+            "dtx_pad_end": args.dtx_pad_end,
+            "dtx_fake_timesigs": args.dtx_fake_timesigs,
+            "no_sounds": args.no_sounds,
+            "generate_bgms": args.generate_bgms,
+        }
+
+        process_file(params)
+
+
+        if args.input_ifs_seq and args.copy_raw_files:
+            for filename in filenames:
+                output_filename = os.path.join(sound_folder, os.path.basename(filename))
+
+                if seq_archive:
+                    seq_archive.extract(filename, sound_folder)
+                else:
+                    shutil.copy2(filename, output_filename)
+
+    def submit_set(file_set):
+        depends = bgm_jobs[:]
+
+        # Extract va3 files before the chart is converted
+        if file_set.get('seq') and 'sound' in file_set and not args.no_sounds:
+            print("Parsing %s..." % file_set['sound'])
+            depends.append(runner.submit(vas3tool.read_vas3, file_set['sound'], sound_folder))
+
+        runner.submit(handle_set, file_set, depends=depends, io=True)
+
+    if "guitar" in args.parts or "bass" in args.parts or "open" in args.parts:
+        submit_set(guitar)
+
+    if "drum" in args.parts:
+        submit_set(drum)
+
+
+def convert_file(args, runner):
+    params = {
+        "input": args.input if args.input else None,
+        "input_format": args.input_format if args.input_format else None,
+        "output": args.output,
+        "output_format": args.output_format,
+        "sound_folder": args.sound_folder,
+        "sound_metadata": get_sound_metadata(args.sound_folder),
+        "event_file": args.event_file if args.event_file else None,
+        "parts": args.parts,
+        "difficulty": args.difficulty,
+        "merge_guitars": args.merge_guitars,
+        "events": read_event_file(args.event_file),
+        "musicdb": args.music_db,
+        "musicid": args.music_id,
+        "input_split": {
+            "drum": {
+                "nov": args.input_drum_nov,
+                "bsc": args.input_drum_bsc,
+                "adv": args.input_drum_adv,
+                "ext": args.input_drum_ext,
+                "mst": args.input_drum_mst,
+            },
+            "guitar": {
+                "nov": args.input_guitar_nov,
+                "bsc": args.input_guitar_bsc,
+                "adv": args.input_guitar_adv,
+                "ext": args.input_guitar_ext,
+                "mst": args.input_guitar_mst,
+            },
+            "bass": {
+                "nov": args.input_bass_nov,
+                "bsc": args.input_bass_bsc,
+                "adv": args.input_bass_adv,
+                "ext": args.input_bass_ext,
+                "mst": args.input_bass_mst,
+            },
+            "open": {
+                "nov": args.input_open_nov,
+                "bsc": args.input_open_bsc,
+                "adv": args.input_open_adv,
+                "ext": args.input_open_ext,
+                "mst": args.input_open_mst,
+            }
+        },
+        "render_no_bgm": args.render_no_bgm,
+        "render_auto_name": args.render_auto_name,
+        "render_ext": args.render_ext,
+        "render_quality": args.render_quality,
+        "render_volume": args.render_volume,
+        "render_volume_bgm": args.render_volume_bgm,
+        "render_ignore_auto": args.render_ignore_auto,
+        "dtx_pad_start": args.dtx_pad_start,
+        "dtx_pad_end": args.dtx_pad_end,
+        "dtx_fake_timesigs": args.dtx_fake_timesigs,
+        "no_sounds": args.no_sounds,
+        "generate_bgms": args.generate_bgms,
+    }
+
+    runner.submit(process_file, params, io=True)
+
+
+# Options that don't change the output of a song in batch mode
+BATCH_IGNORED_OPTIONS = ['batch', 'batch_force', 'jobs', 'single_threaded', 'ffmpeg_path', 'output', 'sound_folder', 'input_ifs_seq', 'input_ifs_bgm', 'ifs_cache']
+
+
+def get_file_signature(filename):
+    if not filename or not os.path.exists(filename):
+        return None
+
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def find_batch_songs(batch_input):
+    # Input can be a folder (searched recursively) or a manifest file
+    # listing one m####_seq.ifs/m####_bgm.ifs path per line
+    if os.path.isdir(batch_input):
+        filenames = glob.glob(os.path.join(batch_input, "**", "m*_seq.ifs"), recursive=True)
+        filenames += glob.glob(os.path.join(batch_input, "**", "m*_bgm.ifs"), recursive=True)
+
+    else:
+        filenames = []
+
+        with open(batch_input, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+
+                if line and not line.startswith("#"):
+                    filenames.append(os.path.join(os.path.dirname(batch_input), line))
+
+    songs = {}
+    for filename in filenames:
+        base_filename = os.path.basename(filename)
+
+        for suffix, key in [("_seq.ifs", "seq"), ("_bgm.ifs", "bgm")]:
+            if base_filename.lower().endswith(suffix):
+                name = base_filename[:-len(suffix)]
+
+                if name not in songs:
+                    songs[name] = {'name': name}
+
+                songs[name][key] = filename
+
+    output = []
+    for name in sorted(songs.keys()):
+        song = songs[name]
+
+        if 'seq' not in song:
+            print("Couldn't find SEQ IFS for %s, skipping" % name)
+            continue
+
+        if 'bgm' not in song:
+            bgm_filename = song['seq'][:-len("_seq.ifs")] + "_bgm.ifs"
+
+            if os.path.exists(bgm_filename):
+                song['bgm'] = bgm_filename
+
+        output.append(song)
+
+    return output
+
+
+def get_batch_song_args(args, song):
+    song_args = copy.copy(args)
+    song_args.batch = None
+    song_args.single_threaded = True
+    song_args.input_ifs_seq = song['seq']
+    song_args.input_ifs_bgm = song.get('bgm', None)
+
+    if args.output_format.lower() == "wav":
+        song_args.output = os.path.join(args.output, "%s.%s" % (song['name'], args.render_ext if args.render_ext else "mp3"))
+    else:
+        song_args.output = os.path.join(args.output, song['name'])
+
+    if args.sound_folder:
+        song_args.sound_folder = os.path.join(args.sound_folder, song['name'])
+
+    return song_args
+
+
+def get_batch_signature(args, song):
+    options = {k: v for k, v in vars(args).items() if k not in BATCH_IGNORED_OPTIONS}
+
+    return {
+        'seq': get_file_signature(song['seq']),
+        'bgm': get_file_signature(song.get('bgm', None)),
+        'options': json.loads(json.dumps(options, sort_keys=True)),
+    }
+
+
+def read_batch_log(filename):
+    # The last entry for each song wins
+    entries = {}
+
+    if os.path.exists(filename):
+        with open(filename, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entries[entry['song']] = entry
+                except:
+                    pass
+
+    return entries
+
+
+def convert_batch_song(song_args):
+    # Runs inside a batch worker, everything for a single song is processed in order
+    start_time = time.time()
+    temp_state = tmpfile.get_temp_state()
+    runner = jobs.init_runner(inline=True)
+    error = None
+
+    try:
+        convert_ifs(song_args, runner)
+
+        failures = runner.wait()
+        if failures:
+            error = "; ".join(["%s: %s" % (name, repr(e)) for name, e in failures])
+
+    except (Exception, SystemExit) as e:
+        error = repr(e)
+
+    finally:
+        tmpfile.tmpcleanup(temp_state)
+
+    return error, time.time() - start_time
+
+
+def run_batch(args):
+    songs = find_batch_songs(args.batch)
+
+    if not songs:
+        print("Couldn't find any songs to convert in", args.batch)
+        return ["batch"]
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    log_filename = os.path.join(args.output, "batch_log.jsonl")
+    previous_entries = read_batch_log(log_filename)
+
+    pending = []
+    skipped = 0
+    for song in songs:
+        song_args = get_batch_song_args(args, song)
+        signature = get_batch_signature(args, song)
+        entry = previous_entries.get(song['name'], None)
+
+        if not args.batch_force and entry and entry['status'] == "ok" and entry['signature'] == signature and os.path.exists(song_args.output):
+            skipped += 1
+            continue
+
+        pending.append((song, song_args, signature))
+
+    print("Converting %d songs (%d already up to date)..." % (len(pending), skipped))
+
+    if args.single_threaded:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+
+    start_time = time.time()
+    failed = []
+    converted = 0
+    input_size = 0
+
+    with open(log_filename, "a", encoding="utf-8") as log, executor:
+        futures = {}
+        for song, song_args, signature in pending:
+            futures[executor.submit(convert_batch_song, song_args)] = (song, signature)
+
+        for future in concurrent.futures.as_completed(futures):
+            song, signature = futures[future]
+
+            try:
+                error, duration = future.result()
+            except Exception as e:
+                error, duration = repr(e), None
+
+            if error is None:
+                converted += 1
+                input_size += sum([x[0] for x in [signature['seq'], signature['bgm']] if x])
+            else:
+                failed.append(song['name'])
+
+            log.write(json.dumps({
+                'song': song['name'],
+                'status': "ok" if error is None else "failed",
+                'error': error,
+                'duration': duration,
+                'signature': signature,
+                'time': time.time(),
+            }) + "\n")
+            log.flush()
+
+            print("[%d/%d] %s: %s" % (converted + len(failed), len(pending), song['name'], "ok" if error is None else "failed (%s)" % error))
+
+    elapsed = time.time() - start_time
+
+    print()
+    print("Converted %d songs, %d failed, %d skipped in %.2f seconds" % (converted, len(failed), skipped, elapsed))
+
+    if elapsed > 0 and converted > 0:
+        print("%.2f songs/minute, %.2f MB/s of input" % (converted / elapsed * 60, input_size / elapsed / 1024 / 1024))
+
+    if failed:
+        print("Failed songs:", " ".join(failed))
+
+    return failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     input_group = parser.add_argument_group('input')
@@ -145,6 +636,11 @@ if __name__ == "__main__":
     input_ifs_group.add_argument('--input-ifs-seq', help='Input file/folder for SEQ (IFS)')
     input_ifs_group.add_argument('--input-ifs-bgm', help='Input file/folder for BGM (IFS)')
     input_ifs_group.add_argument('--ifs-target', help="Target specific chart type within IFS", default=None, choices=['sq3', 'sq2'])
+    input_ifs_group.add_argument('--ifs-cache', help="Keep files extracted from IFS archives in a cache of up to SIZE megabytes between runs", metavar='SIZE', default=None, type=int)
+
+    input_batch_group = parser.add_argument_group('input_batch')
+    input_batch_group.add_argument('--batch', help='Folder containing m####_seq.ifs/m####_bgm.ifs files, or a manifest file listing them, to convert in one go')
+    input_batch_group.add_argument('--batch-force', action='store_true', help='Convert songs even if their output is up to date', default=False)
 
     parser.add_argument('--output', help='Output file/folder', required=True)
     parser.add_argument('--output-format', help='Output file format', required=True)
@@ -173,9 +669,14 @@ if __name__ == "__main__":
     parser.add_argument('--dtx-fake-timesigs', help="Fake time signatures when converting to DTX to work around x/4 limitation", default=False, action='store_true')
 
     parser.add_argument('--single-threaded', help="Process charts in single threads", default=False, action='store_true')
+    parser.add_argument('--jobs', help="Maximum number of jobs to run at the same time (default: number of CPUs)", default=None, type=int)
+    parser.add_argument('--ffmpeg-path', help="Path to ffmpeg executable (only required for non-WAV audio)")
 
     args = parser.parse_args()
 
+    if args.ffmpeg_path:
+        helper.set_ffmpeg_path(args.ffmpeg_path)
+
     # Clean parts and difficulty
     if 'all' in args.parts:
         args.parts = ['drum', 'guitar', 'bass', 'open']
@@ -191,265 +692,24 @@ if __name__ == "__main__":
         if 'all' in args.difficulty or len(args.difficulty) > 1:
             raise Exception("Can only specify one difficulty for WAV export mode")
 
-    if args.input_ifs_seq:
-        if os.path.isdir(args.input_ifs_seq):
-            filenames = glob.glob(args.input_ifs_seq + "/*")
-            ifs_path = args.input_ifs_seq
-        else:
-            filenames, ifs_path = ifs.extract(args.input_ifs_seq)
-
-        # Try to match charts with sound files, then extract as required
-        guitar = {}
-        drum = {}
-        for filename in filenames:
-            base_filename = os.path.basename(filename)
-
-            target_charts = [".sq3", ".sq2"]
-            target_events = [".ev2", ".evt"]
-            if args.ifs_target:
-                if args.ifs_target.lower() == "sq2":
-                    target_charts = [".sq2"]
-                    target_events = [".evt", ".ev2"]
-                elif args.ifs_target.lower() == "sq3":
-                    target_charts = [".sq3"]
-                    target_events = [".ev2", ".evt"]
-                else:
-                    raise Exception("Invalid IFS target selected")
-
-            if base_filename[-4:] in target_charts:
-                if base_filename[0] == 'd':
-                    drum['seq'] = filename
-                elif base_filename[0] == 'g':
-                    guitar['seq'] = filename
-            elif base_filename[-4:] == ".va3" and not args.no_sounds:
-                if base_filename[-5] == 'd':
-                    drum['sound'] = filename
-                elif base_filename[-5] == 'g':
-                    guitar['sound'] = filename
-            elif base_filename[-4:] in target_events:
-                # Give priority to the events file at the top of the list
-                if base_filename[-4:] != target_events[0] and 'events' in drum:
-                    continue
-
-                event_xml = eamxml.get_raw_xml(open(filename, "rb").read())
-
-                if len(event_xml) > 0:
-                    events = event.get_bonus_notes_by_timestamp(event_xml)
-                    drum['events'] = events
-                    guitar['events'] = events
-
-        if args.sound_folder:
-            sound_folder = args.sound_folder
-        elif args.output:
-            sound_folder = args.output
-        else:
-            sound_folder = tmpfile.mkdtemp(prefix="sounds")
-
-        if not os.path.exists(sound_folder) and not args.no_sounds:
-            os.makedirs(sound_folder)
-
-        if args.input_ifs_bgm and args.copy_raw_files:
-            if os.path.isdir(args.input_ifs_bgm):
-                filenames_bgm = glob.glob(args.input_ifs_bgm + "/*.bin")
-                ifs_path = args.input_ifs_bgm
-            else:
-                filenames_bgm, ifs_path = ifs.extract(args.input_ifs_bgm)
-
-            if not os.path.exists(args.output):
-                os.makedirs(args.output)
-
-            for filename in filenames_bgm:
-                output_filename = os.path.join(args.output, os.path.basename(filename))
-                shutil.copy2(filename, output_filename)
-
-        if args.input_ifs_bgm and not args.no_sounds:
-            if os.path.isdir(args.input_ifs_bgm):
-                filenames_bgm = glob.glob(args.input_ifs_bgm + "/*.bin")
-                ifs_path = args.input_ifs_bgm
-            else:
-                filenames_bgm, ifs_path = ifs.extract(args.input_ifs_bgm)
-
-            for filename in filenames_bgm:
-                # Convert to WAV
-                output_filename = filename.replace(".bin", ".wav")
-                output_filename = os.path.join(sound_folder, os.path.basename(filename).replace(".bin", ".wav"))
-
-                print("Converting %s..." % output_filename)
-
-                if not args.single_threaded:
-                    bgm_thread = threading.Thread(target=wavbintool.parse_bin, args=(filename, output_filename))
-                    bgm_thread.start()
-                    running_threads.append(bgm_thread)
-                else:
-                    wavbintool.parse_bin(filename, output_filename)
-        else:
-            filenames_bgm = None
-
-        def handle_set(file_set):
-            if 'seq' not in file_set or not file_set['seq']:
-                return
-
-            # Extract va3 files
-            if 'sound' in file_set and not args.no_sounds:
-                print("Parsing %s..." % file_set['sound'])
-                vas3tool.read_vas3(file_set['sound'], sound_folder)
-
-            params = {
-                "input": file_set['seq'],
-                "input_format": None,
-                "output": args.output,
-                "output_format": args.output_format,
-                "sound_folder": sound_folder,
-                "sound_metadata": get_sound_metadata(sound_folder),
-                "event_file": file_set['event'] if 'event' in file_set else None,
-                "parts": args.parts,
-                "difficulty": args.difficulty,
-                "merge_guitars": args.merge_guitars,
-                "events": file_set['events'] if 'events' in file_set else {},
-                "musicdb": args.music_db,
-                "musicid": args.music_id,
-                "input_split": {
-                    "drum": {
-                        "nov": args.input_drum_nov,
-                        "bsc": args.input_drum_bsc,
-                        "adv": args.input_drum_adv,
-                        "ext": args.input_drum_ext,
-                        "mst": args.input_drum_mst,
-                    },
-                    "guitar": {
-                        "nov": args.input_guitar_nov,
-                        "bsc": args.input_guitar_bsc,
-                        "adv": args.input_guitar_adv,
-                        "ext": args.input_guitar_ext,
-                        "mst": args.input_guitar_mst,
-                    },
-                    "bass": {
-                        "nov": args.input_bass_nov,
-                        "bsc": args.input_bass_bsc,
-                        "adv": args.input_bass_adv,
-                        "ext": args.input_bass_ext,
-                        "mst": args.input_bass_mst,
-                    },
-                    "open": {
-                        "nov": args.input_open_nov,
-                        "bsc": args.input_open_bsc,
-                        "adv": args.input_open_adv,
-                        "ext": args.input_open_ext,
-                        "mst": args.input_open_mst,
-                    }
-                },
-                "render_no_bgm": args.render_no_bgm,
-                "render_auto_name": args.render_auto_name,
-                "render_ext": args.render_ext,
-                "render_quality": args.render_quality,
-                "render_volume": args.render_volume,
-                "render_volume_bgm": args.render_volume_bgm,
-                "render_ignore_auto": args.render_ignore_auto,
-                "dtx_pad_start": args.dtx_pad_start,
-                "dtx_pad_end": args.dtx_pad_end,
-                "dtx_fake_timesigs": args.dtx_fake_timesigs,
-                "no_sounds": args.no_sounds,
-                "generate_bgms": args.generate_bgms,
-            }
-
-            process_file(params)
-
-
-            if args.input_ifs_seq and args.copy_raw_files:
-                if os.path.isdir(args.input_ifs_seq):
-                    filenames_seq = glob.glob(args.input_ifs_seq + "/*")
-                    ifs_path = args.input_ifs_seq
-                else:
-                    filenames_seq, ifs_path = ifs.extract(args.input_ifs_seq)
-
-                for filename in filenames_seq:
-                    output_filename = os.path.join(sound_folder, os.path.basename(filename))
-                    shutil.copy2(filename, output_filename)
-
-        if "guitar" in args.parts or "bass" in args.parts or "open" in args.parts:
-            if not args.single_threaded:
-                guitar_thread = threading.Thread(target=handle_set, args=(guitar,))
-                guitar_thread.start()
-                running_threads.append(guitar_thread)
-            else:
-                handle_set(guitar)
-
-        if "drum" in args.parts:
-            if not args.single_threaded:
-                drum_thread = threading.Thread(target=handle_set, args=(drum,))
-                drum_thread.start()
-                running_threads.append(drum_thread)
-            else:
-                handle_set(drum)
+    if args.batch:
+        failures = run_batch(args)
 
     else:
-        params = {
-            "input": args.input if args.input else None,
-            "input_format": args.input_format if args.input_format else None,
-            "output": args.output,
-            "output_format": args.output_format,
-            "sound_folder": args.sound_folder,
-            "sound_metadata": get_sound_metadata(args.sound_folder),
-            "event_file": args.event_file if args.event_file else None,
-            "parts": args.parts,
-            "difficulty": args.difficulty,
-            "merge_guitars": args.merge_guitars,
-            "events": event.get_bonus_notes_by_timestamp(eamxml.get_raw_xml(open(args.event_file, "rb").read())) if args.event_file else {},
-            "musicdb": args.music_db,
-            "musicid": args.music_id,
-            "input_split": {
-                "drum": {
-                    "nov": args.input_drum_nov,
-                    "bsc": args.input_drum_bsc,
-                    "adv": args.input_drum_adv,
-                    "ext": args.input_drum_ext,
-                    "mst": args.input_drum_mst,
-                },
-                "guitar": {
-                    "nov": args.input_guitar_nov,
-                    "bsc": args.input_guitar_bsc,
-                    "adv": args.input_guitar_adv,
-                    "ext": args.input_guitar_ext,
-                    "mst": args.input_guitar_mst,
-                },
-                "bass": {
-                    "nov": args.input_bass_nov,
-                    "bsc": args.input_bass_bsc,
-                    "adv": args.input_bass_adv,
-                    "ext": args.input_bass_ext,
-                    "mst": args.input_bass_mst,
-                },
-                "open": {
-                    "nov": args.input_open_nov,
-                    "bsc": args.input_open_bsc,
-                    "adv": args.input_open_adv,
-                    "ext": args.input_open_ext,
-                    "mst": args.input_open_mst,
-                }
-            },
-            "render_no_bgm": args.render_no_bgm,
-            "render_auto_name": args.render_auto_name,
-            "render_ext": args.render_ext,
-            "render_quality": args.render_quality,
-            "render_volume": args.render_volume,
-            "render_volume_bgm": args.render_volume_bgm,
-            "render_ignore_auto": args.render_ignore_auto,
-            "dtx_pad_start": args.dtx_pad_start,
-            "dtx_pad_end": args.dtx_pad_end,
-            "dtx_fake_timesigs": args.dtx_fake_timesigs,
-            "no_sounds": args.no_sounds,
-            "generate_bgms": args.generate_bgms,
-        }
+        runner = jobs.init_runner(args.jobs, inline=args.single_threaded)
 
-        if not args.single_threaded:
-            parse_thread = threading.Thread(target=process_file, args=(params,))
-            parse_thread.start()
-            running_threads.append(parse_thread)
+        if args.input_ifs_seq:
+            convert_ifs(args, runner)
         else:
-            process_file(params)
+            convert_file(args, runner)
 
-    if not args.single_threaded:
-        for thread in running_threads:
-            thread.join()
+        failures = runner.wait()
+        runner.shutdown()
+
+        if failures:
+            print("%d job(s) failed" % len(failures))
 
     tmpfile.tmpcleanup()
+
+    if failures:
+        exit(1)
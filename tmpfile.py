@@ -30,13 +30,32 @@ def mkdtemp(prefix=None):
     temp_foldernames.append(foldername)
     return foldername
 
-def tmpcleanup():
-    for filename in temp_filenames:
+def get_temp_state():
+    return (len(temp_filenames), len(temp_foldernames))
+
+def tmpcleanup(state=(0, 0)):
+    # Only removes temp files/folders created after state (see get_temp_state)
+    for filename in temp_filenames[state[0]:]:
         if os.path.exists(filename):
             #print("Removing temp file", filename)
             os.remove(filename)
 
-    for foldername in temp_foldernames:
+    for foldername in temp_foldernames[state[1]:]:
         if os.path.exists(foldername):
             #print("Removing temp folder", foldername)
-            shutil.rmtree(foldername)
\ No newline at end of file
+            shutil.rmtree(foldername)
+
+    del temp_filenames[state[0]:]
+    del temp_foldernames[state[1]:]
+
+def get_cache_dir(name=None):
+    # Unlike the temp files above, this folder is kept between runs.
+    # It can be moved somewhere else with the GITADORA_CUSTOMS_CACHE environment variable.
+    foldername = os.environ.get("GITADORA_CUSTOMS_CACHE", os.path.join(tempfile.gettempdir(), "gitadora-customs-cache"))
+
+    if name:
+        foldername = os.path.join(foldername, name)
+
+    os.makedirs(foldername, exist_ok=True)
+
+    return foldername
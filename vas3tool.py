@@ -16,9 +16,6 @@ import helper
 
 import adpcmwave
 
-import imageio
-imageio.plugins.ffmpeg.download()
-
 
 GDX_SIZES = {
     'GDXH': 0x14,
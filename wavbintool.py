@@ -11,8 +11,6 @@ import tmpfile
 
 import helper
 
-helper.check_ffmpeg()
-
 def parse_bin(input_filename, output_filename):
     with open(input_filename,"rb") as f:
         data = f.read()